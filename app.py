@@ -1,210 +1,238 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, flash, g, send_file
+from flask import before_render_template, template_rendered
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
 from datetime import datetime, timedelta
+import hmac
 import os
 import random
+import time
+
+import chat_intent
+import database
+import history
+import invoices
+import itinerary
+import metrics
+import migrations
+import outbound
+import reservations
+import revisions
+import ride_archive
+import user_stats
+import wire
+from ride_search import (DEFAULT_RADIUS_KM, city_key, decode_cursor, geo_search, parse_fields,
+                         parse_filters, parse_point, search_page, search_rides)
+from ride_snapshot import RideSnapshot, STALENESS_SECONDS
+from search_cache import SearchCache
+from gazetteer import Gazetteer, TeleportFallback
+from ride_import import INSERT_RIDE, detect_format, import_rides, iter_rows, validate_ride
+from live_location import STREAM_SECONDS, LocationHub, parse_location
+from lanes import LaneGate, Shed
+from sos_dispatch import SOSDispatcher
+from database import init_db
 
 app = Flask(__name__)
 app.secret_key = 'yatrasetu_secret_key_2024'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
+
+# Behind a reverse proxy every request comes from its address. Set
+# PROXY_HOPS to the number of proxies in front of the app, and
+# remote_addr is taken from the X-Forwarded-For entry the nearest one
+# wrote. It only keys rate limits (admit_request), never access: see
+# prometheus_metrics.
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+# Search results per (source, destination, date); see search_cache.py
+search_cache = SearchCache(
+    max_entries=int(os.environ.get('SEARCH_CACHE_SIZE', 512)),
+    ttl=float(os.environ.get('SEARCH_CACHE_TTL', 30))
+)
+
+# SEARCH_SNAPSHOT=1 answers city searches from active rides held in
+# memory, at most SEARCH_SNAPSHOT_STALENESS seconds old; see ride_snapshot.py
+search_snapshot = (RideSnapshot(float(os.environ.get('SEARCH_SNAPSHOT_STALENESS', STALENESS_SECONDS)))
+                   if os.environ.get('SEARCH_SNAPSHOT', '0') == '1' else None)
+
+# City autocomplete is answered locally; Teleport is an opt-in fallback
+city_index = Gazetteer.load()
+teleport_fallback = TeleportFallback(enabled=os.environ.get('CITY_SUGGEST_TELEPORT') == '1',
+                                     wait=float(os.environ.get('CITY_SUGGEST_TELEPORT_WAIT', 0.3)))
+
+# Bookings in this worker go through one writer thread that commits them
+# in batches (see reservations.py); BOOKING_GROUP_COMMIT=0 books inline
+booking_writer = (reservations.GroupCommitter()
+                  if os.environ.get('BOOKING_GROUP_COMMIT', '1') != '0' else None)
+
+# Active rides as connections for multi-leg trip planning; see itinerary.py
+itineraries = itinerary.ConnectionIndex()
+
+# Driver positions fanned out to tracking pages; held in this process only,
+# so tracking needs a single worker process; see live_location.py
+location_hub = LocationHub()
+
+# SOS alerts are persisted by the request and notified in the background,
+# using live positions to find nearby drivers; see sos_dispatch.py
+sos_dispatcher = SOSDispatcher(locator=location_hub)
+
+# Invoices of confirmed bookings are rendered by INVOICE_WORKERS threads in
+# the background and stored under INVOICE_DIR; see invoices.py.
+# INVOICE_WORKERS=0 leaves the queue to another worker or process.
+invoice_workers = (invoices.InvoiceWorkers(int(os.environ.get('INVOICE_WORKERS', 2)))
+                   if os.environ.get('INVOICE_WORKERS', '2') != '0' else None)
+
+# Departed rides are expired and, after RIDE_ARCHIVE_DAYS, archived in the
+# background; see ride_archive.py. RIDE_SWEEP_SECONDS=0 turns it off.
+def forget_expired_rides(rides):
+    # Cached searches would list them until their TTL ran out
+    if search_snapshot:
+        search_snapshot.changed()
+    if len(rides) > 100:
+        search_cache.clear()
+        return
+    for ride in rides:
+        search_cache.invalidate_ride(ride['source_city'], ride['destination_city'], ride['departure_time'])
+
+ride_sweeper = ride_archive.RideSweeper(
+    interval=int(os.environ.get('RIDE_SWEEP_SECONDS', ride_archive.SWEEP_SECONDS)),
+    on_expired=forget_expired_rides
+)
+
+# Keep RESERVED_LANES of this worker's WORKER_THREADS free for SOS and
+# booking writes, and rate-limit each client per lane; see lanes.py.
+# WORKER_THREADS must match the server's threads per worker process.
+request_lanes = LaneGate(
+    capacity=int(os.environ.get('WORKER_THREADS', 8)),
+    reserved=int(os.environ.get('RESERVED_LANES', 2)),
+    limits=os.environ.get('ADMISSION_LIMITS', '1') != '0'
+)
+# Endpoint -> lane of request_lanes; the rest are 'general'
+ENDPOINT_LANES = {
+    'sos_emergency': 'priority',
+    'api_book_ride': 'booking',
+    'api_book_rides': 'booking',
+    'api_chat': 'chat',
+    'api_city_suggest': 'suggest',
+    'api_search_rides': 'search',
+    'api_itineraries': 'search',
+    'api_get_ride': 'search',
+    'api_booking_location_stream': 'stream',
+    'static': 'static',
+}
+
+# Query arguments of /api/search-rides passed to ride_search.parse_filters
+FILTER_ARGS = ('ride_type', 'vehicle_type', 'min_price', 'max_price', 'seats')
+
+# gzip (brotli if installed) for JSON and text bodies above
+# API_COMPRESS_MIN_BYTES; see wire.py
+compressor = wire.Compressor()
+
+# Gauges for /metrics from the components' own stats(); see metrics.py
+metrics.register_collector(metrics.stats_collector('db_pool', 'Connection pool', database.pool_stats))
+metrics.register_collector(metrics.stats_collector('search_cache', 'Search cache', search_cache.stats))
+metrics.register_collector(metrics.stats_collector('lanes', 'Request lanes', request_lanes.stats))
+metrics.register_collector(request_lanes.collect)
+metrics.register_collector(metrics.stats_collector('itineraries', 'Trip planner', itineraries.stats))
+metrics.register_collector(metrics.stats_collector('outbound', 'Outbound HTTP', outbound.shared.stats))
+metrics.register_collector(metrics.stats_collector('ride_sweeper', 'Ride expiry and archive', ride_sweeper.stats))
+metrics.register_collector(metrics.stats_collector('compression', 'Response compression', compressor.stats))
+if invoice_workers:
+    metrics.register_collector(metrics.stats_collector('invoices', 'Invoice workers', invoice_workers.stats))
+if search_snapshot:
+    metrics.register_collector(metrics.stats_collector('search_snapshot', 'Search snapshot', search_snapshot.stats))
+if booking_writer:
+    metrics.register_collector(metrics.stats_collector('booking_writer', 'Group commit', booking_writer.stats))
 # //test
 @app.route('/test-find-ride')
 def test_find_ride():
     return render_template('test-find-ride.html')
 
-# Database connection
+# Database connection: borrow this thread's pooled connection for the
+# lifetime of the app context instead of opening a new one per call
 def get_db_connection():
-    conn = sqlite3.connect('yatrasetu.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    if 'db' not in g:
+        g.db = database.checkout()
+    return g.db
 
-# Initialize database
-def init_db():
-    print("🔄 Initializing database...")
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            phone TEXT,
-            user_type TEXT DEFAULT 'passenger',
-            profile_image TEXT,
-            rating REAL DEFAULT 5.0,
-            total_rides INTEGER DEFAULT 0,
-            member_since TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    print("✅ Created users table")
-    
-    # Create rides table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rides (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            ride_type TEXT NOT NULL,
-            source_city TEXT NOT NULL,
-            destination_city TEXT NOT NULL,
-            departure_time TIMESTAMP NOT NULL,
-            arrival_time TIMESTAMP,
-            vehicle_type TEXT NOT NULL,
-            vehicle_number TEXT NOT NULL,
-            available_capacity INTEGER NOT NULL,
-            price_per_unit DECIMAL(10,2) NOT NULL,
-            additional_info TEXT,
-            contact_number TEXT NOT NULL,
-            preferred_language TEXT DEFAULT 'hindi',
-            status TEXT DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    print("✅ Created rides table")
-    
-    # Create bookings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ride_id INTEGER NOT NULL,
-            passenger_id INTEGER NOT NULL,
-            quantity INTEGER NOT NULL,
-            total_amount DECIMAL(10,2) NOT NULL,
-            status TEXT DEFAULT 'confirmed',
-            booked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (ride_id) REFERENCES rides (id),
-            FOREIGN KEY (passenger_id) REFERENCES users (id)
-        )
-    ''')
-    print("✅ Created bookings table")
-    
-    # Create SOS alerts table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sos_alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            latitude REAL,
-            longitude REAL,
-            address TEXT,
-            status TEXT DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    print("✅ Created sos_alerts table")
-    
-    # Check if we need to add sample data
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]
-    
-    if user_count == 0:
-        print("📝 Adding sample data...")
-        sample_users = [
-            ('Prasad Sharma', 'prasad@example.com', 'password123', '9876543210', 'driver'),
-            ('Siddhesh Patil', 'siddhesh@example.com', 'password123', '9876543211', 'passenger'),
-            ('Pranit Deshmukh', 'pranit@example.com', 'password123', '9876543212', 'driver'),
-            ('Sudin More', 'sudin@example.com', 'password123', '9876543213', 'passenger'),
-            ('Tejas Jadhav', 'tejas@example.com', 'password123', '9876543214', 'driver'),
-            ('Pranav Kulkarni', 'pranav@example.com', 'password123', '9876543215', 'passenger'),
-            ('Admin User', 'admin@yatrasetu.com', 'admin123', '9876543216', 'admin')
-        ]
-        
-        cursor.executemany('''
-            INSERT INTO users (name, email, password, phone, user_type)
-            VALUES (?, ?, ?, ?, ?)
-        ''', sample_users)
-        
-        # Create sample rides
-        sample_rides = [
-            (1, 'car', 'Nashik', 'Delhi', '2024-01-20 08:00:00', '2024-01-20 20:00:00', 
-             'SUV', 'MH15AB1234', 4, 500.00, 'Comfortable AC SUV with music system', '9876543210'),
-            (3, 'bike', 'Sangamner', 'Pune', '2024-01-21 07:00:00', '2024-01-21 12:00:00',
-             'Motorcycle', 'MH12CD5678', 1, 200.00, 'Safe rider with helmet', '9876543212'),
-            (5, 'logistics', 'Pune', 'Mumbai', '2024-01-22 09:00:00', '2024-01-22 14:00:00',
-             'Tempo', 'MH14EF9012', 500, 50.00, 'Goods transport with care', '9876543214')
-        ]
-        
-        cursor.executemany('''
-            INSERT INTO rides (user_id, ride_type, source_city, destination_city, departure_time, 
-                             arrival_time, vehicle_type, vehicle_number, available_capacity, 
-                             price_per_unit, additional_info, contact_number)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', sample_rides)
-        
-        print("✅ Sample data added successfully!")
-    
-    conn.commit()
-    conn.close()
-    print("🎉 Database initialization complete!")
+@app.before_request
+def start_request_timer():
+    metrics.begin_request()
 
-# Check and initialize database
-def check_database():
-    if not os.path.exists('yatrasetu.db'):
-        print("🆕 Creating new database...")
-        init_db()
-        return
-    
-    # Check if all tables exist
-    conn = get_db_connection()
-    cursor = conn.cursor()
+LOOPBACK = ('127.0.0.1', '::1')
+
+@app.before_request
+def admit_request():
+    sos_dispatcher.start()
+    ride_sweeper.start()
+    if invoice_workers:
+        invoice_workers.start()
+    lane = ENDPOINT_LANES.get(request.endpoint, 'general')
+    # A loopback address is a proxy that PROXY_HOPS does not cover, shared
+    # by everyone behind it: such requests get no per-client bucket
+    if 'user_id' in session:
+        client = f"user:{session['user_id']}"
+    elif request.remote_addr in LOOPBACK:
+        client = None
+    else:
+        client = f'ip:{request.remote_addr}'
     try:
-        cursor.execute("SELECT 1 FROM users LIMIT 1")
-        cursor.execute("SELECT 1 FROM rides LIMIT 1")
-        cursor.execute("SELECT 1 FROM bookings LIMIT 1")
-        cursor.execute("SELECT 1 FROM sos_alerts LIMIT 1")
-        print("✅ All database tables exist")
-    except sqlite3.OperationalError as e:
-        print(f"🔄 Recreating missing tables: {e}")
-        init_db()
-    finally:
-        conn.close()
+        g.lane = (lane, request_lanes.admit(lane, client))
+    except Shed as shed:
+        message = ('Too many requests, please slow down' if shed.status == 429
+                   else 'Server is busy, please try again')
+        response = jsonify({'success': False, 'message': message})
+        response.headers['Retry-After'] = str(shed.retry_after)
+        return response, shed.status
+    return None
+
+@app.teardown_request
+def release_lane(exc):
+    held = g.pop('lane', None)
+    if held:
+        request_lanes.release(*held)
+
+@app.after_request
+def note_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.after_request
+def compress_response(response):
+    return compressor.compress(response, request.accept_encodings, request.full_path)
+
+@app.teardown_request
+def record_request_time(exc):
+    status = g.pop('response_status', None) or (500 if exc else 200)
+    metrics.end_request(request.endpoint, request.method, status)
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    metrics.begin_template()
+
+@template_rendered.connect_via(app)
+def record_template_time(sender, template, context, **extra):
+    metrics.end_template(template.name)
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        database.release(conn)
 
 # Routes
 @app.route('/')
 def index():
-    user_stats = {}
+    stats = {}
     if 'user_id' in session:
-        conn = get_db_connection()
-        
         try:
-            # Get user stats
-            user_stats['active_rides'] = conn.execute(
-                'SELECT COUNT(*) FROM rides WHERE user_id = ? AND status = "active"',
-                (session['user_id'],)
-            ).fetchone()[0]
-            
-            user_stats['total_bookings'] = conn.execute(
-                'SELECT COUNT(*) FROM bookings WHERE passenger_id = ?',
-                (session['user_id'],)
-            ).fetchone()[0]
-            
-            user_stats['rating'] = conn.execute(
-                'SELECT rating FROM users WHERE id = ?',
-                (session['user_id'],)
-            ).fetchone()[0]
-            
-            # Calculate days since joining
-            join_date = conn.execute(
-                'SELECT member_since FROM users WHERE id = ?',
-                (session['user_id'],)
-            ).fetchone()[0]
-            if join_date:
-                join_date = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S')
-                user_stats['days_joined'] = (datetime.now() - join_date).days
-            else:
-                user_stats['days_joined'] = 1
-                
+            stats = user_stats.dashboard_stats(get_db_connection(), session['user_id'])
         except sqlite3.OperationalError as e:
             print(f"Database error: {e}")
-            user_stats = {'active_rides': 0, 'total_bookings': 0, 'rating': 5.0, 'days_joined': 1}
-        finally:
-            conn.close()
+            stats = dict(user_stats.DEFAULT_STATS)
     
-    return render_template('index.html', user_stats=user_stats)
+    return render_template('index.html', user_stats=stats)
 
 @app.route('/find-ride')
 def find_ride():
@@ -223,7 +251,6 @@ def booking(ride_id):
         'SELECT r.*, u.name as driver_name, u.phone as driver_phone FROM rides r JOIN users u ON r.user_id = u.id WHERE r.id = ?',
         (ride_id,)
     ).fetchone()
-    conn.close()
 
     if not ride:
         flash('Ride not found or may have been removed', 'error')
@@ -248,21 +275,16 @@ def my_rides():
         return redirect(url_for('login'))
     
     conn = get_db_connection()
+    before = request.args.get('before', type=int)
     try:
-        rides = conn.execute('''
-            SELECT r.*, COUNT(b.id) as bookings_count
-            FROM rides r 
-            LEFT JOIN bookings b ON r.id = b.ride_id 
-            WHERE r.user_id = ? 
-            GROUP BY r.id 
-            ORDER BY r.created_at DESC
-        ''', (session['user_id'],)).fetchall()
+        rides, next_before = history.ride_history(conn, session['user_id'], before)
+        stats = user_stats.dashboard_stats(conn, session['user_id'])
     except sqlite3.OperationalError:
-        rides = []
-    finally:
-        conn.close()
+        rides, next_before = [], None
+        stats = dict(user_stats.DEFAULT_STATS)
     
-    return render_template('my_rides.html', rides=rides)
+    return render_template('my_rides.html', rides=rides, stats=stats,
+                           before=before, next_before=next_before)
 
 @app.route('/my-bookings')
 def my_bookings():
@@ -271,21 +293,44 @@ def my_bookings():
         return redirect(url_for('login'))
     
     conn = get_db_connection()
+    before = request.args.get('before', type=int)
     try:
-        bookings = conn.execute('''
-            SELECT b.*, r.*, u.name as driver_name
-            FROM bookings b
-            JOIN rides r ON b.ride_id = r.id
-            JOIN users u ON r.user_id = u.id
-            WHERE b.passenger_id = ?
-            ORDER BY b.booked_at DESC
-        ''', (session['user_id'],)).fetchall()
+        bookings, next_before = history.booking_history(conn, session['user_id'], before)
+        stats = user_stats.dashboard_stats(conn, session['user_id'])
     except sqlite3.OperationalError:
-        bookings = []
-    finally:
-        conn.close()
+        bookings, next_before = [], None
+        stats = dict(user_stats.DEFAULT_STATS)
+    
+    return render_template('my_bookings.html', bookings=bookings, stats=stats,
+                           before=before, next_before=next_before)
+
+@app.route('/invoice/<int:booking_id>')
+def booking_invoice(booking_id):
+    """The stored invoice of one of the user's bookings (any booking for admins)"""
+    if 'user_id' not in session:
+        flash('Please login to view your invoices', 'warning')
+        return redirect(url_for('login'))
+    
+    conn = get_db_connection()
+    passenger_id = None if session.get('user_type') == 'admin' else session['user_id']
+    invoice = invoices.lookup(conn, booking_id, passenger_id)
+    if not invoice or (invoice['status'] is None and invoice['booking_status'] not in ('confirmed', 'completed')):
+        flash('No invoice found for this booking', 'warning')
+        return redirect(url_for('my_bookings'))
+    
+    path = invoices.path_of(invoice['digest']) if invoice['digest'] else None
+    if path and os.path.exists(path):
+        return send_file(os.path.abspath(path), mimetype='text/html', etag=invoice['digest'],
+                         download_name=f'invoice-{booking_id}.html')
     
-    return render_template('my_bookings.html', bookings=bookings)
+    # Not rendered yet, failed, or its file is gone: ask for it now
+    if invoice['status'] != 'queued':
+        invoices.enqueue(conn, [booking_id])
+        conn.commit()
+    if invoice_workers:
+        invoice_workers.wake()
+    flash('Your invoice is being prepared, please check again in a moment', 'info')
+    return redirect(url_for('my_bookings'))
 
 @app.route('/profile')
 def profile():
@@ -298,7 +343,6 @@ def profile():
         'SELECT * FROM users WHERE id = ?', 
         (session['user_id'],)
     ).fetchone()
-    conn.close()
     
     return render_template('profile.html', user=user)
 
@@ -313,7 +357,6 @@ def login():
             'SELECT * FROM users WHERE email = ? AND password = ?',
             (email, password)
         ).fetchone()
-        conn.close()
         
         if user:
             session['user_id'] = user['id']
@@ -364,7 +407,6 @@ def register():
                 'SELECT * FROM users WHERE email = ?', 
                 (email,)
             ).fetchone()
-            conn.close()
             
             # Auto login
             session['user_id'] = user['id']
@@ -396,35 +438,21 @@ def api_post_ride():
     
     data = request.get_json()
     
+    try:
+        values = validate_ride(data, session['user_id'], city_index.locate)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO rides (
-                user_id, ride_type, source_city, destination_city, departure_time,
-                arrival_time, vehicle_type, vehicle_number, available_capacity,
-                price_per_unit, additional_info, contact_number, preferred_language
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            session['user_id'],
-            data['ride_type'],
-            data['source_city'],
-            data['destination_city'],
-            data['departure_time'],
-            data.get('arrival_time'),
-            data['vehicle_type'],
-            data['vehicle_number'],
-            data['available_capacity'],
-            data['price_per_unit'],
-            data.get('additional_info', ''),
-            data['contact_number'],
-            data.get('preferred_language', 'hindi')
-        ))
-        
+        cursor.execute(INSERT_RIDE, values)
         conn.commit()
         ride_id = cursor.lastrowid
-        conn.close()
+        search_cache.invalidate_ride(values[2], values[3], values[4])
+        if search_snapshot:
+            search_snapshot.changed()
+        itineraries.ride_changed(conn, [ride_id])
         
         return jsonify({
             'success': True, 
@@ -436,226 +464,666 @@ def api_post_ride():
         return jsonify({'success': False, 'message': str(e)})
 
 
+@app.route('/api/import-rides', methods=['POST'])
+def api_import_rides():
+    """Bulk ride import for fleet operators.
+
+    Send CSV (header row with the /api/post-ride field names) or NDJSON
+    (one ride object per line), either as the raw request body or as a
+    multipart upload named 'file'. ?format=csv|ndjson overrides detection.
+    Rows are read and inserted incrementally; invalid rows are reported
+    and skipped. An upload that cannot be read to the end gets a 400 that
+    still counts the rides imported before the bad part.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, '', request.mimetype
+    fmt = detect_format(request.args.get('format'), content_type, filename)
+    
+    started = time.perf_counter()
+    try:
+        rows = iter_rows(stream, fmt)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Could not read upload: {e}'}), 400
+    summary = import_rides(get_db_connection(), rows, session['user_id'], locate=city_index.locate)
+    
+    # Chunks before a read error are committed, so invalidate either way
+    corridors = summary.pop('corridors')
+    read_error = summary.pop('read_error')
+    itineraries.invalidate()
+    if search_snapshot:
+        search_snapshot.changed()
+    if len(corridors) > 100:
+        search_cache.clear()
+    else:
+        for source, destination, day in corridors:
+            search_cache.invalidate_ride(source, destination, day)
+    
+    if read_error:
+        summary.update({
+            'success': False,
+            'message': f"Could not read upload: {read_error} ({summary['imported']} rides imported before it)"
+        })
+        return jsonify(summary), 400
+    summary.update({
+        'success': True,
+        'message': f"Imported {summary['imported']} rides ({summary['failed']} rejected)",
+        'seconds': round(time.perf_counter() - started, 3)
+    })
+    return jsonify(summary)
+
+
 @app.route('/chat')
 def chat_page():
     return render_template('chat.html')
 
 
+# Ride cards in a chat reply; one search page is filtered by seats and
+# ride type (passenger rides unless the message asks for goods)
+CHAT_RIDE_TYPES = {'car', 'bike'}
+CHAT_CARD_FIELDS = ('id,ride_type,source_city,destination_city,departure_time,vehicle_type,'
+                    'available_capacity,price_per_unit,driver_name,rating')
+CHAT_SEARCH_LIMIT = 20
+CHAT_MAX_CARDS = 5
+
+
 @app.route('/api/chat', methods=['POST'])
 def api_chat():
+    """Answer a chat message; ride queries come back with ride cards.
+
+    The message is parsed by chat_intent into an intent and slots (cities,
+    date, seats, ride type) and a search runs through the same code and
+    cache as /api/search-rides.
+    """
     data = request.get_json() or {}
     msg = (data.get('message') or '').strip()
     if not msg:
         return jsonify({'success': False, 'reply': "Please send a message."})
 
-    # Very small rule-based responder: expand as needed or plug an LLM here.
-    lower = msg.lower()
-    if 'hello' in lower or 'hi' in lower:
-        reply = f"Hello! I'm the YatraSetu assistant. How can I help you today?"
-    elif 'book' in lower or 'booking' in lower:
-        reply = "To book a ride, search for a ride and click 'Book' on the ride card. I can open the Find Ride page for you."
-    elif 'where' in lower and 'ride' in lower:
-        reply = "You can see available rides on the Find Ride page. Enter source and destination and press Search."
-    elif 'help' in lower:
-        reply = "I can help you find rides, post rides, and view your bookings. Try: 'Find rides from Pune to Mumbai on 2024-01-22'."
-    else:
-        # fallback echo with guidance
-        reply = "I heard: '" + msg + "'. I can help with searching rides, booking, and account info. Try asking: 'Find rides from Pune to Mumbai'."
-
-    return jsonify({'success': True, 'reply': reply})
+    query = chat_intent.parse(msg, city_index)
+    payload = {
+        'success': True,
+        'intent': query.intent,
+        'query': query._asdict(),
+        'reply': chat_intent.REPLIES[query.intent],
+        'link': chat_intent.LINKS.get(query.intent),
+    }
+    if query.intent == chat_intent.SEARCH and (query.source or query.destination):
+        _, found = _search_payload(city_key(query.source), city_key(query.destination), query.travel_date,
+                                   CHAT_CARD_FIELDS, str(CHAT_SEARCH_LIMIT))
+        rides = [ride for ride in found['rides']
+                 if ride['available_capacity'] >= (query.seats or 1)
+                 and ride['ride_type'] in ({query.ride_type} if query.ride_type else CHAT_RIDE_TYPES)]
+        more = len(rides) > CHAT_MAX_CARDS or found['has_more']
+        payload['rides'] = rides[:CHAT_MAX_CARDS]
+        payload['reply'] = chat_intent.describe(query, len(payload['rides']), more)
+    return jsonify(payload)
 
 @app.route('/api/search-rides')
 def api_search_rides():
+    """Search active rides.
+
+    Without limit/after this returns every match as a JSON array. With
+    limit (max 100) and/or after it returns one page ordered by
+    (departure_time, id) plus a next_cursor to pass back as after.
+    fields=a,b,c restricts the columns returned.
+
+    lat/lon/radius (pickup) and dest_lat/dest_lon/dest_radius (drop, km)
+    switch to a radius search ranked by the driver's detour; a side given
+    only as a city name is placed with the gazetteer.
+
+    ride_type=car,bike, vehicle_type, min_price, max_price and seats
+    narrow the results (see ride_search.parse_filters).
+
+    Responses carry an ETag (see revisions.py); send it back as
+    If-None-Match to get 304 Not Modified while the results are unchanged.
+    format=columns sends the keys once and each ride as an array.
+    """
     source = request.args.get('source', '').strip().lower()
     destination = request.args.get('destination', '').strip().lower()
     travel_date = request.args.get('travel_date', '')
+    fields_param = request.args.get('fields', '')
+    limit = request.args.get('limit', '')
+    after = request.args.get('after', '')
+    columnar = _columnar()
+    if columnar is None:
+        return jsonify({'success': False, 'message': 'format must be columns or left out'}), 400
+    try:
+        filters = parse_filters(*(request.args.get(name, '') for name in FILTER_ARGS))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    point_args = tuple(request.args.get(name, '') for name in
+                       ('lat', 'lon', 'radius', 'dest_lat', 'dest_lon', 'dest_radius'))
+    if any(point_args[:2] + point_args[3:5]):
+        return _geo_search_rides(source, destination, travel_date, fields_param, limit, point_args,
+                                 columnar, filters)
     
-    conn = get_db_connection()
+    try:
+        etag, payload = _search_payload(source, destination, travel_date, fields_param, limit, after,
+                                        filters, current=_client_has)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return _conditional(etag, payload, columnar)
+
+def _columnar():
+    # True for ?format=columns, False without it, None for anything else
+    return {'': False, 'columns': True}.get(request.args.get('format', ''))
+
+def _client_has(etag):
+    """The If-None-Match tag naming etag, plain or compressed (see wire.py), or None"""
+    return next((tag for tag in wire.etag_variants(etag) if request.if_none_match.contains_weak(tag)), None)
+
+def _conditional(etag, payload, columnar=False):
+    """payload as JSON tagged with etag, or 304 if the client already has it"""
+    held = _client_has(etag)
+    if held:
+        response = Response(status=304)
+        response.set_etag(held)
+    else:
+        response = Response(wire.dumps(payload, columnar), mimetype='application/json')
+        response.set_etag(etag)
+    # Clients may keep the body but must check back before reusing it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _search_payload(source, destination, travel_date, fields_param='', limit='', after='', filters=None,
+                    current=None):
+    """(ETag, results) of a city search exactly as /api/search-rides returns them.
+
+    When current(etag) is true the client already has these results, so
+    the search is skipped and the results are None. Raises ValueError for
+    a bad fields, limit or after value.
+
+    Without search_snapshot, results come through search_cache and may
+    miss another worker's writes for up to its TTL. With it, the snapshot
+    is brought up to date first and the cache is keyed on its revision for
+    the pair, so results are at most max_staleness seconds old whichever
+    worker wrote.
+    """
+    paginated = bool(limit or after)
+    filters = filters or {}
+    generation = search_cache.generation
+    snapshot_etag = ()
+    if search_snapshot:
+        conn = get_db_connection()
+        snapshot_etag = (search_snapshot.etag(conn, source, destination),)
+        if current and current(snapshot_etag[0]):
+            return snapshot_etag[0], None
+    cache_key = search_cache.make_key(source, destination, travel_date, fields_param, limit, after,
+                                      tuple(sorted(filters.items())), *snapshot_etag)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    fields = parse_fields(fields_param)
+    after_key = decode_cursor(after) if after else None
+    limit = int(limit) if limit else 20
+    
+    # Read before the results, so they are never older than their tag
+    if search_snapshot:
+        etag = snapshot_etag[0]
+    else:
+        conn = get_db_connection()
+        etag = revisions.search_etag(conn, source, destination, travel_date)
+    if current and current(etag):
+        return etag, None
     
     try:
-        query = '''
-            SELECT r.*, u.name as driver_name, u.rating, u.total_rides
-            FROM rides r
-            JOIN users u ON r.user_id = u.id
-            WHERE r.status = "active"
-        '''
-        params = []
-        
-        if source:
-            query += ' AND LOWER(r.source_city) LIKE ?'
-            params.append(f'%{source}%')
-        
-        if destination:
-            query += ' AND LOWER(r.destination_city) LIKE ?'
-            params.append(f'%{destination}%')
-        
-        if travel_date:
-            query += ' AND DATE(r.departure_time) = ?'
-            params.append(travel_date)
-        
-        query += ' ORDER BY r.departure_time ASC'
-        
-        rides = conn.execute(query, params).fetchall()
-        
-        # Convert to list of dictionaries
-        rides_list = []
-        for ride in rides:
-            ride_dict = dict(ride)
-            # Add some sample data for demonstration
-            ride_dict['rating'] = ride_dict.get('rating', 4.5)
-            ride_dict['total_rides'] = ride_dict.get('total_rides', random.randint(5, 50))
-            rides_list.append(ride_dict)
-        
-        return jsonify(rides_list)
-        
-    except sqlite3.OperationalError:
-        return jsonify([])
-    finally:
-        conn.close()
+        if paginated:
+            page = search_snapshot.search_page if search_snapshot else search_page
+            rides, next_cursor = page(conn, source, destination, travel_date,
+                                      fields=fields, after=after_key, limit=limit, filters=filters)
+        else:
+            find = search_snapshot.search_rides if search_snapshot else search_rides
+            rides = find(conn, source, destination, travel_date, fields=fields, filters=filters)
+    except (sqlite3.OperationalError, ValueError):
+        rides, next_cursor = [], None
+    
+    # Kept as the rows the cursor returned; see wire.py
+    rides_list = wire.Rows(fields, rides)
+    
+    if paginated:
+        payload = {
+            'success': True,
+            'rides': rides_list,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+    else:
+        payload = rides_list
+    search_cache.put(cache_key, (etag, payload), generation)
+    return etag, payload
+
+def _geo_search_rides(source, destination, travel_date, fields_param, limit, point_args, columnar=False,
+                      filters=None):
+    # Geo results are keyed with empty cities, so any ride posted or booked
+    # on that date invalidates them
+    filters = filters or {}
+    cache_key = (search_cache.make_key('', '', travel_date, fields_param, limit, 'geo', source, destination)
+                 + point_args + (tuple(sorted(filters.items())),))
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return _conditional(*cached, columnar)
+    generation = search_cache.generation
+    
+    try:
+        fields = parse_fields(fields_param)
+        limit = int(limit) if limit else 20
+        origin = parse_point(*point_args[:3])
+        drop = parse_point(*point_args[3:])
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    # The other side may still be a typed city name
+    if origin is None and source:
+        located = city_index.locate(source)
+        origin = located + (DEFAULT_RADIUS_KM,) if located else None
+    if drop is None and destination:
+        located = city_index.locate(destination)
+        drop = located + (DEFAULT_RADIUS_KM,) if located else None
+    
+    conn = get_db_connection()
+    # Every active ride that day, a superset of what the radius can match
+    etag = revisions.search_etag(conn, '', '', travel_date)
+    if _client_has(etag):
+        return _conditional(etag, None)
+    try:
+        rides = geo_search(conn, origin, drop, travel_date, fields=fields, limit=limit, filters=filters)
+    except (sqlite3.OperationalError, ValueError):
+        rides = []
+    payload = {'success': True, 'rides': wire.Rows.from_dicts(rides), 'next_cursor': None, 'has_more': False}
+    search_cache.put(cache_key, (etag, payload), generation)
+    return _conditional(etag, payload, columnar)
+
+@app.route('/api/itineraries')
+def api_itineraries():
+    """Trips of up to three rides when no single ride covers the route.
+
+    source/destination are city names; travel_date (YYYY-MM-DD) or after
+    (YYYY-MM-DDTHH:MM) sets the earliest departure, default now. seats,
+    max_transfers (0-2) and min_connection (minutes) are optional.
+    Returns the earliest-arriving and the cheapest trip; book one with
+    /api/book-rides using its legs' ride ids.
+    """
+    source = city_key(request.args.get('source', ''))
+    destination = city_key(request.args.get('destination', ''))
+    if not source or not destination:
+        return jsonify({'success': False, 'message': 'source and destination are required'}), 400
+    try:
+        seats = int(request.args.get('seats', 1))
+        max_transfers = int(request.args.get('max_transfers', itinerary.MAX_TRANSFERS))
+        min_connection = int(request.args.get('min_connection', itinerary.MIN_CONNECTION_MINUTES))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'seats, max_transfers and min_connection must be numbers'}), 400
+    if seats < 1 or not 0 <= max_transfers <= itinerary.MAX_TRANSFERS or min_connection < 0:
+        return jsonify({'success': False, 'message': 'seats, max_transfers or min_connection out of range'}), 400
+    start = request.args.get('after') or request.args.get('travel_date') or datetime.now().isoformat()
+    start = itinerary.to_minutes(start)
+    if start is None:
+        return jsonify({'success': False, 'message': 'Invalid travel_date/after'}), 400
+    
+    conn = get_db_connection()
+    itineraries.refresh(conn)
+    plans = itineraries.plan(source, destination, start, seats, max_transfers, min_connection,
+                             ride_types={'car', 'bike'})
+    
+    legs = {leg.ride_id for trip in plans.values() if trip for leg in trip['legs']}
+    rides = {}
+    if legs:
+        rides = {row['id']: dict(row) for row in conn.execute(f'''
+            SELECT r.id, r.ride_type, r.source_city, r.destination_city, r.departure_time,
+                   r.arrival_time, r.vehicle_type, r.price_per_unit, r.available_capacity,
+                   u.name AS driver_name
+            FROM rides r JOIN users u ON r.user_id = u.id
+            WHERE r.id IN ({', '.join('?' * len(legs))})
+        ''', list(legs))}
+    
+    def describe(trip):
+        if trip is None:
+            return None
+        return {
+            'transfers': len(trip['legs']) - 1,
+            'depart': itinerary.from_minutes(trip['depart']),
+            'arrive': itinerary.from_minutes(trip['arrive']),
+            'total_amount': trip['total_amount'],
+            'legs': [dict(rides.get(leg.ride_id, {'id': leg.ride_id}),
+                          estimated_arrival=itinerary.from_minutes(leg.arrive))
+                     for leg in trip['legs']],
+        }
+    
+    return jsonify({
+        'success': True,
+        'earliest': describe(plans['earliest']),
+        'cheapest': describe(plans['cheapest'])
+    })
 
 @app.route('/api/book-ride', methods=['POST'])
 def api_book_ride():
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Please login first'})
     
-    data = request.get_json()
-    ride_id = data['ride_id']
-    quantity = data['quantity']
+    data = request.get_json(silent=True) or {}
+    ride_id = data.get('ride_id')
+    quantity = data.get('quantity')
+    # Retries of the same request send the same key and get the same booking
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
     
     try:
-        conn = get_db_connection()
-        
-        # Use a transaction to avoid race conditions on available_capacity
-        cursor = conn.cursor()
-        try:
-            cursor.execute('BEGIN IMMEDIATE')
-            ride = cursor.execute('SELECT * FROM rides WHERE id = ?', (ride_id,)).fetchone()
-            if not ride:
-                conn.rollback()
-                return jsonify({'success': False, 'message': 'Ride not found'})
-
-            if ride['available_capacity'] < quantity:
-                conn.rollback()
-                return jsonify({'success': False, 'message': 'Not enough capacity available'})
-
-            total_amount = ride['price_per_unit'] * quantity
+        result = reservations.book(get_db_connection(), ride_id, session['user_id'], quantity,
+                                   idempotency_key, writer=booking_writer)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+    
+    ride = result['ride']
+    search_cache.invalidate_ride(ride['source_city'], ride['destination_city'], ride['departure_time'])
+    if search_snapshot:
+        search_snapshot.changed()
+    itineraries.ride_changed(get_db_connection(), [ride_id])
+    if invoice_workers:
+        invoice_workers.wake()
+    return jsonify({
+        'success': True,
+        'message': 'Ride booked successfully!',
+        'total_amount': result['total_amount'],
+        'booking_id': result['booking_id']
+    })
 
-            cursor.execute('''
-                INSERT INTO bookings (ride_id, passenger_id, quantity, total_amount)
-                VALUES (?, ?, ?, ?)
-            ''', (ride_id, session['user_id'], quantity, total_amount))
 
-            cursor.execute('''
-                UPDATE rides SET available_capacity = available_capacity - ?
-                WHERE id = ?
-            ''', (quantity, ride_id))
+@app.route('/api/book-rides', methods=['POST'])
+def api_book_rides():
+    """Book several rides at once: all of them or none.
 
-            conn.commit()
-            booking_id = cursor.lastrowid
-            return jsonify({
-                'success': True,
-                'message': 'Ride booked successfully!',
-                'total_amount': total_amount,
-                'booking_id': booking_id
-            })
-        except Exception as e:
-            conn.rollback()
-            return jsonify({'success': False, 'message': str(e)})
-        finally:
-            conn.close()
-        
+    Body: {"items": [{"ride_id": 1, "quantity": 2}, ...]}. Used for
+    multi-leg trips and bulk logistics orders.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    data = request.get_json() or {}
+    items = data.get('items')
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    
+    try:
+        result = reservations.book_many(get_db_connection(), session['user_id'], items,
+                                        idempotency_key, writer=booking_writer)
+    except reservations.ReservationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e),
+            'failures': getattr(e, 'failures', [])
+        })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+    
+    for ride in result['rides']:
+        search_cache.invalidate_ride(ride['source_city'], ride['destination_city'], ride['departure_time'])
+    if search_snapshot:
+        search_snapshot.changed()
+    itineraries.ride_changed(get_db_connection(), [item['ride_id'] for item in items])
+    if invoice_workers:
+        invoice_workers.wake()
+    return jsonify({
+        'success': True,
+        'message': f"{len(result['bookings'])} rides booked successfully!",
+        'bookings': result['bookings'],
+        'total_amount': result['total_amount']
+    })
 
 
 @app.route('/api/ride/<int:ride_id>')
 def api_get_ride(ride_id):
+    """One ride with its driver; answers If-None-Match with 304 (see revisions.py)"""
     conn = get_db_connection()
     try:
+        etag = revisions.ride_etag(conn, ride_id)
+        if etag is None:
+            return jsonify({'success': False, 'message': 'Ride not found'}), 404
+        if _client_has(etag):
+            return _conditional(etag, None)
         ride = conn.execute('SELECT r.*, u.name as driver_name, u.rating, u.total_rides FROM rides r JOIN users u ON r.user_id = u.id WHERE r.id = ?', (ride_id,)).fetchone()
         if not ride:
             return jsonify({'success': False, 'message': 'Ride not found'}), 404
         ride_dict = dict(ride)
         ride_dict['rating'] = ride_dict.get('rating', 4.5)
         ride_dict['total_rides'] = ride_dict.get('total_rides', random.randint(5, 50))
-        return jsonify({'success': True, 'ride': ride_dict})
+        return _conditional(etag, {'success': True, 'ride': ride_dict})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        conn.close()
+
+
+def _tracked_booking(conn, booking_id, user_id):
+    """The booking if user_id is its passenger or the ride's driver"""
+    return conn.execute('''
+        SELECT b.id, b.ride_id, b.status, b.total_amount, r.ride_type,
+               r.source_city, r.destination_city, r.user_id AS driver_id, u.name AS driver_name
+        FROM bookings b
+        JOIN rides r ON b.ride_id = r.id
+        JOIN users u ON r.user_id = u.id
+        WHERE b.id = ? AND (b.passenger_id = ? OR r.user_id = ?)
+    ''', (booking_id, user_id, user_id)).fetchone()
+
+
+@app.route('/track/<int:booking_id>')
+def track_booking(booking_id):
+    if 'user_id' not in session:
+        flash('Please login to track your ride', 'warning')
+        return redirect(url_for('login'))
+    booking = _tracked_booking(get_db_connection(), booking_id, session['user_id'])
+    if not booking:
+        flash('Booking not found', 'error')
+        return redirect(url_for('my_bookings'))
+    return render_template('tracking.html', booking={
+        'id': booking['id'],
+        'ride_id': booking['ride_id'],
+        'service_type': (booking['ride_type'] or '').title(),
+        'pickup_address': booking['source_city'],
+        'dropoff_address': booking['destination_city'],
+        'status': booking['status'],
+        'driver_name': booking['driver_name'],
+        'estimated_fare': booking['total_amount'],
+    })
+
+
+@app.route('/api/ride/<int:ride_id>/location', methods=['POST'])
+def api_post_location(ride_id):
+    """Driver app reports its position; pushed to everyone tracking the ride"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Please login first'}), 401
+    ride = get_db_connection().execute(
+        'SELECT user_id FROM rides WHERE id = ?', (ride_id,)
+    ).fetchone()
+    if not ride or ride['user_id'] != session['user_id']:
+        return jsonify({'success': False, 'message': 'Only the driver can share this ride\'s location'}), 403
+    try:
+        point = parse_location(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    point['at'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    listeners = location_hub.publish(ride_id, point)
+    return jsonify({'success': True, 'listeners': listeners})
+
+
+@app.route('/api/booking/<int:booking_id>/location')
+def api_booking_location(booking_id):
+    """Latest known driver position, for clients without EventSource"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Please login first'}), 401
+    booking = _tracked_booking(get_db_connection(), booking_id, session['user_id'])
+    if not booking:
+        return jsonify({'success': False, 'message': 'Booking not found'}), 404
+    point, status = location_hub.latest(booking['ride_id'])
+    return jsonify({
+        'success': True,
+        'current_lat': point['lat'] if point else None,
+        'current_lng': point['lng'] if point else None,
+        'at': point.get('at') if point else None,
+        'status': status or booking['status'],
+    })
+
+
+@app.route('/api/booking/<int:booking_id>/location/stream')
+def api_booking_location_stream(booking_id):
+    """Server-Sent Events stream of the driver's position for one booking"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Please login first'}), 401
+    booking = _tracked_booking(get_db_connection(), booking_id, session['user_id'])
+    if not booking:
+        return jsonify({'success': False, 'message': 'Booking not found'}), 404
+    # The generator runs after this request's DB connection is released;
+    # its lane slot is held until the stream closes
+    response = Response(location_hub.stream(booking['ride_id'], max_seconds=STREAM_SECONDS),
+                        mimetype='text/event-stream', headers={
+                            'Cache-Control': 'no-cache',
+                            'X-Accel-Buffering': 'no',
+                        })
+    held = g.pop('lane', None)
+    if held:
+        response.call_on_close(lambda: request_lanes.release(*held))
+    return response
+
+
+@app.route('/api/db-stats')
+def api_db_stats():
+    """Connection pool and search cache counters for this worker (admin only)."""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return jsonify({
+        'success': True,
+        'stats': database.pool_stats(),
+        'search_cache': search_cache.stats(),
+        'booking_writer': booking_writer.stats() if booking_writer else None,
+        'live_location': location_hub.stats(),
+        'sos': sos_dispatcher.stats(),
+        'lanes': request_lanes.stats(),
+        'itineraries': itineraries.stats(),
+        'outbound': outbound.shared.stats(),
+        'ride_sweeper': ride_sweeper.stats(),
+        'compression': compressor.stats(),
+        'search_snapshot': search_snapshot.stats() if search_snapshot else None,
+        'invoices': invoice_workers.stats() if invoice_workers else None,
+        'schema': migrations.status(get_db_connection())
+    })
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint for this worker.
+
+    Answered for admins, and for scrapers sending METRICS_TOKEN as a
+    bearer token when it is set. The client address is not trusted: behind
+    a local proxy every request comes from loopback, and with PROXY_HOPS
+    it is whatever the proxy forwarded.
+    """
+    token = os.environ.get('METRICS_TOKEN')
+    allowed = session.get('user_type') == 'admin' or bool(
+        token and hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                       f'Bearer {token}'.encode()))
+    if not allowed:
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/admin/instrumentation', methods=['GET', 'POST'])
+def api_instrumentation():
+    """Show or change the slow-query log threshold and the sampling profiler.
+
+    POST {"slow_query_ms": 50, "profiler": true, "profile_interval_ms": 5,
+    "reset_profile": true}; every field is optional. Applies to this
+    worker only.
+    """
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            if 'slow_query_ms' in data:
+                metrics.slow_query_ms = max(0.0, float(data['slow_query_ms'] or 0))
+            interval = data.get('profile_interval_ms')
+            interval = float(interval) / 1000 if interval is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'slow_query_ms and profile_interval_ms must be numbers'}), 400
+        if interval is not None and not 0.001 <= interval <= 1:
+            return jsonify({'success': False, 'message': 'profile_interval_ms must be between 1 and 1000'}), 400
+        if data.get('reset_profile'):
+            metrics.profiler.reset()
+        if data.get('profiler') is True:
+            metrics.profiler.start(interval)
+        elif data.get('profiler') is False:
+            metrics.profiler.stop()
+        elif interval is not None:
+            metrics.profiler.interval = interval
+    return jsonify({
+        'success': True,
+        'slow_query_ms': metrics.slow_query_ms,
+        'profiler': metrics.profiler.stats()
+    })
+
+
+@app.route('/api/admin/profile')
+def api_profile():
+    """Sampled stacks in collapsed format (flamegraph.pl / speedscope)"""
+    if session.get('user_type') != 'admin':
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+    return Response(metrics.profiler.collapsed(), mimetype='text/plain')
 
 
 @app.route('/api/city-suggest')
 def api_city_suggest():
-    """Proxy to Teleport cities API to avoid browser CORS/network blocks."""
+    """City suggestions from the bundled gazetteer (see gazetteer.py)."""
     query = request.args.get('q', '').strip()
     if not query or len(query) < 2:
         return jsonify({'success': True, 'suggestions': []})
 
-    try:
-        # Use standard library to avoid adding 'requests' dependency
-        from urllib import request as urlreq, parse as urlparse
-        import json
-
-        base = 'https://api.teleport.org/api/cities/'
-        params = urlparse.urlencode({'search': query, 'limit': 10})
-        full = f"{base}?{params}"
-        with urlreq.urlopen(full, timeout=5) as resp:
-            if resp.status != 200:
-                return jsonify({'success': False, 'message': f'Teleport error {resp.status}'}), 502
-            raw = resp.read().decode('utf-8')
-            j = json.loads(raw)
-
-        results = (j.get('_embedded') or {}).get('city:search-results', [])
-        names = [item.get('matching_full_name') for item in results if item.get('matching_full_name')]
-        # deduplicate while preserving order
-        seen = set(); uniq = []
-        for n in names:
-            key = n.lower()
-            if key not in seen:
-                seen.add(key)
-                uniq.append(n)
-        return jsonify({'success': True, 'suggestions': uniq})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
+    if city_index.volumes_stale():
+        try:
+            city_index.refresh_volumes(get_db_connection())
+        except sqlite3.OperationalError as e:
+            print(f"City volume refresh failed: {e}")
 
-@app.route('/sos', methods=['POST'])
+    suggestions = city_index.suggest(query, limit=10)
+    if not suggestions:
+        suggestions = teleport_fallback.suggest(query)
+    return jsonify({'success': True, 'suggestions': suggestions})
 
+@app.route('/sos', methods=['POST'])
 def sos_emergency():
+    """Persist the alert and return; notification happens in sos_dispatch.py"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Please login first'})
     
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     
     try:
-        conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO sos_alerts (user_id, latitude, longitude, address)
-            VALUES (?, ?, ?, ?)
-        ''', (
+        alert_id, priority = sos_dispatcher.enqueue(
+            get_db_connection(),
             session['user_id'],
             data.get('latitude'),
             data.get('longitude'),
             data.get('address', '')
-        ))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'message': 'SOS alert sent! Emergency services have been notified.'
-        })
-        
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+    
+    return jsonify({
+        'success': True,
+        'alert_id': alert_id,
+        'priority': priority,
+        'message': 'SOS alert sent! Emergency services have been notified.'
+    })
 
 if __name__ == '__main__':
     # Create necessary folders
     os.makedirs('static/uploads', exist_ok=True)
-    os.makedirs('invoices', exist_ok=True)
+    os.makedirs(invoices.INVOICE_DIR, exist_ok=True)
     
-    # Check and initialize database
-    check_database()
+    # Create or migrate the database (see migrations.py)
+    init_db()
     
     print("🚀 Starting YatraSetu application...")
     print("🌐 Server running at: http://localhost:5000")
@@ -0,0 +1,250 @@
+"""Do bookings and SOS alerts get through a flood of chat and suggestions?
+
+    python bench/admission_flood.py --flooders 48 --seconds 5
+
+Serves the app from a separate process with a fixed pool of
+WORKER_THREADS=8 threads, as gunicorn's gthread worker would, on a
+scratch database with synthetic rides (bench/synthetic.py) and
+RESERVED_LANES=2. While flood processes send
+/api/chat and /api/city-suggest as fast as they can, a few users book
+seats and send SOS alerts at a human pace. Phases: no flood, a flood
+from one address, and a flood from one address per thread (127.0.0.x),
+each with the limits of lanes.py and again with ADMISSION_LIMITS=0,
+which leaves only the pool and the reserve. Prints status counts and
+latency for both sides and what the gate shed, as JSON.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CITIES = ('pune', 'mumbai', 'delhi', 'nashik', 'nagpur', 'bengaluru')
+FLOOD_THREADS = 12
+
+
+def pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 2)
+
+
+def summary(samples):
+    times = [t for _, t in samples]
+    return {'requests': len(samples), 'status': dict(Counter(s for s, _ in samples)),
+            'p50_ms': pct(times, 0.5), 'p95_ms': pct(times, 0.95), 'max_ms': pct(times, 1.0)}
+
+
+def request(port, method, path, body=None, cookie=None, address='127.0.0.1'):
+    """(status, seconds) of one request on a new connection"""
+    headers = {'Content-Type': 'application/json'}
+    if cookie:
+        headers['Cookie'] = cookie
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30, source_address=(address, 0))
+    try:
+        conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def lane_stats(port, cookie):
+    """request_lanes.stats() of the server, from /api/db-stats"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', '/api/db-stats', headers={'Cookie': cookie})
+        return json.loads(conn.getresponse().read())['lanes']
+    finally:
+        conn.close()
+
+
+def serve(port, env):
+    """Serve the app from WORKER_THREADS threads fed by one queue, as gunicorn's gthread worker does"""
+    os.environ.update(env)
+    from concurrent.futures import ThreadPoolExecutor
+
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+    import app as yatrasetu
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    class PooledServer(BaseWSGIServer):
+        pool = ThreadPoolExecutor(int(env['WORKER_THREADS']))
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self.handle_pooled, request, client_address)
+
+        def handle_pooled(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledServer('127.0.0.1', port, yatrasetu.app, handler=QuietHandler).serve_forever()
+
+
+def flood(port, first, seconds, spread, results):
+    stop = time.monotonic() + seconds
+    samples = []
+    lock = threading.Lock()
+
+    def flooder(n):
+        address = f'127.0.{n // 250 + 1}.{n % 250 + 1}' if spread else '127.0.0.1'
+        i = 0
+        while time.monotonic() < stop:
+            if n % 2:
+                # Different routes and dates, so most miss the search cache
+                message = f'rides from {CITIES[i % 6]} to {CITIES[(i + n) % 5 + 1]} on 2030-01-{i % 28 + 1:02d}'
+                sample = request(port, 'POST', '/api/chat', {'message': message}, address=address)
+            else:
+                sample = request(port, 'GET', f'/api/city-suggest?q={"punmdel"[i % 5:i % 5 + 2]}',
+                                 address=address)
+            with lock:
+                samples.append(sample)
+            i += 1
+
+    threads = [threading.Thread(target=flooder, args=(first + n,)) for n in range(FLOOD_THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put(samples)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(port, cookies, ride_id, args, flooding, spread):
+    before = lane_stats(port, cookies['admin'])
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    floods = [context.Process(target=flood, args=(port, n * FLOOD_THREADS, args.seconds, spread, results))
+              for n in range(args.flooders // FLOOD_THREADS if flooding else 0)]
+    for process in floods:
+        process.start()
+    stop = time.monotonic() + args.seconds
+    urgent = {'booking': [], 'sos': []}
+
+    def booker(cookie):
+        while time.monotonic() < stop:
+            urgent['booking'].append(request(port, 'POST', '/api/book-ride',
+                                             {'ride_id': ride_id, 'quantity': 1}, cookie))
+            time.sleep(args.pace)
+
+    def sos(cookie):
+        while time.monotonic() < stop:
+            urgent['sos'].append(request(port, 'POST', '/sos', {'latitude': 18.52, 'longitude': 73.85}, cookie))
+            time.sleep(args.pace)
+
+    threads = ([threading.Thread(target=booker, args=(cookie,)) for cookie in cookies['bookers']]
+               + [threading.Thread(target=sos, args=(cookies['sos'],))])
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    flooded = [sample for _ in floods for sample in results.get()]
+    for process in floods:
+        process.join()
+    after = lane_stats(port, cookies['admin'])
+    shed = {}
+    for lane, stats in after['lanes'].items():
+        for reason, count in stats['shed'].items():
+            count -= before['lanes'][lane]['shed'].get(reason, 0)
+            if count:
+                shed[f'{lane}:{reason}'] = count
+    return {
+        'flood': summary(flooded),
+        'flood_429_ms': {'p50': pct([t for s, t in flooded if s == 429], 0.5),
+                         'p95': pct([t for s, t in flooded if s == 429], 0.95)},
+        'booking': summary(urgent['booking']),
+        'sos': summary(urgent['sos']),
+        'shed': shed,
+        'reserved_used': after['reserved_used'] - before['reserved_used'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rides', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--flooders', type=int, default=48, help='flood threads, %d per process' % FLOOD_THREADS)
+    parser.add_argument('--bookers', type=int, default=3)
+    parser.add_argument('--pace', type=float, default=1.0, help='seconds between one user\'s requests')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    env = {'YATRASETU_DB': os.path.join(scratch, 'bench.db'), 'RIDE_SWEEP_SECONDS': '0',
+           'WORKER_THREADS': '8', 'RESERVED_LANES': '2'}
+    os.environ.update(env)
+
+    import app as yatrasetu
+    import database
+    import synthetic
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    synthetic.generate(conn, args.rides)
+    ride_id = conn.execute('''
+        INSERT INTO rides (user_id, ride_type, source_city, destination_city, departure_time,
+                           vehicle_type, vehicle_number, available_capacity, price_per_unit,
+                           contact_number, source_key, destination_key)
+        VALUES (1, 'logistics', 'Pune', 'Mumbai', '2030-01-01 09:00:00', 'Tempo',
+                'MH14EF9012', 100000, 50, '9876543214', 'pune', 'mumbai')
+    ''').lastrowid
+    conn.commit()
+    # Signed session cookies, as /login would set them
+    signer = yatrasetu.app.session_interface.get_signing_serializer(yatrasetu.app)
+    cookies = {
+        'sos': f"session={signer.dumps({'user_id': 2})}",
+        'bookers': [f"session={signer.dumps({'user_id': 3 + n})}" for n in range(args.bookers)],
+        'admin': f"session={signer.dumps({'user_type': 'admin'})}",
+    }
+
+    phases = {}
+    for limits in ('1', '0'):
+        port = free_port()
+        server = multiprocessing.get_context('spawn').Process(
+            target=serve, args=(port, dict(env, ADMISSION_LIMITS=limits)), daemon=True)
+        server.start()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise SystemExit('❌ server did not start')
+                time.sleep(0.1)
+        suffix = '' if limits == '1' else '_no_limits'
+        if limits == '1':
+            phases['no_flood'] = run(port, cookies, ride_id, args, flooding=False, spread=False)
+        phases['flood_one_address' + suffix] = run(port, cookies, ride_id, args, flooding=True, spread=False)
+        phases['flood_many_addresses' + suffix] = run(port, cookies, ride_id, args, flooding=True, spread=True)
+        server.terminate()
+        server.join()
+    print(json.dumps({'rides': args.rides, 'flooders': args.flooders, 'phases': phases}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Booking contention benchmark: N threads hammering one ride.
+
+    python bench/booking_contention.py --threads 16 --capacity 2000
+    python bench/booking_contention.py --group-commit
+
+Drives the real Flask app in-process against a scratch database. Every
+request is sent twice with the same Idempotency-Key to simulate client
+retries. Prints a JSON summary and exits non-zero if capacity went
+negative, seats were double-booked or a retry created a second booking.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--capacity', type=int, default=2000)
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--group-commit', action='store_true')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+    os.environ['BOOKING_GROUP_COMMIT'] = '1' if args.group_commit else '0'
+    # Each thread books far faster than a person would; see lanes.py
+    os.environ['ADMISSION_LIMITS'] = '0'
+
+    import app as yatrasetu
+    import database
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    ride_id = conn.execute('''
+        INSERT INTO rides (user_id, ride_type, source_city, destination_city, departure_time,
+                           vehicle_type, vehicle_number, available_capacity, price_per_unit,
+                           contact_number, source_key, destination_key)
+        VALUES (1, 'logistics', 'Pune', 'Mumbai', '2030-01-01 09:00:00', 'Tempo',
+                'MH14EF9012', ?, 50, '9876543214', 'pune', 'mumbai')
+    ''', (args.capacity,)).lastrowid
+    conn.commit()
+
+    latencies = []
+    lock = threading.Lock()
+    start_gate = threading.Barrier(args.threads)
+
+    def worker(passenger_id):
+        client = yatrasetu.app.test_client()
+        with client.session_transaction() as s:
+            s['user_id'] = passenger_id
+        mine = []
+        start_gate.wait()
+        while True:
+            key = uuid.uuid4().hex
+            started = time.perf_counter()
+            first = client.post('/api/book-ride', json={'ride_id': ride_id, 'quantity': args.quantity},
+                                headers={'Idempotency-Key': key}).get_json()
+            mine.append(time.perf_counter() - started)
+            if not first['success']:
+                break
+            retry = client.post('/api/book-ride', json={'ride_id': ride_id, 'quantity': args.quantity},
+                                headers={'Idempotency-Key': key}).get_json()
+            assert retry['booking_id'] == first['booking_id'], (first, retry)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(2 + i % 5,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    remaining = conn.execute('SELECT available_capacity FROM rides WHERE id = ?', (ride_id,)).fetchone()[0]
+    booked, bookings = conn.execute(
+        'SELECT COALESCE(SUM(quantity), 0), COUNT(*) FROM bookings WHERE ride_id = ?', (ride_id,)
+    ).fetchone()
+    duplicates = conn.execute('''
+        SELECT COUNT(*) FROM (SELECT idempotency_key FROM bookings WHERE ride_id = ?
+                              GROUP BY passenger_id, idempotency_key HAVING COUNT(*) > 1)
+    ''', (ride_id,)).fetchone()[0]
+
+    latencies.sort()
+    pct = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+    result = {
+        'benchmark': 'booking_contention',
+        'group_commit': args.group_commit,
+        'threads': args.threads,
+        'capacity': args.capacity,
+        'bookings': bookings,
+        'seconds': round(elapsed, 3),
+        'bookings_per_second': round(bookings / elapsed, 1),
+        'latency_ms': {'p50': pct(0.50), 'p95': pct(0.95), 'p99': pct(0.99),
+                       'mean': round(statistics.mean(latencies) * 1000, 3)},
+        'remaining_capacity': remaining,
+        'seats_booked': booked,
+        'duplicate_idempotent_bookings': duplicates,
+        'writer': yatrasetu.booking_writer.stats() if yatrasetu.booking_writer else None,
+    }
+    print(json.dumps(result, indent=2))
+
+    ok = remaining >= 0 and booked + remaining == args.capacity and duplicates == 0
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Radius search vs. city-name search over a large ride table.
+
+    python bench/geo_search.py --rides 100000 --queries 300
+
+Fills a scratch database with active rides between gazetteer cities
+(start points jittered a few km around each city) and times two ways of
+finding rides out of Sangamner: the text path (source=sangamner) and a
+25 km radius search around a village outside the town, which the text
+path cannot answer at all. Prints a JSON summary of both.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Ashvi Budruk, about 15 km east of Sangamner
+VILLAGE = (19.53, 74.35)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rides', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--radius', type=float, default=25.0)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+
+    import app as yatrasetu
+    import database
+    from geo import cell_id
+    from ride_import import INSERT_RIDE
+    from ride_search import city_key, geo_search, search_rides
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    cities = [(name, point) for name, _, _, point in yatrasetu.city_index._base if point]
+    rng = random.Random(13)
+
+    by_name = dict(cities)
+
+    def ride(source=None):
+        destination, (dlat, dlng) = rng.choice(cities)
+        if source is None:
+            source = rng.choice(cities)[0]
+        slat, slng = by_name[source]
+        slat += rng.uniform(-0.05, 0.05)
+        slng += rng.uniform(-0.05, 0.05)
+        departure = f'2030-01-{rng.randint(1, 28):02d} {rng.randint(5, 22):02d}:00:00'
+        return (1, 'car', source, destination, departure, None, 'Sedan', 'MH12AB1234', 4, 150,
+                '', '9876543210', 'hindi', city_key(source), city_key(destination),
+                slat, slng, dlat, dlng, cell_id(slat, slng), cell_id(dlat, dlng))
+
+    started = time.perf_counter()
+    # Every 200th ride leaves Sangamner so that corridor is never empty
+    rows = [ride('Sangamner' if i % 200 == 0 else None) for i in range(args.rides)]
+    conn.executemany(INSERT_RIDE, rows)
+    conn.commit()
+    conn.execute('ANALYZE')
+    load_seconds = time.perf_counter() - started
+
+    def timed(search):
+        times, found = [], 0
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            found = len(search())
+            times.append(time.perf_counter() - t)
+        times.sort()
+        pct = lambda p: round(times[min(len(times) - 1, int(len(times) * p))] * 1000, 3)
+        return {'matches': found, 'p50_ms': pct(0.50), 'p95_ms': pct(0.95), 'p99_ms': pct(0.99),
+                'mean_ms': round(statistics.mean(times) * 1000, 3)}
+
+    origin = VILLAGE + (args.radius,)
+    result = {
+        'benchmark': 'geo_search',
+        'rides': args.rides,
+        'queries': args.queries,
+        'load_seconds': round(load_seconds, 2),
+        'text_source_sangamner': timed(lambda: search_rides(conn, 'sangamner', limit=20)),
+        'text_source_village': timed(lambda: search_rides(conn, 'ashvi budruk', limit=20)),
+        'geo_radius_village': timed(lambda: geo_search(conn, origin, limit=20)),
+        'geo_radius_village_to_pune': timed(
+            lambda: geo_search(conn, origin, (18.5204, 73.8567, args.radius), limit=20)),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Invoice rendering: one template load per booking or per batch, and across processes.
+
+    python bench/invoice_render.py --bookings 20000 --processes 1,2,4
+
+Fills a scratch database with synthetic rides and bookings
+(bench/synthetic.py), renders a sample of invoices loading the template
+for every booking and then in batches of invoices.BATCH_SIZE with one
+load, and regenerates the whole month (invoices.regenerate_month) with
+each number of processes into a fresh directory. Prints a JSON summary.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bookings', type=int, default=20000)
+    parser.add_argument('--sample', type=int, default=1000)
+    parser.add_argument('--processes', default='1,2,4')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+
+    import database
+    import invoices
+    import synthetic
+
+    database.init_db()
+    conn = database.connect()
+    synthetic.generate(conn, max(args.bookings, 1000), bookings=args.bookings)
+    month = conn.execute('SELECT substr(MAX(booked_at), 1, 7) FROM bookings').fetchone()[0]
+    sample = invoices.month_bookings(conn, month)[:args.sample]
+
+    started = time.perf_counter()
+    for booking_id in sample:
+        invoices.Renderer(os.path.join(scratch, 'single')).render_batch(conn, [booking_id])
+    single = time.perf_counter() - started
+
+    renderer = invoices.Renderer(os.path.join(scratch, 'batched'))
+    started = time.perf_counter()
+    for i in range(0, len(sample), invoices.BATCH_SIZE):
+        renderer.render_batch(conn, sample[i:i + invoices.BATCH_SIZE])
+    batched = time.perf_counter() - started
+
+    months = {}
+    for processes in map(int, args.processes.split(',')):
+        started = time.perf_counter()
+        done = invoices.regenerate_month(conn, month, processes, os.path.join(scratch, f'month-{processes}'))
+        seconds = time.perf_counter() - started
+        months[processes] = dict(done, seconds=round(seconds, 2),
+                                 invoices_per_second=round(done['rendered'] / seconds))
+
+    print(json.dumps({
+        'bookings': args.bookings, 'cpus': os.cpu_count(),
+        'per_invoice_ms': {
+            'template_per_booking': round(single / len(sample) * 1000, 3),
+            'template_per_batch': round(batched / len(sample) * 1000, 3),
+        },
+        'regenerate_month': months,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
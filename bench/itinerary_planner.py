@@ -0,0 +1,93 @@
+"""Multi-leg planner latency over a large ride table.
+
+    python bench/itinerary_planner.py --rides 50000 --cities 80 --queries 500
+
+Fills a scratch database with active rides between the most populous
+gazetteer cities over 30 days, loads the connection index and plans
+trips between random city pairs. Prints a JSON summary with the reload
+time, the cost of one incremental update and planning latencies.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rides', type=int, default=50000)
+    parser.add_argument('--cities', type=int, default=80)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+
+    import app as yatrasetu
+    import database
+    import itinerary
+    from geo import cell_id
+    from ride_import import INSERT_RIDE
+    from ride_search import city_key
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    cities = [(name, point) for name, _, _, point in yatrasetu.city_index._base if point][:args.cities]
+    rng = random.Random(14)
+
+    def ride():
+        (source, (slat, slng)), (destination, (dlat, dlng)) = rng.sample(cities, 2)
+        departure = f'2030-01-{rng.randint(1, 30):02d} {rng.randint(0, 23):02d}:{rng.choice(("00", "30"))}'
+        return ('car', source, destination, departure, None, 'Sedan', 'MH12AB1234',
+                rng.randint(1, 4), rng.randint(50, 900), '', '9876543210', 'hindi',
+                city_key(source), city_key(destination),
+                slat, slng, dlat, dlng, cell_id(slat, slng), cell_id(dlat, dlng))
+
+    conn.executemany(INSERT_RIDE, [(1,) + ride() for _ in range(args.rides)])
+    conn.commit()
+
+    index = itinerary.ConnectionIndex()
+    started = time.perf_counter()
+    index.refresh(conn)
+    reload_ms = (time.perf_counter() - started) * 1000
+
+    ride_id = conn.execute('SELECT MAX(id) FROM rides').fetchone()[0]
+    started = time.perf_counter()
+    index.ride_changed(conn, [ride_id])
+    update_ms = (time.perf_counter() - started) * 1000
+
+    times, found, transfers = [], 0, []
+    for _ in range(args.queries):
+        (source, _), (destination, _) = rng.sample(cities, 2)
+        start = itinerary.to_minutes(f'2030-01-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00')
+        t = time.perf_counter()
+        plans = index.plan(city_key(source), city_key(destination), start)
+        times.append(time.perf_counter() - t)
+        if plans['earliest']:
+            found += 1
+            transfers.append(len(plans['earliest']['legs']) - 1)
+    times.sort()
+    pct = lambda p: round(times[min(len(times) - 1, int(len(times) * p))] * 1000, 3)
+    print(json.dumps({
+        'benchmark': 'itinerary_planner',
+        'rides': args.rides,
+        'cities': len(cities),
+        'connections': len(index),
+        'reload_ms': round(reload_ms, 1),
+        'ride_changed_ms': round(update_ms, 3),
+        'queries': args.queries,
+        'trips_found': found,
+        'transfers': {n: transfers.count(n) for n in sorted(set(transfers))},
+        'plan_ms': {'p50': pct(0.50), 'p95': pct(0.95), 'p99': pct(0.99),
+                    'mean': round(statistics.mean(times) * 1000, 3)},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
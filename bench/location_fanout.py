@@ -0,0 +1,130 @@
+"""Live location fan-out load test: one driver, many SSE subscribers.
+
+    python bench/location_fanout.py --subscribers 500 --updates 50 --rate 10
+
+Drives the real Flask app in-process against a scratch database. Every
+subscriber opens /api/booking/<id>/location/stream and reads frames
+until the driver's last update arrives. Prints a JSON summary with the
+publish-to-receive latency and exits non-zero if any subscriber missed
+the final position.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=500)
+    parser.add_argument('--updates', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=10, help='driver updates per second')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+    threading.stack_size(256 * 1024)
+
+    import app as yatrasetu
+    import database
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    ride_id = conn.execute('''
+        INSERT INTO rides (user_id, ride_type, source_city, destination_city, departure_time,
+                           vehicle_type, vehicle_number, available_capacity, price_per_unit,
+                           contact_number, source_key, destination_key)
+        VALUES (1, 'car', 'Pune', 'Mumbai', '2030-01-01 09:00:00', 'Sedan',
+                'MH12AB1234', 100000, 50, '9876543210', 'pune', 'mumbai')
+    ''').lastrowid
+    booking_id = conn.execute('''
+        INSERT INTO bookings (ride_id, passenger_id, quantity, total_amount) VALUES (?, 2, 1, 50)
+    ''', (ride_id,)).lastrowid
+    conn.commit()
+
+    sent_at = {}
+    latencies = []
+    received_final = []
+    frames = []
+    lock = threading.Lock()
+    ready = threading.Barrier(args.subscribers + 1)
+
+    def subscriber():
+        client = yatrasetu.app.test_client()
+        with client.session_transaction() as s:
+            s['user_id'] = 2
+        response = client.get(f'/api/booking/{booking_id}/location/stream', buffered=False)
+        chunks = iter(response.response)
+        next(chunks), next(chunks)  # retry hint and trail: now subscribed
+        mine, count, got_final = [], 0, False
+        ready.wait()
+        try:
+            for chunk in chunks:
+                now = time.perf_counter()
+                text = chunk.decode() if isinstance(chunk, bytes) else chunk
+                if not text.startswith('event: location'):
+                    continue
+                count += 1
+                seq = json.loads(text.split('data: ', 1)[1])['seq']
+                mine.append(now - sent_at[seq])
+                if seq == args.updates:
+                    got_final = True
+                    break
+        finally:
+            response.close()
+        with lock:
+            latencies.extend(mine)
+            frames.append(count)
+            received_final.append(got_final)
+
+    threads = [threading.Thread(target=subscriber, daemon=True) for _ in range(args.subscribers)]
+    for t in threads:
+        t.start()
+    ready.wait()
+
+    driver = yatrasetu.app.test_client()
+    with driver.session_transaction() as s:
+        s['user_id'] = 1
+    post_times = []
+    started = time.perf_counter()
+    for i in range(1, args.updates + 1):
+        sent_at[i] = time.perf_counter()
+        reply = driver.post(f'/api/ride/{ride_id}/location',
+                            json={'lat': 18.52 + i * 1e-4, 'lng': 73.85 + i * 1e-4}).get_json()
+        post_times.append(time.perf_counter() - sent_at[i])
+        assert reply['success'], reply
+        time.sleep(max(0.0, started + i / args.rate - time.perf_counter()))
+    for t in threads:
+        t.join(timeout=30)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    post_times.sort()
+    pct = lambda values, p: round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+    result = {
+        'benchmark': 'location_fanout',
+        'subscribers': args.subscribers,
+        'updates': args.updates,
+        'seconds': round(elapsed, 3),
+        'frames_delivered': sum(frames),
+        'frames_per_second': round(sum(frames) / elapsed, 1),
+        'coalesced_updates': args.subscribers * args.updates - sum(frames),
+        'delivery_latency_ms': {'p50': pct(latencies, 0.50), 'p95': pct(latencies, 0.95),
+                                'p99': pct(latencies, 0.99),
+                                'mean': round(statistics.mean(latencies) * 1000, 3)},
+        'driver_post_ms': {'p50': pct(post_times, 0.50), 'p99': pct(post_times, 0.99)},
+        'missed_final_update': received_final.count(False) + args.subscribers - len(received_final),
+        'hub': yatrasetu.location_hub.stats(),
+    }
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if result['missed_final_update'] == 0 else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""Load-test suite: search, ride detail, booking, dashboard and My Bookings.
+
+    python bench/run.py --rides 100000                      # in-process test client
+    python bench/run.py --rides 100000 --target gunicorn --workers 2 --threads 8
+    python bench/run.py --db /tmp/yatrasetu-100k.db --output before.json
+    python bench/run.py --db /tmp/yatrasetu-100k.db --compare before.json
+
+Builds a synthetic dataset (bench/synthetic.py) in a scratch database
+unless --db points at one, then sends each scenario's requests from
+--concurrency client threads. The app runs either in this process behind
+Flask's test client, or as a gunicorn server driven over HTTP; --url
+targets a server that is already running on the same database. Prints
+(and with --output writes) JSON with p50/p95/p99 latency, throughput and
+error counts per scenario, plus the commit and dataset so runs from
+different commits can be compared; --compare adds the change against an
+earlier result file.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import synthetic  # noqa: E402  (bench/ is on sys.path when run as a script)
+
+SCENARIOS = ('search', 'ride_detail', 'booking', 'dashboard', 'my_bookings')
+# Rides every booking request competes for
+HOT_RIDES = 5
+
+
+class InProcessClient:
+    """Flask test client logged in by writing the session directly"""
+
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as s:
+            s['user_id'] = user_id
+            s['user_type'] = 'passenger'
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+
+class HTTPClient:
+    """urllib client with its own cookie jar, logged in through /login"""
+
+    def __init__(self, base_url, user_id):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        form = urllib.parse.urlencode({'email': synthetic.email(user_id),
+                                       'password': synthetic.BENCH_PASSWORD}).encode()
+        with self.opener.open(base_url + '/login', form, timeout=30) as response:
+            response.read()
+            # A successful login redirects to the dashboard
+            if urllib.parse.urlparse(response.geturl()).path == '/login':
+                raise SystemExit(f'❌ Could not log in as {synthetic.email(user_id)}')
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def _requests(scenario, dataset, rng, hot_rides, cities):
+    """Endless (method, path, body) requests for one scenario"""
+    first_ride, rides = dataset['first_ride'], dataset['rides']
+    start = date.fromisoformat(dataset['start'])
+    while True:
+        if scenario == 'search':
+            source, destination = rng.sample(cities, 2)
+            travel_date = (start + timedelta(days=rng.randrange(dataset['days']))).isoformat()
+            query = urllib.parse.urlencode({'source': source, 'destination': destination,
+                                            'travel_date': travel_date, 'limit': 20})
+            yield 'GET', f'/api/search-rides?{query}', None
+        elif scenario == 'ride_detail':
+            yield 'GET', f'/api/ride/{rng.randrange(first_ride, first_ride + rides)}', None
+        elif scenario == 'booking':
+            yield 'POST', '/api/book-ride', {'ride_id': rng.choice(hot_rides), 'quantity': 1}
+        elif scenario == 'dashboard':
+            yield 'GET', '/', None
+        elif scenario == 'my_bookings':
+            yield 'GET', '/my-bookings', None
+
+
+def run_scenario(scenario, make_client, passengers, dataset, args, hot_rides, cities):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    remaining = [args.requests]
+    gate = threading.Barrier(args.concurrency + 1)
+
+    def worker(n):
+        rng = random.Random(args.seed * 1000 + n)
+        client = make_client(passengers[n % len(passengers)])
+        requests = _requests(scenario, dataset, rng, hot_rides, cities)
+        mine, codes = [], {}
+        gate.wait()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            method, path, body = next(requests)
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, body)
+            except (OSError, urllib.error.URLError):
+                status = 'error'
+            mine.append(time.perf_counter() - started)
+            codes[status] = codes.get(status, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for status, count in codes.items():
+                statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    for n in range(args.warmup):
+        client = make_client(passengers[0])
+        method, path, body = next(_requests(scenario, dataset, random.Random(n), hot_rides, cities))
+        client.request(method, path, body)
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    gate.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    pct = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+    ok = sum(count for status, count in statuses.items() if status.startswith('2') or status.startswith('3'))
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': {'p50': pct(0.50), 'p95': pct(0.95), 'p99': pct(0.99),
+                       'max': round(latencies[-1] * 1000, 3),
+                       'mean': round(sum(latencies) / len(latencies) * 1000, 3)},
+        'status': statuses,
+        'errors': len(latencies) - ok,
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(db_path, args):
+    """Run the app under gunicorn on a free port; returns (process, base url)"""
+    if shutil.which('gunicorn') is None:
+        raise SystemExit('❌ gunicorn is not installed (pip install -r requirements.txt)')
+    port = _free_port()
+    env = dict(os.environ, YATRASETU_DB=db_path, WORKER_THREADS=str(args.threads + 1))
+    process = subprocess.Popen(
+        ['gunicorn', '-w', str(args.workers), '-k', 'gthread', '--threads', str(args.threads),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app'],
+        cwd=ROOT, env=env
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit('❌ gunicorn exited during startup')
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('❌ gunicorn did not start listening within 30 seconds')
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _dataset_of(conn):
+    # Shape of a database made by synthetic.py, for reuse through --db
+    first_user = conn.execute(
+        "SELECT MIN(id) FROM users WHERE email LIKE '%@bench.yatrasetu'").fetchone()[0]
+    if first_user is None:
+        raise SystemExit('❌ --db was not created by bench/synthetic.py')
+    first_ride, last_ride, start, end = conn.execute('''
+        SELECT MIN(r.id), MAX(r.id), MIN(r.departure_time), MAX(r.departure_time)
+        FROM rides r JOIN users u ON r.user_id = u.id WHERE u.email LIKE '%@bench.yatrasetu'
+    ''').fetchone()
+    return {
+        'first_user': first_user,
+        'users': conn.execute('SELECT COUNT(*) FROM users WHERE id >= ?', (first_user,)).fetchone()[0],
+        'first_ride': first_ride,
+        'rides': last_ride - first_ride + 1,
+        'bookings': conn.execute('SELECT COUNT(*) FROM bookings').fetchone()[0],
+        'start': start[:10],
+        'days': (date.fromisoformat(end[:10]) - date.fromisoformat(start[:10])).days + 1,
+    }
+
+
+def compare(result, baseline):
+    """Percent change of p50/p95/p99 and throughput against an earlier run"""
+    changes = {}
+    for name, now in result['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        delta = lambda new, old: round((new - old) / old * 100, 1) if old else None
+        changes[name] = {p: delta(now['latency_ms'][p], before['latency_ms'][p]) for p in ('p50', 'p95', 'p99')}
+        changes[name]['throughput_rps'] = delta(now['throughput_rps'], before['throughput_rps'])
+    return {'baseline_commit': baseline.get('commit'), 'percent_change': changes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rides', type=int, default=10000, help='size of the generated dataset')
+    parser.add_argument('--db', help='reuse a database made by bench/synthetic.py')
+    parser.add_argument('--target', choices=('inprocess', 'gunicorn', 'url'), default='inprocess')
+    parser.add_argument('--url', help='base URL of a running server (--target url)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=15)
+    parser.add_argument('--output', help='also write the JSON result here')
+    parser.add_argument('--compare', help='JSON result of an earlier run')
+    args = parser.parse_args()
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    if args.target == 'url' and not args.url:
+        parser.error('--target url needs --url')
+
+    if args.db:
+        db_path = os.path.abspath(args.db)
+    else:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='yatrasetu-bench-'), 'bench.db')
+    os.environ['YATRASETU_DB'] = db_path
+    # Leave room for every client thread; the gate in lanes.py would
+    # otherwise answer 503 and the run would measure shedding
+    os.environ.setdefault('WORKER_THREADS', str(args.concurrency + 1))
+    # All clients share one address, so per-client rate limits would too
+    os.environ.setdefault('ADMISSION_LIMITS', '0')
+
+    import database
+
+    if args.db:
+        conn = database.connect(db_path)
+        dataset = _dataset_of(conn)
+    else:
+        dataset = synthetic.create(db_path, args.rides, seed=args.seed)
+        conn = database.connect(db_path)
+
+    # Booking scenario: a few popular rides with room for every request
+    rng = random.Random(args.seed)
+    hot_rides = rng.sample(range(dataset['first_ride'], dataset['first_ride'] + dataset['rides']),
+                           min(HOT_RIDES, dataset['rides']))
+    conn.execute(f"UPDATE rides SET available_capacity = ?, status = 'active' "
+                 f"WHERE id IN ({', '.join('?' * len(hot_rides))})", [args.requests * 2] + hot_rides)
+    conn.commit()
+    cities = [row[0] for row in conn.execute('''
+        SELECT source_city FROM rides WHERE id >= ?
+        GROUP BY source_key ORDER BY COUNT(*) DESC LIMIT 50
+    ''', (dataset['first_ride'],))]
+    # Passengers with the most bookings make My Bookings the heaviest page
+    passengers = [row[0] for row in conn.execute('''
+        SELECT passenger_id FROM bookings GROUP BY passenger_id ORDER BY COUNT(*) DESC LIMIT ?
+    ''', (args.concurrency,))] or [dataset['first_user']]
+    conn.close()
+
+    server = None
+    if args.target == 'inprocess':
+        import app as yatrasetu
+        make_client = lambda user_id: InProcessClient(yatrasetu.app, user_id)
+    else:
+        if args.target == 'gunicorn':
+            server, base_url = start_gunicorn(db_path, args)
+        else:
+            base_url = args.url.rstrip('/')
+        make_client = lambda user_id: HTTPClient(base_url, user_id)
+
+    results = {}
+    try:
+        for scenario in scenarios:
+            results[scenario] = run_scenario(scenario, make_client, passengers, dataset, args,
+                                             hot_rides, cities)
+            print(f"✅ {scenario}: p50 {results[scenario]['latency_ms']['p50']} ms, "
+                  f"{results[scenario]['throughput_rps']} req/s", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    result = {
+        'benchmark': 'suite',
+        'commit': _commit(),
+        'target': args.target,
+        'concurrency': args.concurrency,
+        'workers': args.workers if args.target == 'gunicorn' else None,
+        'threads': args.threads if args.target == 'gunicorn' else None,
+        'dataset': dataset,
+        'scenarios': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            result['comparison'] = compare(result, json.load(f))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Search latency from the database and from ride_snapshot.RideSnapshot.
+
+    python bench/search_snapshot.py --rides 50000 --repeat 200
+
+Fills a scratch database with synthetic rides (bench/synthetic.py) and
+runs the same searches, with and without filters, through
+ride_search and through a snapshot. Also reports the snapshot's load
+time and memory per ride (tracemalloc), and the cost of a refresh after
+a batch of bookings. Prints a JSON summary.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t)
+    times.sort()
+    return out, {'mean_ms': round(statistics.mean(times) * 1000, 3),
+                 'p95_ms': round(times[int(len(times) * 0.95) - 1] * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rides', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--bookings', type=int, default=500)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+    os.environ['RIDE_SWEEP_SECONDS'] = '0'
+
+    import app as yatrasetu
+    import database
+    import synthetic
+    from ride_search import search_page, search_rides
+    from ride_snapshot import RideSnapshot
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    synthetic.generate(conn, args.rides)
+    source, destination, day = conn.execute('''
+        SELECT source_city, destination_city, substr(departure_time, 1, 10) AS day FROM rides
+        WHERE status = 'active' GROUP BY source_key, destination_key, day ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()
+
+    snapshot = RideSnapshot(max_staleness=3600)
+    started = time.perf_counter()
+    snapshot.etag(conn)
+    load_ms = round((time.perf_counter() - started) * 1000, 1)
+    # Loaded again under tracemalloc, which slows it down, for the memory
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    traced = RideSnapshot()
+    traced.etag(conn)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del traced
+    rides = snapshot.stats()['rides']
+
+    filters = {'ride_type': ('car',), 'max_price': 800.0, 'seats': 2}
+    searches = {
+        'route_day': dict(source=source, destination=destination, travel_date=day),
+        'route_day_filtered': dict(source=source, destination=destination, travel_date=day, filters=filters),
+        'source_prefix_day': dict(source=source[:2], travel_date=day),
+        'source_prefix_day_filtered': dict(source=source[:2], travel_date=day, filters=filters),
+        'all_cities_day': dict(travel_date=day),
+    }
+    results = {}
+    for name, search in searches.items():
+        expected, database_ms = timed(lambda: search_page(conn, limit=20, **search), args.repeat)
+        found, snapshot_ms = timed(lambda: snapshot.search_page(conn, limit=20, **search), args.repeat)
+        full = len(search_rides(conn, **search))
+        results[name] = {
+            'matches': full, 'same_page': [tuple(r) for r in expected[0]] == [tuple(r) for r in found[0]]
+            and expected[1] == found[1], 'database': database_ms, 'snapshot': snapshot_ms,
+        }
+
+    # What a refresh costs after other workers booked seats
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM rides WHERE status = 'active' AND available_capacity > 1 LIMIT ?", (args.bookings,))]
+    conn.executemany('UPDATE rides SET available_capacity = available_capacity - 1 WHERE id = ?',
+                     [(i,) for i in ids])
+    conn.commit()
+    snapshot.changed()
+    started = time.perf_counter()
+    snapshot.etag(conn)
+    refresh_ms = round((time.perf_counter() - started) * 1000, 2)
+    snapshot.changed()
+    _, idle_refresh = timed(lambda: (snapshot.changed(), snapshot.etag(conn)), args.repeat)
+
+    print(json.dumps({
+        'rides': args.rides, 'active_rides': rides, 'route': [source, destination, day],
+        'load_ms': load_ms, 'bytes_per_ride': round(held / rides) if rides else None,
+        'searches': results,
+        'refresh': {'changed_rides': len(ids), 'ms': refresh_ms, 'idle': idle_refresh},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Does a slow upstream starve unrelated routes?
+
+    python bench/slow_upstream.py --delay 1.5 --seconds 6 --lanes 4
+
+Starts a local stand-in for the Teleport API that answers after --delay
+seconds, points /api/city-suggest at it and sends a steady stream of
+suggestions for names the gazetteer does not know. At the same time
+other threads search rides. It runs twice: "blocking", where a suggestion
+waits for the upstream (the old behaviour), and "bounded", where it waits
+at most CITY_SUGGEST_TELEPORT_WAIT and the answer is cached for the next
+keystroke. Prints a JSON summary of search and suggest latency, 503s
+from the request lanes and upstream calls saved by coalescing.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LETTERS = 'qwxvjkzpfy'
+
+
+def upstream(delay):
+    hits = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            hits[0] += 1
+            query = parse_qs(urlsplit(self.path).query).get('search', [''])[0]
+            time.sleep(delay)
+            body = json.dumps({'_embedded': {'city:search-results': [
+                {'matching_full_name': f'{query.title()}, Maharashtra, India'}]}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, hits
+
+
+def pct(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3) if values else None
+
+
+def run(yatrasetu, mode, args, hits):
+    teleport = yatrasetu.teleport_fallback
+    teleport.wait = args.delay + 1 if mode == 'blocking' else args.wait
+    teleport._cache.clear()
+    hits[0] = 0
+    stop = time.monotonic() + args.seconds
+    results = {'search': [], 'suggest': [], 'search_503': 0, 'suggest_503': 0, 'suggestions': 0}
+    lock = threading.Lock()
+
+    def searcher(n):
+        client = yatrasetu.app.test_client()
+        rng = random.Random(n)
+        while time.monotonic() < stop:
+            day = f'2030-01-{rng.randint(1, 28):02d}'
+            started = time.perf_counter()
+            response = client.get(f'/api/search-rides?source=pune&destination=mumbai&travel_date={day}')
+            elapsed = time.perf_counter() - started
+            with lock:
+                results['search'].append(elapsed)
+                results['search_503'] += response.status_code == 503
+            time.sleep(0.01)
+
+    def suggester(n):
+        client = yatrasetu.app.test_client()
+        rng = random.Random(1000 + n)
+        while time.monotonic() < stop:
+            # A few new names every half second, typed by several users.
+            # Letters only: the gazetteer folds digits away.
+            tick = int(time.monotonic() * 2)
+            name = mode[:2] + 'zq' + ''.join(LETTERS[int(d)] for d in str(tick)) + LETTERS[rng.randint(0, 3)]
+            started = time.perf_counter()
+            response = client.get(f'/api/city-suggest?q={name}')
+            elapsed = time.perf_counter() - started
+            with lock:
+                results['suggest'].append(elapsed)
+                results['suggest_503'] += response.status_code == 503
+                if response.status_code == 200:
+                    results['suggestions'] += bool(response.get_json()['suggestions'])
+            time.sleep(0.05)
+
+    before = yatrasetu.outbound.shared.stats()
+    threads = ([threading.Thread(target=searcher, args=(n,)) for n in range(args.searchers)]
+               + [threading.Thread(target=suggester, args=(n,)) for n in range(args.suggesters)])
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    after = yatrasetu.outbound.shared.stats()
+    return {
+        'search_ms': {'p50': pct(results['search'], 0.5), 'p95': pct(results['search'], 0.95),
+                      'p99': pct(results['search'], 0.99), 'max': pct(results['search'], 1.0)},
+        'search_requests': len(results['search']),
+        'search_503': results['search_503'],
+        'suggest_ms': {'p50': pct(results['suggest'], 0.5), 'p99': pct(results['suggest'], 0.99)},
+        'suggest_requests': len(results['suggest']),
+        'suggest_503': results['suggest_503'],
+        'suggest_answers_with_upstream_names': results['suggestions'],
+        'upstream_calls': hits[0],
+        'coalesced': after['coalesced'] - before['coalesced'],
+        'rejected': after['rejected'] - before['rejected'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--delay', type=float, default=1.5, help='upstream response time (s)')
+    parser.add_argument('--seconds', type=float, default=6)
+    parser.add_argument('--lanes', type=int, default=4, help='request threads per worker')
+    parser.add_argument('--searchers', type=int, default=2)
+    parser.add_argument('--suggesters', type=int, default=8)
+    parser.add_argument('--wait', type=float, default=0.3, help='bounded mode wait (s)')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+    os.environ['CITY_SUGGEST_TELEPORT'] = '1'
+    os.environ['WORKER_THREADS'] = str(args.lanes)
+    os.environ['RESERVED_LANES'] = '0'
+    # Measures the upstream wait alone, without the lane shares of lanes.py
+    os.environ['ADMISSION_LIMITS'] = '0'
+
+    import app as yatrasetu
+
+    yatrasetu.init_db()
+    server, hits = upstream(args.delay)
+    yatrasetu.teleport_fallback.BASE_URL = f'http://127.0.0.1:{server.server_address[1]}/api/cities/'
+    yatrasetu.teleport_fallback.timeout = args.delay + 1
+
+    result = {'benchmark': 'slow_upstream', 'upstream_delay_s': args.delay, 'lanes': args.lanes,
+              'searchers': args.searchers, 'suggesters': args.suggesters}
+    for mode in ('blocking', 'bounded'):
+        result[mode] = run(yatrasetu, mode, args, hits)
+        # Let lookups still in flight finish before the next run
+        time.sleep(args.delay + 0.5)
+    server.shutdown()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
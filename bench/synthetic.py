@@ -0,0 +1,180 @@
+"""Synthetic YatraSetu datasets for benchmarks.
+
+    python bench/synthetic.py --rides 100000 --db /tmp/yatrasetu-100k.db
+
+Creates users, rides between gazetteer cities and bookings in a scratch
+database through the same schema and INSERT statement the app uses, so
+indexes, triggers and counters match production. Big cities get more
+rides (weights fall off with population rank), start points are
+jittered a few km around the city and departures spread over the
+requested number of days. The same --seed always gives the same data.
+
+Every user's password is BENCH_PASSWORD so HTTP load tests can log in.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_PASSWORD = 'bench123'
+CHUNK_SIZE = 50000
+
+RIDE_TYPES = (
+    # ride_type, share, vehicle types, capacity range, price per km range
+    ('car', 0.7, ('Sedan', 'SUV', 'Hatchback'), (1, 6), (1.5, 3.0)),
+    ('bike', 0.2, ('Motorcycle', 'Scooter'), (1, 1), (1.0, 1.8)),
+    ('logistics', 0.1, ('Tempo', 'Truck'), (100, 2000), (0.05, 0.2)),
+)
+LANGUAGES = ('hindi', 'marathi', 'english', 'gujarati', 'tamil', 'telugu', 'kannada', 'bengali')
+
+
+def email(n):
+    return f'user{n}@bench.yatrasetu'
+
+
+def _cities(limit=None):
+    from gazetteer import Gazetteer
+
+    cities = [(name, point) for name, _, _, point in Gazetteer.load()._base if point]
+    return cities[:limit] if limit else cities
+
+
+def generate(conn, rides, users=None, bookings=None, cities=None, days=30,
+             start='2030-01-01', seed=15):
+    """Fill an initialized database; returns a summary dict.
+
+    users defaults to one per 20 rides (at least 50) and bookings to one
+    per two rides. Ids are appended after whatever the database holds.
+    """
+    from geo import cell_id, haversine_km
+    from ride_import import INSERT_RIDE
+    from ride_search import city_key
+
+    rng = random.Random(seed)
+    users = users if users is not None else max(50, rides // 20)
+    bookings = bookings if bookings is not None else rides // 2
+    places = _cities(cities)
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(len(places))]
+    first_day = datetime.fromisoformat(start)
+    started = time.perf_counter()
+
+    first_user = (conn.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0) + 1
+    conn.executemany(
+        'INSERT INTO users (name, email, password, phone, user_type, rating) VALUES (?, ?, ?, ?, ?, ?)',
+        ((f'Bench User {n}', email(n), BENCH_PASSWORD, f'9{n:09d}'[-10:],
+          'driver' if n % 3 == 0 else 'passenger', round(rng.uniform(3.5, 5.0), 1))
+         for n in range(first_user, first_user + users))
+    )
+    conn.commit()
+    drivers = [n for n in range(first_user, first_user + users) if n % 3 == 0] or [first_user]
+    passengers = [n for n in range(first_user, first_user + users) if n % 3] or [first_user]
+
+    def ride():
+        (source, (slat, slng)), (destination, (dlat, dlng)) = _pair(rng, places, weights)
+        slat += rng.uniform(-0.03, 0.03)
+        slng += rng.uniform(-0.03, 0.03)
+        ride_type, _, vehicles, capacity, per_km = _pick_type(rng)
+        km = haversine_km(slat, slng, dlat, dlng) * 1.3
+        departure = first_day + timedelta(minutes=rng.randrange(days * 24 * 4) * 15)
+        arrival = departure + timedelta(minutes=int(km / 45 * 60)) if rng.random() < 0.5 else None
+        return (
+            rng.choice(drivers), ride_type, source, destination,
+            departure.strftime('%Y-%m-%d %H:%M:%S'),
+            arrival.strftime('%Y-%m-%d %H:%M:%S') if arrival else None,
+            rng.choice(vehicles), f'MH{rng.randint(1, 50):02d}AB{rng.randint(1000, 9999)}',
+            rng.randint(*capacity), round(max(20, km * rng.uniform(*per_km))), '',
+            f'9{rng.randint(100000000, 999999999)}', rng.choice(LANGUAGES),
+            city_key(source), city_key(destination),
+            round(slat, 5), round(slng, 5), dlat, dlng, cell_id(slat, slng), cell_id(dlat, dlng),
+        )
+
+    first_ride = (conn.execute('SELECT MAX(id) FROM rides').fetchone()[0] or 0) + 1
+    for done in range(0, rides, CHUNK_SIZE):
+        conn.executemany(INSERT_RIDE, (ride() for _ in range(min(CHUNK_SIZE, rides - done))))
+        conn.commit()
+
+    # Bookings go through the triggers that keep dashboard counters, so
+    # user_stats and rides.seats_booked come out consistent
+    def booking():
+        quantity = rng.randint(1, 2)
+        return (rng.randrange(first_ride, first_ride + rides), rng.choice(passengers), quantity,
+                quantity * rng.randint(50, 900), 'confirmed' if rng.random() < 0.9 else 'completed')
+
+    for done in range(0, bookings, CHUNK_SIZE):
+        conn.executemany(
+            'INSERT INTO bookings (ride_id, passenger_id, quantity, total_amount, status) VALUES (?, ?, ?, ?, ?)',
+            (booking() for _ in range(min(CHUNK_SIZE, bookings - done)))
+        )
+        conn.commit()
+    conn.execute('ANALYZE')
+    conn.commit()
+    return {
+        'users': users,
+        'rides': rides,
+        'bookings': bookings,
+        'cities': len(places),
+        'first_user': first_user,
+        'first_ride': first_ride,
+        'days': days,
+        'start': start,
+        'seed': seed,
+        'seconds': round(time.perf_counter() - started, 2),
+    }
+
+
+def _pair(rng, places, weights):
+    while True:
+        source, destination = rng.choices(places, weights, k=2)
+        if source[0] != destination[0]:
+            return source, destination
+
+
+def _pick_type(rng):
+    roll = rng.random()
+    for ride_type in RIDE_TYPES:
+        roll -= ride_type[1]
+        if roll < 0:
+            return ride_type
+    return RIDE_TYPES[0]
+
+
+def create(path, rides, **kwargs):
+    """Initialize a fresh database at path and fill it"""
+    if os.path.exists(path):
+        raise SystemExit(f'❌ {path} already exists; pick a new path for a scratch database')
+    os.environ['YATRASETU_DB'] = path
+    import app as yatrasetu
+    import database
+
+    database.DATABASE = path
+    yatrasetu.init_db()
+    conn = database.connect(path)
+    try:
+        return generate(conn, rides, **kwargs)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='path of the new database')
+    parser.add_argument('--rides', type=int, default=10000)
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--bookings', type=int)
+    parser.add_argument('--cities', type=int, help='only the N most populous cities')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--start', default='2030-01-01')
+    parser.add_argument('--seed', type=int, default=15)
+    args = parser.parse_args()
+    summary = create(args.db, args.rides, users=args.users, bookings=args.bookings,
+                     cities=args.cities, days=args.days, start=args.start, seed=args.seed)
+    print(json.dumps(dict(summary, db=args.db), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Bytes on the wire and serialization CPU for search results.
+
+    python bench/wire_format.py --rides 50000 --repeat 50
+
+Fills a scratch database with synthetic rides (bench/synthetic.py) and
+takes three result sets from the search: one page (20 rides), the
+busiest day and the first 2000 active rides. Each is encoded the old way (a dict per
+row through jsonify), from the row tuples (wire.Rows) and as columns
+(format=columns), then compressed with gzip and, if installed, brotli.
+Finally the same day is fetched through the app with and without
+Accept-Encoding. Prints a JSON summary.
+"""
+import argparse
+import gzip
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t)
+    return out, round(statistics.mean(times) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rides', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='yatrasetu-bench-')
+    os.environ['YATRASETU_DB'] = os.path.join(scratch, 'bench.db')
+    os.environ['RIDE_SWEEP_SECONDS'] = '0'
+    # Repeated requests from one client; see lanes.py
+    os.environ['ADMISSION_LIMITS'] = '0'
+
+    import app as yatrasetu
+    import database
+    import synthetic
+    import wire
+    from ride_search import RIDE_FIELDS, search_page, search_rides
+
+    yatrasetu.init_db()
+    conn = database.connect()
+    synthetic.generate(conn, args.rides)
+    day = conn.execute('''
+        SELECT substr(departure_time, 1, 10) AS day FROM rides
+        GROUP BY day ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()[0]
+    fields = list(RIDE_FIELDS)
+    sets = {
+        'page_20': search_page(conn, fields=fields, limit=20)[0],
+        'one_day': search_rides(conn, travel_date=day, fields=fields),
+        'rows_2000': search_rides(conn, fields=fields, limit=2000),
+    }
+
+    def as_dicts(rows):
+        # What /api/search-rides did before wire.py
+        with yatrasetu.app.app_context():
+            rides = []
+            for row in rows:
+                ride = dict(row)
+                ride['rating'] = ride['rating'] or 4.5
+                rides.append(ride)
+            return yatrasetu.app.json.dumps(rides)
+
+    encoders = {
+        'dicts': as_dicts,
+        'rows': lambda rows: wire.Rows(fields, rows).json(),
+        'columns': lambda rows: wire.Rows(fields, rows).json(columnar=True),
+    }
+    results = {}
+    for name, rows in sets.items():
+        results[name] = {'rides': len(rows)}
+        for encoding, encode in encoders.items():
+            body, encode_ms = timed(lambda: encode(rows), args.repeat)
+            body = body.encode()
+            packed, gzip_ms = timed(lambda: gzip.compress(body, wire.GZIP_LEVEL, mtime=0), args.repeat)
+            entry = {'encode_ms': encode_ms, 'bytes': len(body),
+                     'gzip_bytes': len(packed), 'gzip_ms': gzip_ms}
+            if wire.brotli:
+                packed, brotli_ms = timed(lambda: wire.brotli.compress(body, quality=wire.BROTLI_QUALITY),
+                                          args.repeat)
+                entry.update(brotli_bytes=len(packed), brotli_ms=brotli_ms)
+            results[name][encoding] = entry
+
+    client = yatrasetu.app.test_client()
+    url = f'/api/search-rides?travel_date={day}'
+    through_app = {}
+    for label, headers in (('identity', {}), ('compressed', {'Accept-Encoding': 'br, gzip'})):
+        for columns in (False, True):
+            target = url + ('&format=columns' if columns else '')
+            response = client.get(target, headers=headers)
+            # Cached after the first request: this is the encode-once path
+            _, ms = timed(lambda: client.get(target, headers=headers), args.repeat)
+            through_app[label + ('_columns' if columns else '')] = {
+                'bytes': len(response.data), 'encoding': response.headers.get('Content-Encoding'),
+                'cached_request_ms': ms,
+            }
+    print(json.dumps({'rides': args.rides, 'codings': list(wire.CODINGS),
+                      'encode': results, 'app': through_app}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""Intent and slot parsing for the chat assistant (/api/chat).
+
+A message is split into tokens once and walked with a token trie built at
+import, so every keyword and phrase ("my bookings", "day after tomorrow")
+is found in a single pass; whole tokens are matched, so "hi" no longer
+fires inside "Delhi". Words the trie does not know are looked up in the
+gazetteer, longest phrase first ("navi mumbai" before "mumbai"). from/to
+and the Hindi postpositions se/tak decide which side a city is on. Dates
+understand today/tomorrow (aaj, kal, parso), weekdays, "22 Jan", "Jan 22",
+"22/01" and ISO dates.
+"""
+import re
+from collections import namedtuple
+from datetime import date, timedelta
+
+Query = namedtuple('Query', 'intent source destination travel_date seats ride_type')
+
+GREET, SEARCH, BOOK, POST, BOOKINGS, SOS, HELP, THANKS, UNKNOWN = (
+    'greet', 'search', 'book', 'post', 'bookings', 'sos', 'help', 'thanks', 'unknown'
+)
+
+# When a message has keywords for several intents the earliest wins.
+# A recognised city turns anything below POST into a search, and so does
+# a date or ride type in a message with no other keyword.
+PRIORITY = (SOS, BOOKINGS, POST, SEARCH, BOOK, HELP, GREET, THANKS)
+
+KEYWORDS = {
+    ('intent', GREET): ('hi', 'hii', 'hello', 'hey', 'namaste', 'namaskar',
+                        'good morning', 'good afternoon', 'good evening'),
+    ('intent', SEARCH): ('ride', 'rides', 'find', 'search', 'show', 'available', 'going',
+                         'travel', 'travelling', 'lift', 'koi ride'),
+    ('intent', BOOK): ('book', 'booking', 'reserve'),
+    ('intent', POST): ('post', 'offer', 'publish', 'post a ride', 'offer a ride', 'i am driving'),
+    ('intent', BOOKINGS): ('my bookings', 'my booking', 'my trips', 'my rides'),
+    ('intent', SOS): ('sos', 'emergency', 'danger', 'unsafe', 'bachao'),
+    ('intent', HELP): ('help', 'what can you do', 'how to', 'how do i'),
+    ('intent', THANKS): ('thanks', 'thank you', 'thx', 'dhanyavad', 'dhanyawad', 'shukriya'),
+    ('days', 0): ('today', 'tonight', 'aaj'),
+    ('days', 1): ('tomorrow', 'tmrw', 'tmr', 'kal'),
+    ('days', 2): ('day after tomorrow', 'parso', 'parson'),
+    ('from', None): ('from', 'frm'),
+    ('to', None): ('to', 'till', 'towards', 'upto'),
+    ('from_after', None): ('se', 'say'),
+    ('to_after', None): ('tak',),
+    # "Nasik jana hai": going to the city before it
+    ('to_after', SEARCH): ('jana', 'jaana', 'jaana hai', 'jana hai'),
+    ('type', 'car'): ('car', 'cars', 'cab', 'taxi'),
+    ('type', 'bike'): ('bike', 'bikes', 'motorcycle', 'scooter'),
+    ('type', 'logistics'): ('truck', 'tempo', 'parcel', 'logistics', 'goods'),
+    ('seat', None): ('seat', 'seats', 'people', 'persons', 'passengers', 'log', 'sawari'),
+}
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+MONTHS = ('january', 'february', 'march', 'april', 'may', 'june', 'july',
+          'august', 'september', 'october', 'november', 'december')
+
+# Filler that must never be read as a city name
+STOPWORDS = frozenset((
+    'a', 'an', 'the', 'any', 'are', 'is', 'for', 'on', 'in', 'at', 'of', 'me', 'i', 'we',
+    'want', 'need', 'please', 'with', 'and', 'there', 'what', 'can', 'you', 'get', 'next',
+    'this', 'morning', 'evening', 'night', 'hai', 'hain', 'kya', 'mujhe', 'chahiye', 'koi',
+    'mein', 'ke', 'liye', 'ko', 'main', 'way', 'st', 'nd', 'rd', 'th',
+))
+MAX_CITY_WORDS = 3
+
+_TOKENS = re.compile(r'\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/.]\d{1,2}(?:[/.]\d{2,4})?|\d+|[a-z]+')
+_END = object()
+
+
+def _compile():
+    trie = {}
+    entries = dict(KEYWORDS)
+    for n, day in enumerate(WEEKDAYS):
+        entries[('weekday', n)] = (day, day[:3]) + ((day[:4],) if n in (1, 3) else ())
+    for n, month in enumerate(MONTHS, 1):
+        entries[('month', n)] = (month, month[:3]) + (('sept',) if n == 9 else ())
+    for meaning, phrases in entries.items():
+        for phrase in phrases:
+            node = trie
+            for word in phrase.split():
+                node = node.setdefault(word, {})
+            node[_END] = meaning
+    return trie
+
+
+_TRIE = _compile()
+
+
+def _keyword(tokens, i):
+    # Longest keyword phrase starting at tokens[i]: (meaning, next index)
+    node, found = _TRIE, None
+    for j in range(i, len(tokens)):
+        node = node.get(tokens[j])
+        if node is None:
+            break
+        if _END in node:
+            found = (node[_END], j + 1)
+    return found
+
+
+def _city(tokens, i, gazetteer):
+    for n in range(min(MAX_CITY_WORDS, len(tokens) - i), 0, -1):
+        words = tokens[i:i + n]
+        if not all(w.isalpha() and w not in STOPWORDS and w not in _TRIE for w in words):
+            continue
+        phrase = ' '.join(words)
+        if len(phrase) < 3:
+            continue
+        name = gazetteer.canonical(phrase)
+        if name:
+            return name, i + n
+    return None
+
+
+def _numeric_date(token, today):
+    try:
+        if '-' in token:
+            return date(*map(int, token.split('-')))
+        parts = [int(p) for p in re.split(r'[/.]', token)]
+        day, month = parts[:2]
+        if len(parts) == 3:
+            year = parts[2] + 2000 if parts[2] < 100 else parts[2]
+            return date(year, month, day)
+        return _upcoming(day, month, today)
+    except ValueError:
+        return None
+
+
+def _upcoming(day, month, today):
+    # The next time this day and month comes round
+    found = date(today.year, month, day)
+    return found if found >= today else date(today.year + 1, month, day)
+
+
+def tokenize(message):
+    """Lowercased words, numbers and dates of a message"""
+    return _TOKENS.findall((message or '').lower())
+
+
+def parse(message, gazetteer, today=None):
+    """Read a chat message into a Query.
+
+    gazetteer is the city index behind /api/city-suggest; city slots hold
+    its canonical names. travel_date is YYYY-MM-DD or ''.
+    """
+    today = today or date.today()
+    tokens = tokenize(message)
+    items = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        found = _keyword(tokens, i) or _city(tokens, i, gazetteer)
+        if found:
+            meaning, i = found
+            items.append(meaning if isinstance(meaning, tuple) else ('city', meaning))
+            continue
+        if token.isdigit():
+            items.append(('number', int(token)))
+        elif token[0].isdigit():
+            items.append(('date', _numeric_date(token, today)))
+        i += 1
+
+    intents = set()
+    source = destination = travel_date = seats = ride_type = None
+    unplaced = []
+    for k, (kind, value) in enumerate(items):
+        before = items[k - 1][0] if k else None
+        after = items[k + 1] if k + 1 < len(items) else (None, None)
+        if kind == 'intent' or kind == 'to_after' and value:
+            intents.add(value)
+        elif kind == 'city':
+            if before == 'from' or after[0] == 'from_after':
+                source = source or value
+            elif before == 'to' or after[0] == 'to_after':
+                destination = destination or value
+            else:
+                unplaced.append(value)
+        elif kind == 'days':
+            travel_date = today + timedelta(days=value)
+        elif kind == 'weekday':
+            travel_date = today + timedelta(days=(value - today.weekday()) % 7)
+        elif kind == 'date' and value:
+            travel_date = value
+        elif kind == 'month':
+            travel_date = _month_day(items, k, value, today) or travel_date
+        elif kind == 'seat' and before == 'number':
+            seats = items[k - 1][1] or None
+        elif kind == 'type':
+            ride_type = value
+    for city in unplaced:
+        if source is None and city != destination:
+            source = city
+        elif destination is None and city != source:
+            destination = city
+
+    intent = next((name for name in PRIORITY if name in intents), UNKNOWN)
+    if (source or destination) and intent not in (SOS, BOOKINGS, POST):
+        intent = SEARCH
+    elif (travel_date or ride_type) and intent == UNKNOWN:
+        intent = SEARCH
+    return Query(intent, source or '', destination or '',
+                 travel_date.isoformat() if travel_date else '', seats, ride_type)
+
+
+def _month_day(items, k, month, today):
+    # "22 Jan", "22nd January 2027" or "Jan 22"
+    before = items[k - 1] if k else (None, None)
+    after = items[k + 1] if k + 1 < len(items) else (None, None)
+    year = None
+    if before[0] == 'number' and before[1] <= 31:
+        day = before[1]
+        if after[0] == 'number' and after[1] >= 2000:
+            year = after[1]
+    elif after[0] == 'number' and after[1] <= 31:
+        day = after[1]
+        following = items[k + 2] if k + 2 < len(items) else (None, None)
+        if following[0] == 'number' and following[1] >= 2000:
+            year = following[1]
+    else:
+        return None
+    try:
+        return date(year, month, day) if year else _upcoming(day, month, today)
+    except ValueError:
+        return None
+
+
+REPLIES = {
+    GREET: "Hello! I'm the YatraSetu assistant. Tell me where you want to go, "
+           "e.g. 'rides from Pune to Mumbai tomorrow'.",
+    BOOK: "Ask me for rides, e.g. 'Pune to Mumbai on 22 Jan', and press Book on a ride card.",
+    POST: "You can offer a ride on the Post Ride page.",
+    BOOKINGS: "Your bookings are on the My Bookings page.",
+    SOS: "If you are in danger call 112 now. On a trip, the SOS button alerts your contacts.",
+    HELP: "I can find rides for you. Try 'Find rides from Pune to Mumbai on 22 Jan' "
+          "or 'kal Pune se Nashik 2 seats'.",
+    THANKS: "Happy to help! Have a safe trip.",
+    UNKNOWN: "Sorry, I didn't get that. Try 'rides from Pune to Mumbai tomorrow'.",
+    SEARCH: "Which city are you travelling from and to? Try 'Pune to Mumbai tomorrow'.",
+}
+LINKS = {POST: '/post-ride', BOOKINGS: '/my-bookings', SEARCH: '/find-ride'}
+
+
+def describe(query, found, more=False):
+    """Reply text for a search that returned `found` rides"""
+    route = ' '.join(f'{word} {city}' for word, city in
+                     (('from', query.source), ('to', query.destination)) if city)
+    when = f' on {query.travel_date}' if query.travel_date else ''
+    if not found:
+        return f"No rides {route}{when} right now. Try another date or check back later."
+    rides = 'ride' if found == 1 else 'rides'
+    extra = ' More on the Find Ride page.' if more else ''
+    return f"Found {found} {rides} {route}{when}.{extra}"
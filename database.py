@@ -1,112 +1,176 @@
 import sqlite3
 import os
+import sys
+import threading
+
+import metrics
+import migrations
+from gazetteer import Gazetteer
+from geo import cell_id
+from ride_search import city_key
+
+DATABASE = os.environ.get('YATRASETU_DB', 'yatrasetu.db')
+
+# Applied to every connection we open. WAL lets readers run alongside the
+# single writer; NORMAL sync is durable across app crashes in WAL mode.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('cache_size', -16000),
+    ('temp_store', 'MEMORY'),
+)
+
+# One connection per worker thread, reused across requests
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {'opened': 0, 'reused': 0, 'released': 0, 'rolled_back': 0, 'discarded': 0}
+_open_connections = {}
+_schema_lock = threading.Lock()
+_schema_checked = False
+
+
+def connect(path=None):
+    """Open a new connection with the row factory and PRAGMAs applied"""
+    factory = metrics.InstrumentedConnection if metrics.DB_ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(path or DATABASE, timeout=5, factory=factory)
+    conn.row_factory = sqlite3.Row
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+def _bump(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def _ensure_schema(conn):
+    # The first connection in each process brings the schema up to date;
+    # once it is current this is a single PRAGMA read (see migrations.py)
+    global _schema_checked
+    with _schema_lock:
+        if not _schema_checked:
+            migrations.migrate(conn)
+            _schema_checked = True
+
+
+def checkout():
+    """Return this thread's pooled connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+    # A connection inherited across fork() must never be used by the child
+    if conn is not None and _local.pid != os.getpid():
+        _bump('discarded')
+        conn = None
+    if conn is None:
+        conn = connect()
+        _ensure_schema(conn)
+        _local.conn = conn
+        _local.pid = os.getpid()
+        with _stats_lock:
+            _stats['opened'] += 1
+            _open_connections[threading.get_ident()] = os.getpid()
+    else:
+        _bump('reused')
+    return conn
+
+
+def release(conn):
+    """Hand a connection back to the pool, abandoning any open transaction"""
+    if conn.in_transaction:
+        conn.rollback()
+        _bump('rolled_back')
+    _bump('released')
+
+
+def close_thread_connection():
+    """Close the calling thread's pooled connection, if it has one"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    if _local.pid == os.getpid():
+        conn.close()
+    with _stats_lock:
+        _open_connections.pop(threading.get_ident(), None)
+
+
+def pool_stats():
+    """Counters describing how connections are being opened and reused"""
+    with _stats_lock:
+        stats = dict(_stats)
+        stats['open'] = sum(1 for pid in _open_connections.values() if pid == os.getpid())
+    stats['database'] = DATABASE
+    stats['pragmas'] = dict(PRAGMAS)
+    return stats
+
+
+SAMPLE_USERS = [
+    ('Prasad Sharma', 'prasad@example.com', 'password123', '9876543210', 'driver'),
+    ('Siddhesh Patil', 'siddhesh@example.com', 'password123', '9876543211', 'passenger'),
+    ('Pranit Deshmukh', 'pranit@example.com', 'password123', '9876543212', 'driver'),
+    ('Sudin More', 'sudin@example.com', 'password123', '9876543213', 'passenger'),
+    ('Tejas Jadhav', 'tejas@example.com', 'password123', '9876543214', 'driver'),
+    ('Pranav Kulkarni', 'pranav@example.com', 'password123', '9876543215', 'passenger'),
+    ('Admin User', 'admin@yatrasetu.com', 'admin123', '9876543216', 'admin')
+]
+
+SAMPLE_RIDES = [
+    (1, 'car', 'Nashik', 'Delhi', '2024-01-20 08:00:00', '2024-01-20 20:00:00',
+     'SUV', 'MH15AB1234', 4, 500.00, 'Comfortable AC SUV with music system', '9876543210'),
+    (3, 'bike', 'Sangamner', 'Pune', '2024-01-21 07:00:00', '2024-01-21 12:00:00',
+     'Motorcycle', 'MH12CD5678', 1, 200.00, 'Safe rider with helmet', '9876543212'),
+    (5, 'logistics', 'Pune', 'Mumbai', '2024-01-22 09:00:00', '2024-01-22 14:00:00',
+     'Tempo', 'MH14EF9012', 500, 50.00, 'Goods transport with care', '9876543214')
+]
+
+
+def _add_sample_data(conn):
+    from ride_import import INSERT_RIDE
+
+    locate = Gazetteer.load().locate
+    conn.executemany('''
+        INSERT INTO users (name, email, password, phone, user_type)
+        VALUES (?, ?, ?, ?, ?)
+    ''', SAMPLE_USERS)
+    rides = []
+    for ride in SAMPLE_RIDES:
+        source, destination = locate(ride[2]), locate(ride[3])
+        rides.append(ride + (
+            'hindi', city_key(ride[2]), city_key(ride[3]),
+            *(source or (None, None)), *(destination or (None, None)),
+            cell_id(*source) if source else None,
+            cell_id(*destination) if destination else None,
+        ))
+    conn.executemany(INSERT_RIDE, rides)
+    conn.commit()
+
 
 def init_db():
-    """Initialize the database with required tables"""
+    """Bring the schema up to date; an empty database gets the sample accounts"""
     print("🔄 Initializing database...")
-    conn = sqlite3.connect('yatrasetu.db')
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            phone TEXT,
-            user_type TEXT DEFAULT 'passenger',
-            profile_image TEXT,
-            rating REAL DEFAULT 5.0,
-            total_rides INTEGER DEFAULT 0,
-            member_since TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create rides table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS rides (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            ride_type TEXT NOT NULL,
-            source_city TEXT NOT NULL,
-            destination_city TEXT NOT NULL,
-            departure_time TIMESTAMP NOT NULL,
-            arrival_time TIMESTAMP,
-            vehicle_type TEXT NOT NULL,
-            vehicle_number TEXT NOT NULL,
-            available_capacity INTEGER NOT NULL,
-            price_per_unit DECIMAL(10,2) NOT NULL,
-            additional_info TEXT,
-            contact_number TEXT NOT NULL,
-            preferred_language TEXT DEFAULT 'hindi',
-            status TEXT DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create bookings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ride_id INTEGER NOT NULL,
-            passenger_id INTEGER NOT NULL,
-            quantity INTEGER NOT NULL,
-            total_amount DECIMAL(10,2) NOT NULL,
-            status TEXT DEFAULT 'confirmed',
-            booked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (ride_id) REFERENCES rides (id),
-            FOREIGN KEY (passenger_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create SOS alerts table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sos_alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            latitude REAL,
-            longitude REAL,
-            address TEXT,
-            status TEXT DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Check if we need to add sample data
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]
-    
-    if user_count == 0:
+    conn = connect()
+    migrations.migrate(conn)
+    if conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0:
         print("📝 Adding sample data...")
-        sample_users = [
-            ('Prasad Sharma', 'prasad@example.com', 'password123', '9876543210', 'driver'),
-            ('Siddhesh Patil', 'siddhesh@example.com', 'password123', '9876543211', 'passenger'),
-            ('Admin User', 'admin@yatrasetu.com', 'admin123', '9876543216', 'admin')
-        ]
-        
-        cursor.executemany('''
-            INSERT INTO users (name, email, password, phone, user_type)
-            VALUES (?, ?, ?, ?, ?)
-        ''', sample_users)
-        
-        print("✅ Sample users added!")
-    
-    conn.commit()
+        _add_sample_data(conn)
+        print("✅ Sample data added successfully!")
     conn.close()
     print("🎉 Database initialization complete!")
 
 if __name__ == '__main__':
-    # Delete existing database if it exists
-    if os.path.exists('yatrasetu.db'):
-        os.remove('yatrasetu.db')
+    # python database.py [--reset]: create or migrate the database in place;
+    # --reset deletes it (and its WAL side files) first
+    if '--reset' in sys.argv:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
         print("🗑️ Removed old database")
-    
+
     # Create necessary folders
     os.makedirs('static/uploads', exist_ok=True)
     os.makedirs('invoices', exist_ok=True)
-    
+
     # Initialize database
-    init_db()
\ No newline at end of file
+    init_db()
@@ -0,0 +1,310 @@
+"""Local city gazetteer behind /api/city-suggest.
+
+data/indian_cities.csv is loaded once into a sorted array of folded keys
+(name, aliases and inner words) searched with bisect, so a suggestion is
+a couple of binary searches and never a network call. Folding smooths
+over common transliteration variants (Nashik/Nasik, Kolhapur/Kolapur,
+Visakhapatnam/Vishakhapatnam); a deletion index catches one-letter typos.
+Results are ranked by how many active rides start or end in each city.
+The same file gives every city its coordinates, used to place rides on
+the map when they are posted (locate()).
+"""
+import csv
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import urlencode
+
+import metrics
+import outbound
+from ride_search import city_key
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'indian_cities.csv')
+
+# Match tiers, best first
+NAME, ALIAS, WORD, FUZZY = range(4)
+
+# Typo tolerance (one edit) applies to queries of at least this many
+# letters and looks at no more than the first FUZZY_MAX_LENGTH
+FUZZY_MIN_LENGTH = 3
+FUZZY_MAX_LENGTH = 12
+
+_NON_LETTERS = re.compile(r'[^a-z]')
+_CONSONANT_H = re.compile(r'([^aeiouh])h')
+_DOUBLES = re.compile(r'(.)\1+')
+_LETTER_MAP = str.maketrans({'w': 'v', 'z': 'j', 'q': 'k', 'y': 'i'})
+
+
+def fold(text):
+    """Collapse spellings that sound alike: 'Nashik' and 'Nasik' -> 'nasik'
+
+    Every rule maps a prefix of a word to a prefix of its folded form, so
+    folded prefix search still works while the user is typing.
+    """
+    text = _NON_LETTERS.sub('', text.lower()).translate(_LETTER_MAP)
+    text = _CONSONANT_H.sub(r'\1', text)
+    return _DOUBLES.sub(r'\1', text)
+
+
+def _deletions(text):
+    return {text[:i] + text[i + 1:] for i in range(len(text))}
+
+
+class Gazetteer:
+    REFRESH_SECONDS = 300
+    # Different users posting rides with a name before it is suggested
+    PROMOTE_MIN_USERS = 3
+
+    def __init__(self, cities):
+        # cities: list of (name, state, aliases, (lat, lng) or None), most
+        # populous first
+        self._lock = threading.Lock()
+        self._base = list(cities)
+        self._extra = []
+        self.volumes = {}
+        self.refreshed_at = 0.0
+        self._build(self._base)
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        cities = []
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                aliases = [a.strip() for a in (row.get('aliases') or '').split('|') if a.strip()]
+                try:
+                    point = (float(row['lat']), float(row['lng']))
+                except (KeyError, TypeError, ValueError):
+                    point = None
+                cities.append((row['name'].strip(), row['state'].strip(), aliases, point))
+        return cls(cities)
+
+    def _build(self, cities):
+        labels = []
+        city_of_key = {}
+        entries = []
+        for idx, (name, state, aliases, _) in enumerate(cities):
+            labels.append(f'{name}, {state}, India' if state else name)
+            for alias_idx, variant in enumerate([name] + aliases):
+                city_of_key.setdefault(city_key(variant), idx)
+                entries.append((fold(variant), NAME if alias_idx == 0 else ALIAS, idx))
+                words = re.split(r'[\s-]+', variant)
+                for word in words[1:]:
+                    entries.append((fold(word), WORD, idx))
+        entries = [e for e in entries if e[0]]
+        entries.sort()
+
+        # Deletion neighbourhood of every name/alias prefix: a query one
+        # edit away from a prefix shares at least one variant with it
+        fuzzy = {}
+        for key, tier, idx in entries:
+            if tier == WORD:
+                continue
+            for n in range(FUZZY_MIN_LENGTH, min(len(key), FUZZY_MAX_LENGTH) + 1):
+                prefix = key[:n]
+                for variant in _deletions(prefix) | {prefix}:
+                    fuzzy.setdefault(variant, set()).add(idx)
+        names = [city_key(city[0]) for city in cities]
+
+        # Swap in one assignment so concurrent suggest() calls see either
+        # the old or the new index, never a mix
+        self._index = (
+            cities, labels, names, city_of_key,
+            [e[0] for e in entries], entries, fuzzy,
+        )
+
+    def __len__(self):
+        return len(self._index[0])
+
+    def volumes_stale(self):
+        return time.monotonic() - self.refreshed_at > self.REFRESH_SECONDS
+
+    def refresh_volumes(self, conn):
+        """Recount active rides per city and promote names seen only in rides
+
+        A typed name that is a spelling variant of a gazetteer city counts
+        towards that city. Any other name, with its spelling variants, is
+        only suggested once PROMOTE_MIN_USERS different users post rides
+        from or to it, so one user's typo or made-up name never shows up
+        in everyone's suggestions.
+        """
+        # Another request is already refreshing; keep serving the old counts
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if not self.volumes_stale():
+                return
+            self.refreshed_at = time.monotonic()
+            counts = {}
+            users = {}
+            for column in ('source_key', 'destination_key'):
+                rows = conn.execute(
+                    f"SELECT {column}, user_id, COUNT(*) FROM rides WHERE status = 'active' "
+                    f"GROUP BY {column}, user_id"
+                ).fetchall()
+                for key, user_id, count in rows:
+                    if key:
+                        counts[key] = counts.get(key, 0) + count
+                        users.setdefault(key, set()).add(user_id)
+
+            # Names the gazetteer does not know, grouped by spelling, the
+            # most ridden spelling first
+            unknown = {}
+            for key in sorted(counts, key=lambda key: (-counts[key], key)):
+                idx = self._find_index(key)
+                if (idx is None or idx >= len(self._base)) and fold(key):
+                    unknown.setdefault(fold(key), []).append(key)
+            extra = []
+            for keys in unknown.values():
+                if len(set().union(*(users[key] for key in keys))) >= self.PROMOTE_MIN_USERS:
+                    extra.append((keys[0].title(), '', sorted(keys[1:]), None))
+            extra.sort()
+            if extra != self._extra:
+                self._extra = extra
+                self._build(self._base + extra)
+
+            volumes = {}
+            for key, count in counts.items():
+                idx = self._find_index(key)
+                if idx is not None:
+                    volumes[idx] = volumes.get(idx, 0) + count
+            self.volumes = volumes
+        finally:
+            self._lock.release()
+
+    def _find_index(self, name):
+        # Index of the city with this exact name, alias or spelling
+        # variant, or None
+        _, _, _, city_of_key, keys, entries, _ = self._index
+        idx = city_of_key.get(city_key(name))
+        if idx is None:
+            folded = fold(city_key(name))
+            i = bisect_left(keys, folded)
+            while idx is None and i < len(keys) and keys[i] == folded:
+                if entries[i][1] <= ALIAS:
+                    idx = entries[i][2]
+                i += 1
+        return idx
+
+    def _find(self, name):
+        # (name, state, aliases, point) of that city, or None
+        idx = self._find_index(name)
+        return self._index[0][idx] if idx is not None else None
+
+    def locate(self, name):
+        """(lat, lng) for a city name, alias or spelling variant, or None"""
+        city = self._find(name)
+        return city[3] if city else None
+
+    def canonical(self, name):
+        """The gazetteer's name for a city ('Bombay' -> 'Mumbai'), or None"""
+        city = self._find(name)
+        return city[0] if city else None
+
+    def suggest(self, query, limit=10):
+        """Best matching city labels for a partially typed name"""
+        q = fold(query)
+        if not q:
+            return []
+        cities, labels, names, city_of_key, keys, entries, fuzzy = self._index
+        best = {}
+
+        i = bisect_left(keys, q)
+        while i < len(keys) and keys[i].startswith(q):
+            _, tier, idx = entries[i]
+            if tier < best.get(idx, FUZZY + 1):
+                best[idx] = tier
+            i += 1
+
+        if len(best) < limit and len(q) >= FUZZY_MIN_LENGTH:
+            q = q[:FUZZY_MAX_LENGTH]
+            for variant in _deletions(q) | {q}:
+                for idx in fuzzy.get(variant, ()):
+                    best.setdefault(idx, FUZZY)
+
+        # Within a tier: literal prefix of the name first (so "ch" ranks
+        # Chennai above Coimbatore), then ride volume, then population
+        typed = city_key(query)
+        volumes = self.volumes
+        ranked = sorted(best, key=lambda idx: (
+            best[idx], not names[idx].startswith(typed), -volumes.get(idx, 0), idx
+        ))
+        return [labels[idx] for idx in ranked[:limit]]
+
+
+class TeleportFallback:
+    """Optional upstream lookup for names missing from the gazetteer.
+
+    Lookups run on the shared outbound pool (see outbound.py) and the
+    request waits at most `wait` seconds for them. A slower answer is
+    still cached, so the next keystroke gets it. Results (including empty
+    ones) are cached, identical lookups share one upstream call and at
+    most a few run at once; extra callers get no suggestions instead of
+    waiting.
+    """
+    BASE_URL = 'https://api.teleport.org/api/cities/'
+
+    def __init__(self, enabled=False, max_concurrent=2, timeout=2, wait=0.3, ttl=24 * 3600,
+                 max_entries=1024, http=None):
+        self.enabled = enabled
+        self.timeout = timeout
+        self.wait = wait
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.http = http or outbound.shared
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fetch(self, query):
+        params = urlencode({'search': query, 'limit': 10})
+        with metrics.timed_call('teleport'):
+            resp = self.http.request('GET', f'{self.BASE_URL}?{params}', timeout=self.timeout)
+        if resp.status != 200:
+            return []
+        j = json.loads(resp.body.decode('utf-8'))
+        results = (j.get('_embedded') or {}).get('city:search-results', [])
+        names = [item.get('matching_full_name') for item in results if item.get('matching_full_name')]
+        # deduplicate while preserving order
+        seen = set(); uniq = []
+        for n in names:
+            if n.lower() not in seen:
+                seen.add(n.lower())
+                uniq.append(n)
+        return uniq
+
+    def _lookup(self, key, query):
+        # Runs on an outbound thread; caches whatever comes back
+        ttl = self.ttl
+        try:
+            names = self._fetch(query)
+        except Exception as e:
+            print(f"Teleport lookup failed: {e}")
+            names = []
+            ttl = 60  # retry soon after an upstream failure
+        with self._lock:
+            self._cache[key] = (time.monotonic() + ttl, names)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return names
+
+    def suggest(self, query):
+        if not self.enabled:
+            return []
+        key = fold(query)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                return entry[1]
+        future = self.http.submit(('teleport', key), self._lookup, key, query, slots=self._slots)
+        if future is None:
+            return []
+        try:
+            return future.result(timeout=self.wait)
+        except FutureTimeout:
+            return []
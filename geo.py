@@ -0,0 +1,119 @@
+"""Small geometry helpers and grid indexes for nearby lookups.
+
+Points are bucketed into fixed-size lat/lng cells, so a "within R km"
+query only looks at the few cells around the centre instead of every
+point: GridIndex does this in memory for live positions, and rides store
+the id of their cell (cell_id) in indexed columns for radius search.
+"""
+import math
+import threading
+import time
+
+EARTH_RADIUS_KM = 6371.0
+# Cell size in degrees; about 5.5 km north-south
+CELL_DEGREES = 0.05
+# Cells stored on rides (source_cell / destination_cell), about 11 km
+RIDE_CELL_DEGREES = 0.1
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometres"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def cell_of(lat, lng, size=CELL_DEGREES):
+    return int(math.floor(lat / size)), int(math.floor(lng / size))
+
+
+def _cell_span(lat, radius_km, size):
+    # Cells to search either side of the centre; a degree of longitude
+    # shrinks towards the poles
+    lat_cells = int(math.ceil(radius_km / 111.0 / size))
+    lng_scale = max(math.cos(math.radians(lat)), 0.01)
+    lng_cells = int(math.ceil(radius_km / (111.0 * lng_scale) / size))
+    return lat_cells, lng_cells
+
+
+def bounding_box(lat, lng, radius_km):
+    """(min_lat, max_lat, min_lng, max_lng) enclosing a circle"""
+    dlat = radius_km / 111.0
+    dlng = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+def cell_id(lat, lng):
+    """Integer id of the ride cell containing a point"""
+    row, col = cell_of(lat, lng, RIDE_CELL_DEGREES)
+    return (row + 1000) * 10000 + (col + 2000)
+
+
+def cells_within(lat, lng, radius_km):
+    """Ids of every ride cell that may hold points within radius_km"""
+    lat_cells, lng_cells = _cell_span(lat, radius_km, RIDE_CELL_DEGREES)
+    row, col = cell_of(lat, lng, RIDE_CELL_DEGREES)
+    return [
+        (r + 1000) * 10000 + (c + 2000)
+        for r in range(row - lat_cells, row + lat_cells + 1)
+        for c in range(col - lng_cells, col + lng_cells + 1)
+    ]
+
+
+class GridIndex:
+    """Latest position per key, bucketed by grid cell"""
+
+    def __init__(self, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._cells = {}
+        self._where = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._where)
+
+    def update(self, key, lat, lng, at=None):
+        cell = cell_of(lat, lng, self.cell_degrees)
+        with self._lock:
+            old = self._where.get(key)
+            if old is not None and old[0] != cell:
+                self._discard(key, old[0])
+            self._where[key] = (cell, lat, lng, at if at is not None else time.monotonic())
+            self._cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            old = self._where.pop(key, None)
+            if old is not None:
+                self._discard(key, old[0])
+
+    def _discard(self, key, cell):
+        keys = self._cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+    def nearest(self, lat, lng, limit=5, radius_km=10.0, max_age=None):
+        """[(key, distance_km)] closest first, within radius_km.
+
+        max_age drops positions older than that many seconds.
+        """
+        lat_cells, lng_cells = _cell_span(lat, radius_km, self.cell_degrees)
+        row, col = cell_of(lat, lng, self.cell_degrees)
+        cutoff = time.monotonic() - max_age if max_age else None
+
+        found = []
+        with self._lock:
+            for r in range(row - lat_cells, row + lat_cells + 1):
+                for c in range(col - lng_cells, col + lng_cells + 1):
+                    for key in self._cells.get((r, c), ()):
+                        _, plat, plng, at = self._where[key]
+                        if cutoff is not None and at < cutoff:
+                            continue
+                        distance = haversine_km(lat, lng, plat, plng)
+                        if distance <= radius_km:
+                            found.append((distance, key))
+        found.sort()
+        return [(key, round(distance, 3)) for distance, key in found[:limit]]
@@ -0,0 +1,70 @@
+"""Paginated queries behind My Rides and My Bookings.
+
+Both pages list newest first by id, which an index on the owner column
+returns in order (SQLite appends the rowid to every index entry), so a
+page costs the same for a user with ten rows or ten thousand. Pages
+continue from ?before=<id> of the last row shown.
+
+Rides archived by ride_archive.py, with their bookings, are read from
+the archive tables the same way and merged into each page.
+"""
+
+# idx_rides_user, idx_bookings_ride and idx_bookings_passenger are created
+# by migration step 8 (migrations.py)
+
+PAGE_SIZE = 20
+
+_RIDE_COLUMNS = '''
+    r.id, r.ride_type, r.source_city, r.destination_city, r.departure_time,
+    r.vehicle_type, r.vehicle_number, r.available_capacity, r.price_per_unit,
+    r.status, r.created_at, r.bookings_count, r.seats_booked
+'''
+
+_BOOKING_COLUMNS = '''
+    b.id, b.ride_id, b.quantity, b.total_amount, b.status, b.booked_at,
+    r.ride_type, r.source_city, r.destination_city, r.departure_time,
+    r.vehicle_type, r.vehicle_number, r.contact_number, r.status AS ride_status,
+    u.name AS driver_name, i.digest AS invoice_digest
+'''
+
+
+def _page(conn, parts, params, limit):
+    # Each part (live table, archive) returns its newest limit + 1 rows
+    # from its own index; the merge keeps the newest of those
+    query = ' UNION ALL '.join(f'SELECT * FROM ({part} LIMIT ?)' for part in parts)
+    params = (params + [limit + 1]) * len(parts) + [limit + 1]
+    rows = conn.execute(query + ' ORDER BY id DESC LIMIT ?', params).fetchall()
+    next_before = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_before
+
+
+def ride_history(conn, user_id, before=None, limit=PAGE_SIZE):
+    """One page of rides posted by user_id plus the id to continue before"""
+    query = f'SELECT {_RIDE_COLUMNS} FROM {{rides}} r WHERE r.user_id = ?'
+    params = [user_id]
+    if before:
+        query += ' AND r.id < ?'
+        params.append(before)
+    query += ' ORDER BY r.id DESC'
+    parts = [query.format(rides='rides'), query.format(rides='rides_archive')]
+    return _page(conn, parts, params, limit)
+
+
+def booking_history(conn, passenger_id, before=None, limit=PAGE_SIZE):
+    """One page of bookings made by passenger_id plus the id to continue before"""
+    query = f'''
+        SELECT {_BOOKING_COLUMNS}
+        FROM {{bookings}} b
+        JOIN {{rides}} r ON b.ride_id = r.id
+        JOIN users u ON r.user_id = u.id
+        LEFT JOIN invoice_jobs i ON i.booking_id = b.id
+        WHERE b.passenger_id = ?
+    '''
+    params = [passenger_id]
+    if before:
+        query += ' AND b.id < ?'
+        params.append(before)
+    query += ' ORDER BY b.id DESC'
+    parts = [query.format(bookings='bookings', rides='rides'),
+             query.format(bookings='bookings_archive', rides='rides_archive')]
+    return _page(conn, parts, params, limit)
@@ -0,0 +1,395 @@
+"""Booking invoices, rendered in the background and stored by content.
+
+Every confirmed booking gets a row in invoice_jobs, put there by a
+trigger on bookings so that every write path (single, group commit,
+multi-ride) enqueues one; a change of a booking's status queues its
+invoice again. invoice_jobs is a durable queue like sos_alerts: each
+worker thread of an InvoiceWorkers pool claims up to BATCH_SIZE queued
+jobs with one conditional UPDATE, reads all of their bookings (live or
+archived) in one query and renders them with a template loaded once per
+thread. Claims of a worker that died are requeued, failed batches are
+retried with backoff. Bookings made before the queue existed have no
+job; booking_invoice queues one the first time their invoice is asked
+for.
+
+Invoices are HTML with print styles, written once to
+INVOICE_DIR/<aa>/<sha256 of the bytes>.html and served from there; the
+digest is kept on the job, so an invoice rendered again with the same
+content reuses its file, and it doubles as the ETag.
+
+    python invoices.py --month 2024-05 [--processes N] [db path]
+
+renders every invoice of bookings made in that month again, across N
+processes (default: one per CPU), e.g. after the template has changed
+or to render a past month's invoices ahead of time.
+--prune deletes stored files no job refers to any more.
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import database
+
+# invoice_jobs and the triggers on bookings that fill it are created by
+# migration step 12 (migrations.py)
+
+INVOICE_DIR = os.environ.get('INVOICE_DIR', 'invoices')
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+TEMPLATE = 'invoice.html'
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 5
+# A claim older than this belonged to a worker that died mid-batch
+CLAIM_TIMEOUT_SECONDS = 300
+POLL_SECONDS = 30
+# Woken workers wait this long first, so a burst of bookings makes a few
+# full batches instead of many small ones competing with requests
+BATCH_DELAY_SECONDS = 2
+# Bookings per task of a month's regeneration
+CHUNK_SIZE = 500
+# Files younger than this may belong to a render whose digest is not saved yet
+PRUNE_MIN_AGE_SECONDS = 3600
+
+_INVOICE_COLUMNS = '''
+    b.id, b.ride_id, b.quantity, b.total_amount, b.status, b.booked_at,
+    p.name AS passenger_name, p.email AS passenger_email, p.phone AS passenger_phone,
+    r.ride_type, r.source_city, r.destination_city, r.departure_time, r.arrival_time,
+    r.vehicle_type, r.vehicle_number, r.price_per_unit, d.name AS driver_name
+'''
+
+
+def path_of(digest, directory=None):
+    return os.path.join(directory or INVOICE_DIR, digest[:2], digest + '.html')
+
+
+def enqueue(conn, booking_ids):
+    """Queue invoices of booking_ids (again); the caller commits"""
+    conn.executemany('''
+        INSERT INTO invoice_jobs (booking_id) VALUES (?)
+        ON CONFLICT (booking_id) DO UPDATE SET status = 'queued', attempts = 0, retry_at = NULL
+        WHERE status != 'rendering'
+    ''', [(booking_id,) for booking_id in booking_ids])
+
+
+def lookup(conn, booking_id, passenger_id=None):
+    """booking_id with its job's status and digest; None unless passenger_id booked it
+
+    passenger_id None (admins) finds any booking.
+    """
+    return conn.execute('''
+        SELECT b.id, b.status AS booking_status, j.status, j.digest
+        FROM (SELECT id, passenger_id, status FROM bookings WHERE id = ?
+              UNION ALL
+              SELECT id, passenger_id, status FROM bookings_archive WHERE id = ?) b
+        LEFT JOIN invoice_jobs j ON j.booking_id = b.id
+        WHERE ? IS NULL OR b.passenger_id = ?
+    ''', (booking_id, booking_id, passenger_id, passenger_id)).fetchone()
+
+
+class Renderer:
+    """Renders batches of invoices into directory with one loaded template"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or INVOICE_DIR
+        env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+        self.template = env.get_template(TEMPLATE)
+
+    def bookings(self, conn, booking_ids):
+        placeholders = ', '.join('?' * len(booking_ids))
+        query = f'''
+            SELECT {_INVOICE_COLUMNS}
+            FROM {{bookings}} b
+            JOIN {{rides}} r ON b.ride_id = r.id
+            LEFT JOIN users p ON b.passenger_id = p.id
+            LEFT JOIN users d ON r.user_id = d.id
+            WHERE b.id IN ({placeholders})
+        '''
+        return conn.execute(
+            query.format(bookings='bookings', rides='rides') + ' UNION ALL '
+            + query.format(bookings='bookings_archive', rides='rides_archive'),
+            list(booking_ids) * 2
+        ).fetchall()
+
+    def render(self, booking):
+        return self.template.render(
+            booking=booking,
+            number=f"YS-{(booking['booked_at'] or '')[:7].replace('-', '')}-{booking['id']:06d}",
+            unit='kg' if booking['ride_type'] == 'logistics' else 'seat',
+        ).encode()
+
+    def store(self, body):
+        """Write body under its digest unless it is there already; returns (digest, written)"""
+        digest = hashlib.sha256(body).hexdigest()
+        path = path_of(digest, self.directory)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers never see a half-written file
+        partial = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(partial, 'wb') as f:
+            f.write(body)
+        os.replace(partial, path)
+        return digest, True
+
+    def render_batch(self, conn, booking_ids):
+        """{booking id: digest} of booking_ids found, and how many files were new"""
+        digests, written = {}, 0
+        for booking in self.bookings(conn, booking_ids):
+            digest, new = self.store(self.render(booking))
+            digests[booking['id']] = digest
+            written += new
+        return digests, written
+
+
+class InvoiceWorkers:
+    """A bounded pool of threads rendering the invoice_jobs queue"""
+
+    def __init__(self, workers=2, batch_size=BATCH_SIZE, directory=None, poll_seconds=POLL_SECONDS,
+                 batch_delay=BATCH_DELAY_SECONDS):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.directory = directory or INVOICE_DIR
+        self.poll_seconds = poll_seconds
+        self.batch_delay = batch_delay
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.batches = 0
+        self.rendered = 0
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+        self.errors = 0
+        self.last_batch_ms = None
+
+    def start(self):
+        """Start this process's worker threads if they are not running yet"""
+        if self._pid != os.getpid():
+            self._ensure_workers()
+
+    def wake(self):
+        """New jobs were queued; start rendering them now instead of at the next poll"""
+        self._ensure_workers()
+        self._wake.set()
+
+    def _ensure_workers(self):
+        # One pool per process, started lazily so it survives fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._wake = threading.Event()
+                for n in range(self.workers):
+                    threading.Thread(target=self._run, name=f'invoice-worker-{n}', daemon=True).start()
+
+    def _run(self):
+        conn = database.checkout()
+        renderer = Renderer(self.directory)
+        while True:
+            try:
+                jobs = self._claim(conn)
+                if jobs:
+                    self._render(conn, renderer, jobs)
+            except Exception as e:
+                # Claimed jobs are requeued after CLAIM_TIMEOUT_SECONDS
+                with self._lock:
+                    self.errors += 1
+                print(f"Invoice worker error: {e}")
+                if conn.in_transaction:
+                    conn.rollback()
+                jobs = {}
+            if not jobs:
+                if self._wake.wait(self.poll_seconds):
+                    time.sleep(self.batch_delay)
+                self._wake.clear()
+
+    def _claim(self, conn):
+        # Requeue batches whose worker died, then take the oldest queued
+        # jobs. The WHERE is re-checked under the write lock, so two
+        # workers never claim the same job.
+        conn.execute(f'''
+            UPDATE invoice_jobs SET status = 'queued'
+            WHERE status = 'rendering'
+              AND claimed_at < datetime('now', '-{CLAIM_TIMEOUT_SECONDS} seconds')
+        ''')
+        rows = conn.execute('''
+            UPDATE invoice_jobs
+            SET status = 'rendering', claimed_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE booking_id IN (SELECT booking_id FROM invoice_jobs
+                                 WHERE status = 'queued'
+                                   AND (retry_at IS NULL OR retry_at <= CURRENT_TIMESTAMP)
+                                 ORDER BY booking_id LIMIT ?)
+              AND status = 'queued'
+            RETURNING booking_id, attempts
+        ''', (self.batch_size,)).fetchall()
+        conn.commit()
+        return {row['booking_id']: row['attempts'] for row in rows}
+
+    def _render(self, conn, renderer, jobs):
+        started = time.perf_counter()
+        try:
+            digests, written = renderer.render_batch(conn, list(jobs))
+            error = None
+        except Exception as e:
+            digests, written, error = {}, 0, str(e)
+            print(f"Invoice batch of {len(jobs)} failed: {e}")
+        missing = [booking_id for booking_id in jobs if booking_id not in digests]
+        # Only jobs still claimed are finished; one whose booking changed
+        # meanwhile was queued again by the trigger and is rendered again
+        conn.executemany('''
+            UPDATE invoice_jobs
+            SET status = 'done', digest = ?, rendered_at = CURRENT_TIMESTAMP,
+                last_error = NULL, retry_at = NULL
+            WHERE booking_id = ? AND status = 'rendering'
+        ''', [(digest, booking_id) for booking_id, digest in digests.items()])
+        retried = failed = 0
+        for booking_id in missing:
+            attempts = jobs[booking_id]
+            if error is None or attempts >= MAX_ATTEMPTS:
+                outcome = 'failed'
+                failed += 1
+            else:
+                outcome = 'queued'
+                retried += 1
+            backoff = min(2 ** attempts * 10, 600)
+            conn.execute(f'''
+                UPDATE invoice_jobs
+                SET status = ?, last_error = ?,
+                    retry_at = CASE WHEN ? = 'queued' THEN datetime('now', '+{backoff} seconds') END
+                WHERE booking_id = ? AND status = 'rendering'
+            ''', (outcome, error or 'Booking not found', outcome, booking_id))
+        conn.commit()
+        with self._lock:
+            self.batches += 1
+            self.rendered += len(digests)
+            self.written += written
+            self.retried += retried
+            self.failed += failed
+            self.last_batch_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'batch_size': self.batch_size,
+                'batches': self.batches,
+                'rendered': self.rendered,
+                'written': self.written,
+                'retried': self.retried,
+                'failed': self.failed,
+                'errors': self.errors,
+                'last_batch_ms': self.last_batch_ms,
+            }
+
+
+def month_bookings(conn, month):
+    """Ids of bookings made in month (YYYY-MM) that have or should have an invoice"""
+    start = datetime.strptime(month, '%Y-%m')
+    end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    query = '''
+        SELECT id FROM {bookings}
+        WHERE booked_at >= ? AND booked_at < ?
+          AND (status IN ('confirmed', 'completed')
+               OR id IN (SELECT booking_id FROM invoice_jobs))
+    '''
+    params = (start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+    return [row[0] for row in conn.execute(
+        query.format(bookings='bookings') + ' UNION ALL ' + query.format(bookings='bookings_archive')
+        + ' ORDER BY id', params * 2)]
+
+
+# Each process of a month's regeneration has its own connection and template
+_process = {}
+
+
+def _start_process(db_path, directory):
+    _process['conn'] = database.connect(db_path)
+    _process['renderer'] = Renderer(directory)
+
+
+def _render_chunk(booking_ids):
+    return _process['renderer'].render_batch(_process['conn'], booking_ids)
+
+
+def regenerate_month(conn, month, processes=None, directory=None):
+    """Render every invoice of month again across processes; returns counts"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    ids = month_bookings(conn, month)
+    chunks = [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+    processes = processes or os.cpu_count() or 1
+    db_path = conn.execute('PRAGMA database_list').fetchone()[2]
+    if processes == 1 or len(chunks) < 2:
+        renderer = Renderer(directory)
+        results = (renderer.render_batch(conn, chunk) for chunk in chunks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(min(processes, len(chunks)), initializer=_start_process,
+                                   initargs=(db_path, directory))
+        results = pool.map(_render_chunk, chunks)
+    rendered = written = 0
+    try:
+        # Saved chunk by chunk, so the app's writers never wait long
+        for digests, new in results:
+            conn.executemany('''
+                INSERT INTO invoice_jobs (booking_id, status, digest, rendered_at)
+                VALUES (?, 'done', ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (booking_id) DO UPDATE SET
+                    status = 'done', digest = excluded.digest, rendered_at = excluded.rendered_at,
+                    attempts = 0, retry_at = NULL, last_error = NULL
+            ''', list(digests.items()))
+            conn.commit()
+            rendered += len(digests)
+            written += new
+    finally:
+        if pool:
+            pool.shutdown()
+    return {'bookings': len(ids), 'rendered': rendered, 'written': written,
+            'processes': 1 if pool is None else min(processes, len(chunks))}
+
+
+def prune(conn, directory=None):
+    """Delete stored invoices no job refers to; returns how many"""
+    directory = directory or INVOICE_DIR
+    if not os.path.isdir(directory):
+        return 0
+    kept = {row[0] for row in conn.execute('SELECT digest FROM invoice_jobs WHERE digest IS NOT NULL')}
+    cutoff = time.time() - PRUNE_MIN_AGE_SECONDS
+    removed = 0
+    for folder in os.scandir(directory):
+        if not folder.is_dir():
+            continue
+        for entry in os.scandir(folder.path):
+            digest, extension = os.path.splitext(entry.name)
+            if extension == '.html' and digest not in kept and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    import migrations
+
+    parser = argparse.ArgumentParser(description='Render booking invoices again, or prune unused files')
+    parser.add_argument('db', nargs='?')
+    parser.add_argument('--month', help='YYYY-MM: bookings made in this month')
+    parser.add_argument('--processes', type=int, help='default: one per CPU')
+    parser.add_argument('--prune', action='store_true')
+    args = parser.parse_args()
+    if not args.month and not args.prune:
+        parser.error('nothing to do: give --month and/or --prune')
+
+    conn = database.connect(args.db)
+    migrations.migrate(conn)
+    if args.month:
+        started = time.perf_counter()
+        done = regenerate_month(conn, args.month, args.processes)
+        print(f"✅ Rendered {done['rendered']} of {done['bookings']} invoices for {args.month} "
+              f"({done['written']} new files, {done['processes']} processes, "
+              f"{time.perf_counter() - started:.1f}s)")
+    if args.prune:
+        print(f"✅ Removed {prune(conn)} unused invoice files")
@@ -0,0 +1,276 @@
+"""Multi-leg trips over posted rides, for routes with no direct ride.
+
+Every active ride is a connection from its source city to its
+destination city. The index keeps them in one list sorted by departure,
+so planning a trip is a single forward scan over the rides leaving in
+the search window (a connection scan): a ride can be taken if its source
+is the origin, or if an earlier ride reached its source at least the
+minimum connection time before it leaves. Walking each scan with up to
+three legs gives the earliest arrival and the cheapest fare with at
+most two transfers.
+
+Rides without an arrival_time get one estimated from the distance
+between their end points; rides that cannot be placed are skipped.
+Posting and booking update the index one ride at a time. Other gunicorn
+workers' writes are picked up by a periodic reload; /api/book-rides
+re-checks seats anyway, so a stale index only costs a failed booking.
+"""
+import heapq
+import math
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import database
+
+
+MAX_TRANSFERS = 2
+# Minutes between arriving on one ride and leaving on the next
+MIN_CONNECTION_MINUTES = 30
+# How far past the requested start rides are considered
+SEARCH_HOURS = 36
+# Estimated arrival: road distance is about 1.3x straight line at 45 km/h
+ROAD_FACTOR = 1.3
+AVERAGE_SPEED_KMH = 45.0
+KM_PER_DEGREE = 111.2
+
+_EPOCH = datetime(2000, 1, 1)
+
+Connection = namedtuple('Connection', 'depart arrive source destination ride_id price seats ride_type')
+
+# Times come back as minutes since 2000-01-01; julianday() reads both the
+# '2024-01-20 08:00:00' and '2024-01-20T08:00' formats we store
+_MINUTES = "CAST(ROUND((julianday({}) - 2451544.5) * 1440) AS INTEGER)"
+_COLUMNS = f'''
+    id, ride_type, source_key, destination_key,
+    {_MINUTES.format('departure_time')}, {_MINUTES.format('arrival_time')},
+    available_capacity, price_per_unit, source_lat, source_lng, destination_lat, destination_lng
+'''
+
+
+def to_minutes(value):
+    """Minutes since 2000-01-01 for a stored or ISO timestamp, or None"""
+    try:
+        moment = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    return int((moment - _EPOCH).total_seconds() // 60)
+
+
+def from_minutes(minutes):
+    return (_EPOCH + timedelta(minutes=minutes)).strftime('%Y-%m-%d %H:%M')
+
+
+def _connection(row):
+    (ride_id, ride_type, source, destination, depart, arrive, seats, price,
+     slat, slng, dlat, dlng) = row[:12]
+    if depart is None or not source or not destination or source == destination:
+        return None
+    if arrive is None or arrive <= depart:
+        if slat is None or dlat is None:
+            return None
+        # Flat-earth distance is plenty for an arrival estimate and much
+        # cheaper than haversine over every ride on a reload
+        dx = (dlng - slng) * math.cos(math.radians((slat + dlat) / 2))
+        km = math.hypot(dx, dlat - slat) * KM_PER_DEGREE * ROAD_FACTOR
+        arrive = depart + max(1, int(km / AVERAGE_SPEED_KMH * 60))
+    return Connection(depart, arrive, source, destination, ride_id, price or 0, seats, ride_type)
+
+
+def _rows(conn, query, params=()):
+    # Plain tuples: building sqlite3.Row objects dominates a full reload
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor.execute(query, params).fetchall()
+
+
+class ConnectionIndex:
+    REFRESH_SECONDS = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (departure minutes, connections, ride id -> connection), sorted
+        # together; replaced, never mutated, so a scan in progress keeps a
+        # consistent list
+        self._snapshot = ([], [], {})
+        self.loaded_at = None
+        self._reloading = None
+        self._changed_while_reloading = set()
+        self.reloads = 0
+        self.updates = 0
+
+    def __len__(self):
+        return len(self._snapshot[1])
+
+    def stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.REFRESH_SECONDS
+
+    def invalidate(self):
+        """Reload soon (e.g. after a bulk import)"""
+        if self.loaded_at is not None:
+            self.loaded_at = 0.0
+
+    def refresh(self, conn):
+        """Make sure the index is loaded; stale ones reload in the background.
+
+        Only the very first load makes the caller wait. After that a
+        reload runs on its own thread and connection while plans keep
+        using the current list.
+        """
+        if not self.stale():
+            return
+        if self.loaded_at is None:
+            with self._lock:
+                if self.loaded_at is None:
+                    self._load(conn)
+            return
+        with self._lock:
+            if self._reloading is not None and self._reloading.is_alive():
+                return
+            self._changed_while_reloading = set()
+            self._reloading = threading.Thread(target=self._reload, name='itinerary-reload', daemon=True)
+            self._reloading.start()
+
+    def _reload(self):
+        conn = database.connect()
+        try:
+            with self._lock:
+                self._load(conn)
+                # Posts and bookings that raced the reload may be missing
+                changed, self._changed_while_reloading = self._changed_while_reloading, set()
+            if changed:
+                self.ride_changed(conn, changed)
+        except sqlite3.Error as e:
+            print(f"Itinerary index reload failed: {e}")
+        finally:
+            conn.close()
+
+    def _load(self, conn):
+        # Caller holds self._lock
+        rows = _rows(conn, f"SELECT {_COLUMNS} FROM rides WHERE status = 'active'")
+        connections = sorted(c for c in map(_connection, rows) if c is not None)
+        self._snapshot = ([c.depart for c in connections], connections,
+                          {c.ride_id: c for c in connections})
+        self.loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def ride_changed(self, conn, ride_ids):
+        """Re-read rides that were posted, booked or closed"""
+        if self.loaded_at is None:
+            return
+        ride_ids = list(ride_ids)
+        rows = _rows(
+            conn, f"SELECT {_COLUMNS}, status FROM rides WHERE id IN ({', '.join('?' * len(ride_ids))})",
+            ride_ids
+        )
+        with self._lock:
+            times, connections, by_ride = (list(self._snapshot[0]), list(self._snapshot[1]),
+                                           dict(self._snapshot[2]))
+            for ride_id in ride_ids:
+                old = by_ride.pop(ride_id, None)
+                if old is not None:
+                    at = bisect_left(connections, old)
+                    del connections[at], times[at]
+            for row in rows:
+                connection = _connection(row) if row[12] == 'active' else None
+                if connection is not None:
+                    at = bisect_right(connections, connection)
+                    connections.insert(at, connection)
+                    times.insert(at, connection.depart)
+                    by_ride[connection.ride_id] = connection
+            self._snapshot = (times, connections, by_ride)
+            if self._reloading is not None and self._reloading.is_alive():
+                self._changed_while_reloading.update(ride_ids)
+            self.updates += 1
+
+    def plan(self, source, destination, start, seats=1, max_transfers=MAX_TRANSFERS,
+             min_connection=MIN_CONNECTION_MINUTES, horizon_hours=SEARCH_HOURS, ride_types=None):
+        """Earliest-arriving and cheapest trips from source to destination (city keys).
+
+        start is in minutes (see to_minutes). Returns {'earliest': trip,
+        'cheapest': trip}, either None when nothing connects; a trip is
+        {'legs': [Connection, ...], 'depart', 'arrive', 'total_amount'}.
+        """
+        times, connections, _ = self._snapshot
+        max_legs = max_transfers + 1
+        lo = bisect_left(times, start)
+        hi = bisect_right(times, start + horizon_hours * 60)
+
+        # Per number of legs used: city -> (arrival, label) of the earliest
+        # way to be there; labels are (connection, previous label) chains
+        earliest = [{} for _ in range(max_legs + 1)]
+        # Cheapest: arrivals wait in a heap until their connection time has
+        # passed, then the lowest fare is "available" at that city
+        pending = [{} for _ in range(max_legs + 1)]
+        available = [{} for _ in range(max_legs + 1)]
+        best_arrival = best_fare = None
+
+        for c in connections[lo:hi]:
+            if c.seats < seats or (ride_types and c.ride_type not in ride_types):
+                continue
+            if c.destination == source or c.source == destination:
+                continue
+            fare = c.price * seats
+            for legs in range(1, max_legs + 1):
+                if legs == 1:
+                    if c.source != source:
+                        continue
+                    reached = (c, None)
+                    cheapest = (fare, c.arrive, reached)
+                else:
+                    before = earliest[legs - 1].get(c.source)
+                    if before is None or before[0] + min_connection > c.depart:
+                        continue
+                    reached = (c, before[1])
+                    waiting = pending[legs - 1].get(c.source)
+                    while waiting and waiting[0][0] <= c.depart:
+                        _, cost, arrive, _, label = heapq.heappop(waiting)
+                        current = available[legs - 1].get(c.source)
+                        if current is None or (cost, arrive) < current[:2]:
+                            available[legs - 1][c.source] = (cost, arrive, label)
+                    cost, _, label = available[legs - 1][c.source]
+                    cheapest = (cost + fare, c.arrive, (c, label))
+
+                if c.destination == destination:
+                    if best_arrival is None or (c.arrive, legs) < best_arrival[:2]:
+                        best_arrival = (c.arrive, legs, reached)
+                    if best_fare is None or cheapest[:2] < best_fare[:2]:
+                        best_fare = cheapest
+                    continue
+                if legs == max_legs:
+                    continue
+                current = earliest[legs].get(c.destination)
+                if current is None or c.arrive < current[0]:
+                    earliest[legs][c.destination] = (c.arrive, reached)
+                heapq.heappush(pending[legs].setdefault(c.destination, []),
+                               (c.arrive + min_connection, cheapest[0], c.arrive, c.ride_id, cheapest[2]))
+
+        return {
+            'earliest': _trip(best_arrival[2], seats) if best_arrival else None,
+            'cheapest': _trip(best_fare[2], seats) if best_fare else None,
+        }
+
+    def stats(self):
+        return {
+            'connections': len(self),
+            'reloads': self.reloads,
+            'updates': self.updates,
+            'age_seconds': round(time.monotonic() - self.loaded_at, 1) if self.loaded_at else None,
+        }
+
+
+def _trip(label, seats):
+    legs = []
+    while label is not None:
+        legs.append(label[0])
+        label = label[1]
+    legs.reverse()
+    return {
+        'legs': legs,
+        'depart': legs[0].depart,
+        'arrive': legs[-1].arrive,
+        'total_amount': sum(leg.price for leg in legs) * seats,
+    }
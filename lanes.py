@@ -0,0 +1,219 @@
+"""Admission control that keeps worker threads free for urgent requests.
+
+Every request belongs to a lane (app.ENDPOINT_LANES maps endpoints to
+them; see LANES for the limits):
+
+- priority (SOS) is never limited or queued, and neither are static
+  files: turning a page's CSS or scripts away while streams hold slots
+  would break the page.
+- Every other request must take a slot from a pool sized to the
+  worker's threads minus a reserve. When the pool is full it is turned
+  away with a 503 at once: a request waiting for a slot would already
+  hold a thread, and enough of them would take the reserve's threads.
+- Booking writes may also take a reserved slot, all but the last one,
+  which only SOS can use.
+- Each client (user, or IP before login) has a token bucket per lane,
+  and chat and city suggestions one per lane for the whole worker too.
+  Requests without a client (an address shared by everyone behind a
+  proxy; see app.PROXY_HOPS) skip the per-client buckets.
+  An empty bucket answers 429 at once, with Retry-After set to when a
+  token will be back.
+- A lane may hold at most max_share of the pool at once. Past that its
+  requests are also turned away at once, with full_status (429 unless
+  set), so a burst of chat or suggestions cannot use up the worker.
+- Location streams hold their slot for as long as they stay open, so
+  they count against the pool like any other request; their lane's
+  share answers 503, which sends tracking pages back to polling.
+
+Every other request holds a slot while it runs, so with capacity equal
+to the server's threads per worker (gunicorn --threads) at most
+capacity - 1 threads are ever busy with anything but SOS and static
+files, and a flood of searches cannot hold up a booking or an alert.
+What the gate cannot bound is the server's own queue in front of it and
+static files: an SOS that arrives behind a flood waits for the requests
+ahead of it to be turned away or served from disk, which takes well
+under a millisecond each.
+
+ADMISSION_LIMITS=0 (for load tests from one client) turns the buckets
+and lane shares off; the pool and the reserve stay.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# rate is tokens per second and burst the bucket size, per client;
+# route_rate / route_burst is a bucket shared by every client of the lane.
+# max_share caps the lane's part of the general pool; past it requests
+# are answered with full_status.
+Lane = namedtuple('Lane', 'rate burst route_rate route_burst max_share reserved priority full_status',
+                  defaults=(None, None, None, None, None, False, False, 429))
+
+LANES = {
+    'priority': Lane(priority=True),
+    'booking': Lane(rate=1, burst=5, reserved=True),
+    'chat': Lane(rate=1, burst=5, route_rate=20, route_burst=40, max_share=0.25),
+    'suggest': Lane(rate=5, burst=20, route_rate=100, route_burst=200, max_share=0.25),
+    'search': Lane(rate=5, burst=20, max_share=0.5),
+    'stream': Lane(rate=1, burst=10, max_share=0.5, full_status=503),
+    'general': Lane(rate=20, burst=60),
+    # Static files: served without a slot, like SOS
+    'static': Lane(priority=True),
+}
+# Clients remembered per lane; the least recently seen start again full
+MAX_CLIENTS = 10000
+
+
+class Shed(Exception):
+    """A request turned away; answer with status and Retry-After seconds"""
+
+    def __init__(self, status, retry_after, reason):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled at rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst, max_keys=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> [tokens, monotonic time]
+
+    def take(self, key, now):
+        """0 if key had a token, else seconds until it will (caller holds a lock)"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LaneGate:
+    def __init__(self, capacity=8, reserved=1, lanes=None, limits=True):
+        self.capacity = capacity
+        self.reserved = max(0, min(reserved, capacity - 1))
+        self.limits = limits
+        self.lanes = dict(lanes or LANES)
+        general = capacity - self.reserved
+        self._general = threading.BoundedSemaphore(general)
+        # The last reserved slot is left to the priority lane
+        self._reserved = threading.BoundedSemaphore(max(self.reserved - 1, 0))
+        self._lock = threading.Lock()
+        self._caps = {name: max(1, round(general * lane.max_share))
+                      for name, lane in self.lanes.items() if lane.max_share}
+        self._clients = {name: TokenBuckets(lane.rate, lane.burst)
+                         for name, lane in self.lanes.items() if lane.rate}
+        self._routes = {name: TokenBuckets(lane.route_rate, lane.route_burst, max_keys=1)
+                        for name, lane in self.lanes.items() if lane.route_rate}
+        self._in_flight = dict.fromkeys(self.lanes, 0)
+        self._admitted = dict.fromkeys(self.lanes, 0)
+        self._shed = {}                 # (lane, reason) -> requests
+        self.in_flight = 0
+        self.admitted = 0
+        self.priority = 0
+        self.reserved_used = 0
+        self.shed = 0
+
+    def _turn_away(self, lane, status, retry_after, reason):
+        # Caller holds self._lock
+        self._shed[lane, reason] = self._shed.get((lane, reason), 0) + 1
+        self.shed += 1
+        return Shed(status, max(1, math.ceil(retry_after)), reason)
+
+    def admit(self, lane, client):
+        """Admit a request of lane from client; returns the slot to release().
+
+        client None skips the per-client bucket. Raises Shed when it is
+        turned away.
+        """
+        settings = self.lanes[lane]
+        if settings.priority:
+            with self._lock:
+                self.priority += 1
+                self._admitted[lane] += 1
+            return None
+        with self._lock:
+            if self.limits:
+                now = time.monotonic()
+                buckets = self._clients.get(lane)
+                wait = buckets.take(client, now) if buckets is not None and client is not None else 0
+                if not wait and lane in self._routes:
+                    wait = self._routes[lane].take(None, now)
+                if wait:
+                    raise self._turn_away(lane, 429, wait, 'rate_limited')
+                if lane in self._caps and self._in_flight[lane] >= self._caps[lane]:
+                    raise self._turn_away(lane, settings.full_status, 1, 'lane_full')
+            if self._general.acquire(blocking=False):
+                slot = 'general'
+            elif settings.reserved and self._reserved.acquire(blocking=False):
+                slot = 'reserved'
+            else:
+                raise self._turn_away(lane, 503, 1, 'busy')
+            self._in_flight[lane] += 1
+            self.in_flight += 1
+            self.admitted += 1
+            self._admitted[lane] += 1
+            self.reserved_used += slot == 'reserved'
+        return slot
+
+    def release(self, lane, slot):
+        if slot is None:
+            return
+        with self._lock:
+            self.in_flight -= 1
+            self._in_flight[lane] -= 1
+        (self._reserved if slot == 'reserved' else self._general).release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'reserved': self.reserved,
+                'in_flight': self.in_flight,
+                'admitted': self.admitted,
+                'priority': self.priority,
+                'reserved_used': self.reserved_used,
+                'shed': self.shed,
+                'limits': self.limits,
+                'lanes': {
+                    name: {
+                        'in_flight': self._in_flight[name],
+                        'admitted': self._admitted[name],
+                        'max_concurrent': self._caps.get(name),
+                        'clients': len(self._clients[name]) if name in self._clients else None,
+                        'shed': {reason: count for (lane, reason), count in self._shed.items()
+                                 if lane == name},
+                    }
+                    for name in self.lanes
+                },
+            }
+
+    def collect(self):
+        """Per-lane gauges and shed counts for /metrics (see metrics.register_collector)"""
+        with self._lock:
+            in_flight = dict(self._in_flight)
+            admitted = dict(self._admitted)
+            shed = dict(self._shed)
+        return [
+            ('yatrasetu_lane_in_flight', 'gauge', 'Requests holding a slot, by lane',
+             [({'lane': lane}, value) for lane, value in sorted(in_flight.items())]),
+            ('yatrasetu_lane_admitted_total', 'counter', 'Requests admitted, by lane',
+             [({'lane': lane}, value) for lane, value in sorted(admitted.items())]),
+            ('yatrasetu_lane_shed_total', 'counter', 'Requests turned away, by lane and reason',
+             [({'lane': lane, 'reason': reason}, value) for (lane, reason), value in sorted(shed.items())]),
+        ]
@@ -0,0 +1,197 @@
+"""Live driver locations for ride tracking.
+
+Drivers post positions to /api/ride/<id>/location; passengers follow them
+over a Server-Sent Events stream instead of polling. Each ride has one
+channel holding the last few points in a ring buffer with sequence
+numbers. Publishing appends a point and wakes every subscriber of that
+ride at once; each subscriber then reads what it has not seen yet from
+the shared buffer, so an update costs one append however many passengers
+are watching, and no subscriber ever touches the database.
+
+Channels live in process memory: a position posted to one worker process
+never reaches a stream, a poll or the SOS nearest-driver lookup in
+another. Host the app as a single threaded worker process (gunicorn -w 1
+-k gthread --threads N) or route a ride's driver and passengers to the
+same worker.
+
+Each open stream holds one worker thread, and with it a slot of the
+request gate in the 'stream' lane (see lanes.py), which caps streams at
+half of the worker's general slots. A stream ends after STREAM_SECONDS
+and the browser reconnects through the gate again.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+from geo import GridIndex
+
+# Points kept per ride for late joiners and slow readers
+HISTORY_SIZE = 30
+# Seconds between keepalive comments on an idle stream
+KEEPALIVE_SECONDS = 15
+# Channels with no subscribers and no update for this long are dropped
+IDLE_SECONDS = 3600
+# Longest a stream stays open before the client has to reconnect
+STREAM_SECONDS = 300
+# Positions older than this are not offered as "nearby"
+NEARBY_MAX_AGE = 600
+
+
+def parse_location(data):
+    """Validate a posted location; returns the point dict or raises ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError('Location must be an object')
+    try:
+        lat = float(data['lat'])
+        lng = float(data['lng'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('lat and lng are required numbers')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('lat/lng out of range')
+    point = {'lat': round(lat, 6), 'lng': round(lng, 6)}
+    for field in ('speed', 'heading', 'accuracy'):
+        if data.get(field) is not None:
+            try:
+                point[field] = round(float(data[field]), 2)
+            except (TypeError, ValueError):
+                raise ValueError(f'{field} must be a number')
+    return point
+
+
+class RideChannel:
+    """Ring buffer of recent points for one ride plus its waiting readers"""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.points = deque(maxlen=size)
+        self.seq = 0
+        self.status = None
+        self.subscribers = 0
+        self.updated_at = time.monotonic()
+        self.changed = threading.Condition()
+
+    def publish(self, point=None, status=None):
+        with self.changed:
+            self.seq += 1
+            if point is not None:
+                self.points.append((self.seq, point))
+            if status is not None:
+                self.status = status
+            self.updated_at = time.monotonic()
+            self.changed.notify_all()
+            return self.subscribers
+
+    def since(self, seq):
+        """Points newer than seq (oldest first); caller holds self.changed"""
+        return [p for s, p in self.points if s > seq]
+
+    def wait(self, seq, timeout):
+        """Block until something newer than seq is published or timeout.
+
+        Returns (latest seq, new points, status).
+        """
+        with self.changed:
+            if self.seq <= seq:
+                self.changed.wait(timeout)
+            return self.seq, self.since(seq), self.status
+
+
+class LocationHub:
+    def __init__(self, history=HISTORY_SIZE):
+        self.history = history
+        self._channels = {}
+        self._lock = threading.Lock()
+        # Latest position of every ride, for nearest-driver lookups
+        self.positions = GridIndex()
+        self.published = 0
+        self.delivered = 0
+        self.streams_opened = 0
+
+    def channel(self, ride_id):
+        with self._lock:
+            channel = self._channels.get(ride_id)
+            if channel is None:
+                self._prune()
+                channel = self._channels[ride_id] = RideChannel(self.history)
+            return channel
+
+    def _prune(self):
+        cutoff = time.monotonic() - IDLE_SECONDS
+        idle = [ride_id for ride_id, c in self._channels.items()
+                if not c.subscribers and c.updated_at < cutoff]
+        for ride_id in idle:
+            del self._channels[ride_id]
+            self.positions.remove(ride_id)
+
+    def publish(self, ride_id, point=None, status=None):
+        """Record a point and/or ride status; returns the number of listeners"""
+        listeners = self.channel(ride_id).publish(point, status)
+        if point is not None:
+            self.positions.update(ride_id, point['lat'], point['lng'])
+        self.published += 1
+        self.delivered += listeners
+        return listeners
+
+    def nearby(self, lat, lng, limit=5, radius_km=10.0, max_age=NEARBY_MAX_AGE):
+        """[(ride_id, distance_km)] of rides recently reported near a point"""
+        return self.positions.nearest(lat, lng, limit, radius_km, max_age)
+
+    def latest(self, ride_id):
+        with self._lock:
+            channel = self._channels.get(ride_id)
+        if channel is None:
+            return None, None
+        with channel.changed:
+            point = channel.points[-1][1] if channel.points else None
+            return point, channel.status
+
+    def stream(self, ride_id, keepalive=KEEPALIVE_SECONDS, max_seconds=None):
+        """Yield SSE frames for a ride until the client goes away.
+
+        The recent trail is sent first so the map can draw the path; after
+        that only the newest point of each wake-up is sent.
+        """
+        channel = self.channel(ride_id)
+        with channel.changed:
+            channel.subscribers += 1
+            seq = channel.seq
+            trail = list(channel.since(0))
+            status = channel.status
+        self.streams_opened += 1
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        try:
+            yield 'retry: 3000\n\n'
+            yield _frame('trail', {'points': trail, 'status': status})
+            while deadline is None or time.monotonic() < deadline:
+                new_seq, points, new_status = channel.wait(seq, keepalive)
+                if new_seq == seq:
+                    yield ': keepalive\n\n'
+                    continue
+                seq = new_seq
+                if points:
+                    yield _frame('location', dict(points[-1], seq=seq, status=new_status), seq)
+                if new_status != status:
+                    status = new_status
+                    yield _frame('status', {'status': status}, seq)
+        finally:
+            with channel.changed:
+                channel.subscribers -= 1
+
+    def stats(self):
+        with self._lock:
+            channels = list(self._channels.values())
+        return {
+            'rides': len(channels),
+            'positions': len(self.positions),
+            'subscribers': sum(c.subscribers for c in channels),
+            'published': self.published,
+            'delivered': self.delivered,
+            'streams_opened': self.streams_opened,
+        }
+
+
+def _frame(event, data, event_id=None):
+    frame = f'event: {event}\n'
+    if event_id is not None:
+        frame += f'id: {event_id}\n'
+    return frame + f"data: {json.dumps(data, separators=(',', ':'))}\n\n"
@@ -0,0 +1,423 @@
+"""Request, database and external-call instrumentation for /metrics.
+
+Everything is kept in process memory and rendered in the Prometheus text
+format, so each gunicorn worker reports its own numbers (scrape every
+worker, or sum them in the query). What is measured:
+
+- every request, by endpoint, method and status, plus the part of it
+  spent in SQLite and rendering templates
+- every SQL statement, including the time spent fetching its rows,
+  keyed by its normalised text, with row counts
+- waits for the SQLite write lock (how long BEGIN IMMEDIATE blocked)
+  and statements that gave up with "database is locked"
+- calls to outside services such as Teleport
+
+Statements slower than slow_query_ms are printed (the slow-query log)
+and a sampling profiler can be switched on at runtime; both are off by
+default and controlled from /api/admin/instrumentation.
+"""
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from functools import lru_cache
+
+# Seconds; Prometheus' default buckets shifted down for a SQLite app
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# A BEGIN IMMEDIATE longer than this waited for another writer
+LOCK_WAIT_THRESHOLD = 0.001
+# Longest statement text used as a label
+MAX_STATEMENT_LABEL = 160
+
+_SPACES = re.compile(r'\s+')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labels: (list(s[0]), s[1], s[2]) for labels, s in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket'
+                             f'{_labels(self.label_names + ("le",), labels + (repr(bound),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(self.label_names + ("le",), labels + ("+Inf",))} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('yatrasetu_http_request_duration_seconds',
+                            'Time to produce a response', ('endpoint', 'method', 'status'))
+REQUEST_DB_SECONDS = Histogram('yatrasetu_http_request_db_seconds',
+                               'Part of each request spent in SQLite', ('endpoint',))
+TEMPLATE_SECONDS = Histogram('yatrasetu_template_render_duration_seconds',
+                             'Jinja template rendering time', ('template',))
+STATEMENT_SECONDS = Histogram('yatrasetu_db_statement_duration_seconds',
+                              'SQL execution time including fetching rows', ('statement',))
+STATEMENT_ROWS = Counter('yatrasetu_db_statement_rows_total',
+                         'Rows returned or changed by each statement', ('statement',))
+LOCK_WAIT_SECONDS = Histogram('yatrasetu_db_lock_wait_seconds',
+                              'Time BEGIN IMMEDIATE spent waiting for the write lock')
+LOCK_WAITS = Counter('yatrasetu_db_lock_waits_total',
+                     'Write transactions that had to wait for another writer')
+BUSY_ERRORS = Counter('yatrasetu_db_busy_errors_total',
+                      'Statements that failed because the database stayed locked past busy_timeout')
+SLOW_QUERIES = Counter('yatrasetu_db_slow_queries_total',
+                       'Statements slower than the slow-query threshold')
+EXTERNAL_SECONDS = Histogram('yatrasetu_external_request_duration_seconds',
+                             'Calls to outside services', ('service', 'outcome'))
+
+METRICS = [REQUEST_SECONDS, REQUEST_DB_SECONDS, TEMPLATE_SECONDS, STATEMENT_SECONDS, STATEMENT_ROWS,
+           LOCK_WAIT_SECONDS, LOCK_WAITS, BUSY_ERRORS, SLOW_QUERIES, EXTERNAL_SECONDS]
+
+# Functions returning [(name, type, help, [(labels dict, value), ...])]
+# for gauges owned elsewhere (pool, caches, lanes)
+_collectors = []
+
+# DB_INSTRUMENTATION=0 opens plain sqlite3 connections (no statement timing)
+DB_ENABLED = os.environ.get('DB_INSTRUMENTATION', '1') != '0'
+# Milliseconds; 0 turns the slow-query log off
+slow_query_ms = float(os.environ.get('SLOW_QUERY_MS', 0))
+
+_request = threading.local()
+
+
+def register_collector(collect):
+    _collectors.append(collect)
+    return collect
+
+
+@lru_cache(maxsize=2048)
+def statement_label(sql):
+    """Normalised statement text: one line, IN lists folded, truncated"""
+    text = _IN_LIST.sub('(?...)', _SPACES.sub(' ', sql).strip())
+    return text if len(text) <= MAX_STATEMENT_LABEL else text[:MAX_STATEMENT_LABEL - 3] + '...'
+
+
+def record_statement(sql, seconds, rows):
+    label = statement_label(sql)
+    STATEMENT_SECONDS.observe(seconds, label)
+    if rows:
+        STATEMENT_ROWS.inc(rows, label)
+    if getattr(_request, 'active', False):
+        _request.db_seconds += seconds
+    if label.startswith('BEGIN IMMEDIATE') or label.startswith('BEGIN EXCLUSIVE'):
+        LOCK_WAIT_SECONDS.observe(seconds)
+        if seconds > LOCK_WAIT_THRESHOLD:
+            LOCK_WAITS.inc()
+    if slow_query_ms and seconds * 1000 >= slow_query_ms:
+        SLOW_QUERIES.inc()
+        print(f"🐢 Slow query {seconds * 1000:.1f} ms ({rows} rows): {label}")
+
+
+def record_error(error):
+    message = str(error)
+    if 'locked' in message or 'busy' in message:
+        BUSY_ERRORS.inc()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times each statement from execute() to its last fetch"""
+
+    _sql = None
+
+    def _flush(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            rows = self._rows if self._rows else max(self.rowcount, 0)
+            record_statement(sql, self._elapsed, rows)
+
+    def _run(self, method, sql, parameters):
+        self._flush()
+        started = time.perf_counter()
+        try:
+            method(sql, parameters)
+        except sqlite3.OperationalError as e:
+            record_error(e)
+            raise
+        finally:
+            self._sql, self._elapsed, self._rows = sql, time.perf_counter() - started, 0
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters)
+
+    def _fetch(self, method, *args):
+        started = time.perf_counter()
+        try:
+            result = method(*args)
+        finally:
+            self._elapsed = getattr(self, '_elapsed', 0.0) + time.perf_counter() - started
+        return result
+
+    def fetchone(self):
+        row = self._fetch(super().fetchone)
+        if row is None:
+            self._flush()
+        elif self._sql is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._fetch(super().fetchmany, size if size is not None else self.arraysize)
+        if self._sql is not None:
+            self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(super().fetchall)
+        if self._sql is not None:
+            self._rows += len(rows)
+        self._flush()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._fetch(super().__next__)
+        except StopIteration:
+            self._flush()
+            raise
+        if self._sql is not None:
+            self._rows += 1
+        return row
+
+    def close(self):
+        self._flush()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._flush()
+        except Exception:
+            pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements and commits are timed.
+
+    Connection.execute() would bypass cursor(), so the shortcuts are
+    routed through an InstrumentedCursor here.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        except sqlite3.OperationalError as e:
+            record_error(e)
+            raise
+        finally:
+            record_statement('COMMIT', time.perf_counter() - started, 0)
+
+
+def begin_request():
+    _request.active = True
+    _request.db_seconds = 0.0
+    _request.started = time.perf_counter()
+
+
+def end_request(endpoint, method, status):
+    if not getattr(_request, 'active', False):
+        return
+    _request.active = False
+    endpoint = endpoint or 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - _request.started, endpoint, method, str(status))
+    REQUEST_DB_SECONDS.observe(_request.db_seconds, endpoint)
+
+
+def begin_template():
+    _request.template_started = time.perf_counter()
+
+
+def end_template(name):
+    started = getattr(_request, 'template_started', None)
+    if started is not None:
+        _request.template_started = None
+        TEMPLATE_SECONDS.observe(time.perf_counter() - started, name or 'string')
+
+
+class timed_call:
+    """with timed_call('teleport'): ... records an outside call"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        EXTERNAL_SECONDS.observe(time.perf_counter() - self.started, self.service,
+                                 'error' if exc_type else 'ok')
+        return False
+
+
+def stats_collector(prefix, help, stats):
+    """Collector publishing the numeric values of a stats() dict as gauges"""
+    def collect():
+        values = stats() or {}
+        return [
+            (f'yatrasetu_{prefix}_{key}', 'gauge', f'{help}: {key}', [({}, float(value))])
+            for key, value in sorted(values.items())
+            if isinstance(value, (int, float))
+        ]
+    return collect
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, help, samples in collect():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(tuple(labels), tuple(labels.values()))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Samples every thread's stack at an interval while enabled.
+
+    Stacks are kept in collapsed form ("outer;inner;leaf count"), ready
+    for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval=0.01, max_stacks=5000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self._stacks = _Tally()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = threading.Event()
+
+    @property
+    def enabled(self):
+        return self._running.is_set()
+
+    def start(self, interval=None):
+        if interval:
+            self.interval = interval
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        me = threading.get_ident()
+        while self._running.is_set():
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                for stack in stacks:
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    def stats(self):
+        return {'enabled': self.enabled, 'interval_ms': round(self.interval * 1000, 3),
+                'samples': self.samples, 'stacks': len(self._stacks)}
+
+
+profiler = SamplingProfiler()
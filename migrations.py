@@ -0,0 +1,580 @@
+"""Versioned schema migrations.
+
+The database records the last migration applied in PRAGMA user_version.
+migrate() compares it with the newest migration here. When they match
+(every start after the first) it costs one PRAGMA read. Otherwise it takes
+an exclusive lock on <database>.migrate.lock, so that of all the gunicorn
+workers starting at once exactly one applies the pending steps while the
+others wait and then find nothing left to do.
+
+Databases created before versioning start at user_version 0 with some of
+these changes already made by hand or by older code, so every step checks
+before it alters and is safe to run again; a crash part-way through a step
+is repaired by running it again on the next start.
+
+Each step holds its own SQL as it shipped, never a schema constant of
+the module that uses the tables, so changing a module cannot change what
+an old step does. To change the schema, append a step to MIGRATIONS.
+Never edit a step that has shipped.
+"""
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from gazetteer import Gazetteer
+from geo import cell_id
+from ride_search import city_key
+
+BASE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        phone TEXT,
+        user_type TEXT DEFAULT 'passenger',
+        profile_image TEXT,
+        rating REAL DEFAULT 5.0,
+        total_rides INTEGER DEFAULT 0,
+        member_since TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS rides (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        ride_type TEXT NOT NULL,
+        source_city TEXT NOT NULL,
+        destination_city TEXT NOT NULL,
+        departure_time TIMESTAMP NOT NULL,
+        arrival_time TIMESTAMP,
+        vehicle_type TEXT NOT NULL,
+        vehicle_number TEXT NOT NULL,
+        available_capacity INTEGER NOT NULL,
+        price_per_unit DECIMAL(10,2) NOT NULL,
+        additional_info TEXT,
+        contact_number TEXT NOT NULL,
+        preferred_language TEXT DEFAULT 'hindi',
+        status TEXT DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+
+    CREATE TABLE IF NOT EXISTS bookings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ride_id INTEGER NOT NULL,
+        passenger_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        total_amount DECIMAL(10,2) NOT NULL,
+        status TEXT DEFAULT 'confirmed',
+        booked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (ride_id) REFERENCES rides (id),
+        FOREIGN KEY (passenger_id) REFERENCES users (id)
+    );
+
+    CREATE TABLE IF NOT EXISTS sos_alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        latitude REAL,
+        longitude REAL,
+        address TEXT,
+        status TEXT DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+'''
+
+# Serializes migrations between threads of one process; the file lock
+# does the same between processes
+_lock = threading.Lock()
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _base_tables(conn):
+    conn.executescript(BASE_SCHEMA)
+
+
+def _add_columns(conn, table, columns):
+    # One check per column: a step that crashed between two ALTERs adds
+    # the rest when it runs again
+    existing = _columns(conn, table)
+    for name, definition in columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
+
+def _city_keys(conn):
+    _add_columns(conn, 'rides', (('source_key', 'TEXT'), ('destination_key', 'TEXT')))
+    rows = conn.execute('''
+        SELECT id, source_city, destination_city FROM rides
+        WHERE source_key IS NULL OR destination_key IS NULL
+    ''').fetchall()
+    conn.executemany(
+        'UPDATE rides SET source_key = ?, destination_key = ? WHERE id = ?',
+        [(city_key(r[1]), city_key(r[2]), r[0]) for r in rows]
+    )
+
+
+def _ride_counters(conn):
+    _add_columns(conn, 'rides', (
+        ('bookings_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('seats_booked', 'INTEGER NOT NULL DEFAULT 0'),
+    ))
+
+
+def _ride_coordinates(conn):
+    _add_columns(conn, 'rides', (
+        ('source_lat', 'REAL'), ('source_lng', 'REAL'),
+        ('destination_lat', 'REAL'), ('destination_lng', 'REAL'),
+        ('source_cell', 'INTEGER'), ('destination_cell', 'INTEGER'),
+    ))
+    _place_rides(conn)
+
+
+def _place_rides(conn):
+    # Give rides posted before radius search coordinates from the gazetteer
+    locate = Gazetteer.load().locate
+    updates = []
+    for ride_id, source_city, destination_city in conn.execute(
+            'SELECT id, source_city, destination_city FROM rides WHERE source_cell IS NULL').fetchall():
+        source, destination = locate(source_city), locate(destination_city)
+        updates.append((
+            *(source or (None, None)), *(destination or (None, None)),
+            cell_id(*source) if source else None,
+            cell_id(*destination) if destination else None,
+            ride_id,
+        ))
+    conn.executemany('''
+        UPDATE rides SET source_lat = ?, source_lng = ?, destination_lat = ?, destination_lng = ?,
+                         source_cell = ?, destination_cell = ?
+        WHERE id = ?
+    ''', updates)
+
+
+def _booking_idempotency(conn):
+    _add_columns(conn, 'bookings', (('idempotency_key', 'TEXT'),))
+    conn.executescript('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_idempotency
+            ON bookings (passenger_id, idempotency_key)
+            WHERE idempotency_key IS NOT NULL;
+    ''')
+
+
+def _sos_queue(conn):
+    # The columns and the backfill commit together: a crash in between
+    # would leave the old alerts 'queued' and the rerun would send them
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    queued = 'dispatch_status' in _columns(conn, 'sos_alerts')
+    _add_columns(conn, 'sos_alerts', (
+        ('priority', 'INTEGER NOT NULL DEFAULT 1'),
+        ('dispatch_status', "TEXT NOT NULL DEFAULT 'queued'"),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('claimed_at', 'TIMESTAMP'),
+        ('dispatched_at', 'TIMESTAMP'),
+        ('retry_at', 'TIMESTAMP'),
+        ('last_error', 'TEXT'),
+    ))
+    if not queued:
+        # Alerts from before the dispatcher are history, not work to do
+        conn.execute("UPDATE sos_alerts SET dispatch_status = 'skipped'")
+    conn.commit()
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS sos_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            alert_id INTEGER NOT NULL,
+            notifier TEXT NOT NULL,
+            recipient_id INTEGER,
+            role TEXT,
+            status TEXT NOT NULL,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (alert_id) REFERENCES sos_alerts (id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_sos_queue
+            ON sos_alerts (priority DESC, id) WHERE dispatch_status = 'queued';
+        CREATE INDEX IF NOT EXISTS idx_sos_notifications_alert ON sos_notifications (alert_id);
+    ''')
+
+
+# user_stats counters, in table order, as step 7 created them
+_USER_STATS_COUNTERS = (
+    'active_rides', 'rides_posted', 'completed_rides', 'bookings_received',
+    'total_bookings', 'confirmed_bookings', 'completed_bookings', 'total_spent',
+)
+
+
+def _user_stats(conn):
+    # A user_stats table from before versioning without every counter is
+    # dropped with its triggers and created again
+    columns = _columns(conn, 'user_stats')
+    if columns and not set(_USER_STATS_COUNTERS) <= columns:
+        triggers = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_user_stats_%'")]
+        for name in triggers + ['trg_user_stats_ride_update']:
+            conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        conn.execute('DROP TABLE IF EXISTS user_stats')
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            active_rides INTEGER NOT NULL DEFAULT 0,
+            rides_posted INTEGER NOT NULL DEFAULT 0,
+            completed_rides INTEGER NOT NULL DEFAULT 0,
+            bookings_received INTEGER NOT NULL DEFAULT 0,
+            total_bookings INTEGER NOT NULL DEFAULT 0,
+            confirmed_bookings INTEGER NOT NULL DEFAULT 0,
+            completed_bookings INTEGER NOT NULL DEFAULT 0,
+            total_spent DECIMAL(12,2) NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_ride_insert
+        AFTER INSERT ON rides
+        BEGIN
+            INSERT INTO user_stats (user_id, rides_posted, active_rides, completed_rides)
+            VALUES (NEW.user_id, 1, NEW.status = 'active', NEW.status = 'completed')
+            ON CONFLICT (user_id) DO UPDATE SET
+                rides_posted = rides_posted + 1,
+                active_rides = active_rides + excluded.active_rides,
+                completed_rides = completed_rides + excluded.completed_rides;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_ride_status
+        AFTER UPDATE OF status ON rides WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE user_stats SET
+                active_rides = active_rides - (OLD.status = 'active') + (NEW.status = 'active'),
+                completed_rides = completed_rides - (OLD.status = 'completed') + (NEW.status = 'completed')
+            WHERE user_id = NEW.user_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_ride_delete
+        AFTER DELETE ON rides
+        BEGIN
+            UPDATE user_stats SET
+                rides_posted = rides_posted - 1,
+                active_rides = active_rides - (OLD.status = 'active'),
+                completed_rides = completed_rides - (OLD.status = 'completed'),
+                bookings_received = bookings_received - OLD.bookings_count
+            WHERE user_id = OLD.user_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_booking_insert
+        AFTER INSERT ON bookings
+        BEGIN
+            UPDATE rides SET
+                bookings_count = bookings_count + 1,
+                seats_booked = seats_booked + NEW.quantity
+            WHERE id = NEW.ride_id;
+            UPDATE user_stats SET bookings_received = bookings_received + 1
+            WHERE user_id = (SELECT user_id FROM rides WHERE id = NEW.ride_id);
+            INSERT INTO user_stats (user_id, total_bookings, confirmed_bookings, completed_bookings, total_spent)
+            VALUES (NEW.passenger_id, 1, NEW.status = 'confirmed', NEW.status = 'completed', NEW.total_amount)
+            ON CONFLICT (user_id) DO UPDATE SET
+                total_bookings = total_bookings + 1,
+                confirmed_bookings = confirmed_bookings + excluded.confirmed_bookings,
+                completed_bookings = completed_bookings + excluded.completed_bookings,
+                total_spent = total_spent + excluded.total_spent;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_booking_status
+        AFTER UPDATE OF status ON bookings WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE user_stats SET
+                confirmed_bookings = confirmed_bookings - (OLD.status = 'confirmed') + (NEW.status = 'confirmed'),
+                completed_bookings = completed_bookings - (OLD.status = 'completed') + (NEW.status = 'completed')
+            WHERE user_id = NEW.passenger_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_booking_delete
+        AFTER DELETE ON bookings
+        BEGIN
+            UPDATE rides SET
+                bookings_count = bookings_count - 1,
+                seats_booked = seats_booked - OLD.quantity
+            WHERE id = OLD.ride_id;
+            UPDATE user_stats SET bookings_received = bookings_received - 1
+            WHERE user_id = (SELECT user_id FROM rides WHERE id = OLD.ride_id);
+            UPDATE user_stats SET
+                total_bookings = total_bookings - 1,
+                confirmed_bookings = confirmed_bookings - (OLD.status = 'confirmed'),
+                completed_bookings = completed_bookings - (OLD.status = 'completed'),
+                total_spent = total_spent - OLD.total_amount
+            WHERE user_id = OLD.passenger_id;
+        END;
+    ''')
+    # The counters are recomputed from scratch
+    conn.execute('''
+        UPDATE rides SET
+            bookings_count = (SELECT COUNT(*) FROM bookings WHERE ride_id = rides.id),
+            seats_booked = (SELECT COALESCE(SUM(quantity), 0) FROM bookings WHERE ride_id = rides.id)
+    ''')
+    conn.execute('DELETE FROM user_stats')
+    conn.execute('''
+        INSERT INTO user_stats (user_id, active_rides, rides_posted, completed_rides, bookings_received,
+                                total_bookings, confirmed_bookings, completed_bookings, total_spent)
+        SELECT u.id,
+               COALESCE(r.active_rides, 0), COALESCE(r.rides_posted, 0),
+               COALESCE(r.completed_rides, 0), COALESCE(r.bookings_received, 0),
+               COALESCE(b.total_bookings, 0), COALESCE(b.confirmed_bookings, 0),
+               COALESCE(b.completed_bookings, 0), COALESCE(b.total_spent, 0)
+        FROM users u
+        LEFT JOIN (
+            SELECT rides.user_id,
+                   SUM(rides.status = 'active') AS active_rides,
+                   COUNT(*) AS rides_posted,
+                   SUM(rides.status = 'completed') AS completed_rides,
+                   COALESCE(SUM(received.bookings), 0) AS bookings_received
+            FROM rides
+            LEFT JOIN (SELECT ride_id, COUNT(*) AS bookings FROM bookings GROUP BY ride_id) received
+                ON received.ride_id = rides.id
+            GROUP BY rides.user_id
+        ) r ON r.user_id = u.id
+        LEFT JOIN (
+            SELECT passenger_id,
+                   COUNT(*) AS total_bookings,
+                   SUM(status = 'confirmed') AS confirmed_bookings,
+                   SUM(status = 'completed') AS completed_bookings,
+                   SUM(total_amount) AS total_spent
+            FROM bookings GROUP BY passenger_id
+        ) b ON b.passenger_id = u.id
+    ''')
+
+
+def _indexes(conn):
+    conn.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_rides_route
+            ON rides (status, source_key, destination_key, departure_time);
+        CREATE INDEX IF NOT EXISTS idx_rides_source
+            ON rides (status, source_key, departure_time);
+        CREATE INDEX IF NOT EXISTS idx_rides_destination
+            ON rides (status, destination_key, departure_time);
+        CREATE INDEX IF NOT EXISTS idx_rides_departure
+            ON rides (status, departure_time);
+        CREATE INDEX IF NOT EXISTS idx_rides_source_cell
+            ON rides (status, source_cell, departure_time,
+                      source_lat, source_lng, destination_lat, destination_lng);
+        CREATE INDEX IF NOT EXISTS idx_rides_destination_cell
+            ON rides (status, destination_cell, departure_time,
+                      source_lat, source_lng, destination_lat, destination_lng);
+        CREATE INDEX IF NOT EXISTS idx_rides_user ON rides (user_id);
+        CREATE INDEX IF NOT EXISTS idx_bookings_ride ON bookings (ride_id);
+        CREATE INDEX IF NOT EXISTS idx_bookings_passenger ON bookings (passenger_id);
+    ''')
+
+
+def _ride_archive(conn):
+    # Archive tables with the columns rides and bookings have now, plus archived_at
+    for table in ('rides', 'bookings'):
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {table}_archive AS SELECT * FROM {table} WHERE 0')
+        if 'archived_at' not in _columns(conn, f'{table}_archive'):
+            conn.execute(f'ALTER TABLE {table}_archive ADD COLUMN archived_at TIMESTAMP')
+    conn.executescript('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_rides_archive_id ON rides_archive (id);
+        CREATE INDEX IF NOT EXISTS idx_rides_archive_user ON rides_archive (user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_bookings_archive_passenger ON bookings_archive (passenger_id, id);
+        CREATE INDEX IF NOT EXISTS idx_bookings_archive_ride ON bookings_archive (ride_id);
+
+        CREATE TABLE IF NOT EXISTS archive_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            moving INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO archive_state (id, moving) VALUES (1, 0);
+    ''')
+    # The user_stats delete triggers now skip rows being archived
+    for name in ('trg_user_stats_ride_delete', 'trg_user_stats_booking_delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    conn.executescript('''
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_ride_delete
+        AFTER DELETE ON rides WHEN NOT (SELECT moving FROM archive_state)
+        BEGIN
+            UPDATE user_stats SET
+                rides_posted = rides_posted - 1,
+                active_rides = active_rides - (OLD.status = 'active'),
+                completed_rides = completed_rides - (OLD.status = 'completed'),
+                bookings_received = bookings_received - OLD.bookings_count
+            WHERE user_id = OLD.user_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_user_stats_booking_delete
+        AFTER DELETE ON bookings WHEN NOT (SELECT moving FROM archive_state)
+        BEGIN
+            UPDATE rides SET
+                bookings_count = bookings_count - 1,
+                seats_booked = seats_booked - OLD.quantity
+            WHERE id = OLD.ride_id;
+            UPDATE user_stats SET bookings_received = bookings_received - 1
+            WHERE user_id = (SELECT user_id FROM rides WHERE id = OLD.ride_id);
+            UPDATE user_stats SET
+                total_bookings = total_bookings - 1,
+                confirmed_bookings = confirmed_bookings - (OLD.status = 'confirmed'),
+                completed_bookings = completed_bookings - (OLD.status = 'completed'),
+                total_spent = total_spent - OLD.total_amount
+            WHERE user_id = OLD.passenger_id;
+        END;
+    ''')
+
+
+def _ride_revisions(conn):
+    _add_columns(conn, 'rides', (('revision', 'INTEGER NOT NULL DEFAULT 0'),))
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS ride_revision (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO ride_revision (id, value) VALUES (1, 0);
+
+        CREATE TRIGGER IF NOT EXISTS trg_rides_revision_insert
+        AFTER INSERT ON rides
+        BEGIN
+            UPDATE ride_revision SET value = value + 1;
+            UPDATE rides SET revision = (SELECT value FROM ride_revision) WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_rides_revision_update
+        AFTER UPDATE ON rides WHEN NEW.revision IS OLD.revision
+        BEGIN
+            UPDATE ride_revision SET value = value + 1;
+            UPDATE rides SET revision = (SELECT value FROM ride_revision) WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_rides_revision_driver
+        AFTER UPDATE OF name, rating, total_rides ON users
+        WHEN NEW.name IS NOT OLD.name OR NEW.rating IS NOT OLD.rating
+          OR NEW.total_rides IS NOT OLD.total_rides
+        BEGIN
+            UPDATE ride_revision SET value = value + 1;
+            UPDATE rides SET revision = (SELECT value FROM ride_revision) WHERE user_id = NEW.id;
+        END;
+    ''')
+
+
+def _ride_change_log(conn):
+    conn.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_rides_revision ON rides (revision);
+    ''')
+
+
+def _invoice_jobs(conn):
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS invoice_jobs (
+            booking_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            digest TEXT,
+            claimed_at TIMESTAMP,
+            retry_at TIMESTAMP,
+            rendered_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_invoice_queue ON invoice_jobs (booking_id) WHERE status = 'queued';
+        CREATE INDEX IF NOT EXISTS idx_invoice_claims ON invoice_jobs (claimed_at) WHERE status = 'rendering';
+
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_booking_insert
+        AFTER INSERT ON bookings WHEN NEW.status IN ('confirmed', 'completed')
+        BEGIN
+            INSERT OR IGNORE INTO invoice_jobs (booking_id) VALUES (NEW.id);
+        END;
+
+        -- A cancelled booking keeps its invoice, rendered again as cancelled
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_booking_status
+        AFTER UPDATE OF status ON bookings WHEN NEW.status IS NOT OLD.status
+        BEGIN
+            INSERT INTO invoice_jobs (booking_id)
+            SELECT NEW.id WHERE NEW.status IN ('confirmed', 'completed')
+                             OR EXISTS (SELECT 1 FROM invoice_jobs WHERE booking_id = NEW.id)
+            ON CONFLICT (booking_id) DO UPDATE SET status = 'queued', attempts = 0, retry_at = NULL;
+        END;
+    ''')
+    # Bookings made before get no job here, which would hold the migration
+    # lock for a render of all history: their invoice is queued the first
+    # time it is asked for, or rendered in batches by invoices.py --month
+
+
+# (user_version after the step, description, step), oldest first
+MIGRATIONS = (
+    (1, 'base tables', _base_tables),
+    (2, 'normalized city keys on rides', _city_keys),
+    (3, 'booking counters on rides', _ride_counters),
+    (4, 'ride coordinates and grid cells', _ride_coordinates),
+    (5, 'booking idempotency keys', _booking_idempotency),
+    (6, 'SOS dispatch queue', _sos_queue),
+    (7, 'user_stats counters and triggers', _user_stats),
+    (8, 'search and history indexes', _indexes),
+    (9, 'ride and booking archive', _ride_archive),
+    (10, 'ride revisions for ETags', _ride_revisions),
+    (11, 'ride change log index', _ride_change_log),
+    (12, 'invoice job queue', _invoice_jobs),
+)
+LATEST = MIGRATIONS[-1][0]
+
+
+def version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def migrate(conn):
+    """Apply pending migrations; returns the versions applied (usually none)"""
+    if version(conn) >= LATEST:
+        return []
+    path = conn.execute('PRAGMA database_list').fetchone()[2]
+    applied = []
+    with _lock, (_file_lock(path + '.migrate.lock') if path else _nothing()):
+        # Another process may have finished while we waited for the lock
+        for number, description, step in MIGRATIONS:
+            if number <= version(conn):
+                continue
+            print(f"🔄 Migration {number}: {description}")
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+            applied.append(number)
+    return applied
+
+
+@contextmanager
+def _nothing():
+    # In-memory databases belong to one connection; nothing to lock
+    yield
+
+
+def status(conn):
+    """Current and latest schema versions, for /api/db-stats"""
+    return {'schema_version': version(conn), 'latest_schema_version': LATEST}
+
+
+if __name__ == '__main__':
+    # python migrations.py [db path]: bring a database up to date
+    import sys
+
+    import database
+
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else None)
+    applied = migrate(conn)
+    print(f"✅ Schema at version {version(conn)}" + (f" (applied {applied})" if applied else ''))
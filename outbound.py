@@ -0,0 +1,159 @@
+"""Shared client for calls to outside services (Teleport, SOS webhooks).
+
+Request threads are the scarce resource in a threaded worker, so slow
+upstreams must not hold them:
+
+- submit() runs a lookup on a small pool of outbound threads. The caller
+  waits only as long as it chooses and can answer without the result;
+  the lookup finishes in the background (and typically fills a cache).
+- Identical lookups already in flight share one upstream call.
+- The pool is bounded. When it is full, new lookups are refused at once
+  instead of queueing behind a stuck upstream.
+- request() reuses keep-alive connections per host and always applies a
+  timeout.
+
+Threads start lazily so every gunicorn worker gets its own after fork.
+"""
+import http.client
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+Response = namedtuple('Response', 'status headers body')
+
+# Connections that went stale while idle fail like this on first use
+_STALE = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class HTTPClient:
+    def __init__(self, max_workers=4, max_pending=32, timeout=2.0, max_idle_per_host=4):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._inflight = {}
+        self._idle = {}
+        self.requests = 0
+        self.reused = 0
+        self.errors = 0
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def _pool(self):
+        # Caller holds self._lock
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='outbound')
+            self._inflight = {}
+            self._idle = {}
+            self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, key, func, *args, slots=None):
+        """Run func(*args) on the outbound pool; returns a Future or None.
+
+        A call with the same key still running gets that call's Future.
+        None means the pool (or the caller's own slots semaphore) is full
+        and the lookup was not started.
+        """
+        with self._lock:
+            executor = self._pool()
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self._inflight) >= self.max_pending:
+                self.rejected += 1
+                return None
+            if slots is not None and not slots.acquire(blocking=False):
+                self.rejected += 1
+                return None
+            future = executor.submit(func, *args)
+            self._inflight[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda _: self._finished(key, future, slots))
+        return future
+
+    def _finished(self, key, future, slots):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if slots is not None:
+            slots.release()
+
+    def _connection(self, scheme, host, port, timeout):
+        with self._lock:
+            self._pool()
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                self.reused += 1
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(host, port, timeout=timeout), False
+
+    def _keep(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Blocking HTTP request over a pooled connection; returns a Response"""
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        timeout = timeout or self.timeout
+        self.requests += 1
+        for attempt in (1, 2):
+            conn, reused = self._connection(scheme, parts.hostname, port, timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except _STALE:
+                conn.close()
+                if reused and attempt == 1:
+                    continue
+                self.errors += 1
+                raise
+            except Exception:
+                conn.close()
+                self.errors += 1
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._keep(key, conn)
+            return Response(response.status, dict(response.getheaders()), data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._inflight),
+                'idle_connections': sum(len(v) for v in self._idle.values()),
+                'requests': self.requests,
+                'reused_connections': self.reused,
+                'errors': self.errors,
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+            }
+
+
+shared = HTTPClient(
+    max_workers=int(os.environ.get('OUTBOUND_WORKERS', 4)),
+    max_pending=int(os.environ.get('OUTBOUND_MAX_PENDING', 32)),
+)
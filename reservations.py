@@ -0,0 +1,367 @@
+"""Seat reservations for /api/book-ride and /api/book-rides.
+
+A booking is one conditional UPDATE that only succeeds while enough
+seats are left, followed by the INSERT into bookings. There is no
+SELECT-then-UPDATE window and no BEGIN IMMEDIATE held across Python code,
+so capacity can never go negative and the write lock is held for two
+statements. Client retries carrying the same idempotency key get the
+original booking back instead of a second one. A multi-ride booking
+reserves every ride in one UPDATE and commits all of them or none.
+
+With group commit enabled, concurrent bookings in a worker are handed to
+one writer thread that applies each in its own SAVEPOINT and commits the
+whole batch at once. A request that fails, for any reason, is rolled back
+to its savepoint and fails alone. A request still queued when its caller
+stops waiting is cancelled and never applied; one already being applied
+is waited for, so a caller is never told a booking failed that then
+commits.
+"""
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, TimeoutError
+
+import database
+
+# Largest number of items accepted by /api/book-rides
+MAX_BATCH_ITEMS = 50
+
+
+class ReservationError(Exception):
+    """A booking that cannot be made; the message is safe to show users"""
+
+
+def _positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 1
+
+
+def _existing_booking(conn, passenger_id, idempotency_key):
+    row = conn.execute('''
+        SELECT b.id, b.total_amount, r.source_city, r.destination_city, r.departure_time
+        FROM bookings b JOIN rides r ON b.ride_id = r.id
+        WHERE b.passenger_id = ? AND b.idempotency_key = ?
+    ''', (passenger_id, idempotency_key)).fetchone()
+    if row is None:
+        return None
+    return {
+        'booking_id': row['id'],
+        'total_amount': row['total_amount'],
+        'ride': {k: row[k] for k in ('source_city', 'destination_city', 'departure_time')},
+        'replayed': True,
+    }
+
+
+def _failure_reason(conn, ride_id):
+    ride = conn.execute(
+        'SELECT status, available_capacity FROM rides WHERE id = ?', (ride_id,)
+    ).fetchone()
+    if ride is None:
+        return 'Ride not found'
+    if ride['status'] != 'active':
+        return 'Ride is no longer available'
+    return 'Not enough capacity available'
+
+
+def reserve(conn, ride_id, passenger_id, quantity, idempotency_key=None):
+    """Take seats and insert the booking in the caller's transaction.
+
+    Returns {'booking_id', 'total_amount', 'ride', 'replayed'}; raises
+    ReservationError when the ride cannot take the booking.
+    """
+    if not _positive_int(ride_id):
+        raise ReservationError('Choose a ride to book')
+    if not _positive_int(quantity):
+        raise ReservationError('Quantity must be a positive whole number')
+
+    if idempotency_key:
+        existing = _existing_booking(conn, passenger_id, idempotency_key)
+        if existing:
+            return existing
+
+    ride = conn.execute('''
+        UPDATE rides SET available_capacity = available_capacity - ?
+        WHERE id = ? AND status = 'active' AND available_capacity >= ?
+        RETURNING price_per_unit, source_city, destination_city, departure_time
+    ''', (quantity, ride_id, quantity)).fetchall()
+    if not ride:
+        raise ReservationError(_failure_reason(conn, ride_id))
+    ride = dict(ride[0])
+
+    total_amount = ride.pop('price_per_unit') * quantity
+    cursor = conn.execute('''
+        INSERT INTO bookings (ride_id, passenger_id, quantity, total_amount, idempotency_key)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (ride_id, passenger_id, quantity, total_amount, idempotency_key))
+    return {
+        'booking_id': cursor.lastrowid,
+        'total_amount': total_amount,
+        'ride': ride,
+        'replayed': False,
+    }
+
+
+def _batch_keys(idempotency_key, count):
+    return [f'{idempotency_key}:{i}' for i in range(count)]
+
+
+def _existing_batch(conn, passenger_id, idempotency_key, count):
+    keys = _batch_keys(idempotency_key, count)
+    rows = conn.execute(f'''
+        SELECT b.id, b.ride_id, b.quantity, b.total_amount,
+               r.source_city, r.destination_city, r.departure_time
+        FROM bookings b JOIN rides r ON b.ride_id = r.id
+        WHERE b.passenger_id = ? AND b.idempotency_key IN ({', '.join('?' * count)})
+        ORDER BY b.id
+    ''', [passenger_id] + keys).fetchall()
+    if len(rows) != count:
+        return None
+    return _batch_result(rows, replayed=True)
+
+
+def _batch_result(rows, replayed):
+    return {
+        'bookings': [
+            {'booking_id': r['id'], 'ride_id': r['ride_id'],
+             'quantity': r['quantity'], 'total_amount': r['total_amount']}
+            for r in rows
+        ],
+        'total_amount': sum(r['total_amount'] for r in rows),
+        'rides': [
+            {k: r[k] for k in ('source_city', 'destination_city', 'departure_time')}
+            for r in rows
+        ],
+        'replayed': replayed,
+    }
+
+
+def reserve_many(conn, passenger_id, items, idempotency_key=None):
+    """Reserve every (ride_id, quantity) item in the caller's transaction.
+
+    All rides are decremented by one conditional UPDATE; if any of them
+    cannot take its share a ReservationError listing the failures is
+    raised and the caller must roll back. Bookings are inserted with
+    executemany in request order.
+    """
+    if not isinstance(items, list) or not items:
+        raise ReservationError('Add at least one ride to book')
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ReservationError(f'At most {MAX_BATCH_ITEMS} rides can be booked at once')
+    parsed = []
+    for item in items:
+        ride_id = item.get('ride_id') if isinstance(item, dict) else None
+        quantity = item.get('quantity') if isinstance(item, dict) else None
+        if not _positive_int(ride_id) or not _positive_int(quantity):
+            raise ReservationError('Each item needs a ride_id and a positive whole quantity')
+        parsed.append((ride_id, quantity))
+
+    if idempotency_key:
+        existing = _existing_batch(conn, passenger_id, idempotency_key, len(parsed))
+        if existing:
+            return existing
+
+    # The same ride may appear twice (e.g. two legs on one bus)
+    per_ride = {}
+    for ride_id, quantity in parsed:
+        per_ride[ride_id] = per_ride.get(ride_id, 0) + quantity
+
+    values = ', '.join('(?, ?)' for _ in per_ride)
+    params = [v for pair in per_ride.items() for v in pair]
+    updated = conn.execute(f'''
+        UPDATE rides
+        SET available_capacity = available_capacity - wanted.quantity
+        FROM (SELECT column1 AS ride_id, column2 AS quantity FROM (VALUES {values})) AS wanted
+        WHERE rides.id = wanted.ride_id
+          AND rides.status = 'active'
+          AND rides.available_capacity >= wanted.quantity
+        RETURNING rides.id, rides.price_per_unit, rides.source_city,
+                  rides.destination_city, rides.departure_time
+    ''', params).fetchall()
+    rides = {row['id']: row for row in updated}
+
+    failed = [ride_id for ride_id in per_ride if ride_id not in rides]
+    if failed:
+        error = ReservationError('Some rides could not be booked; nothing was reserved')
+        error.failures = [
+            {'ride_id': ride_id, 'message': _failure_reason(conn, ride_id)} for ride_id in failed
+        ]
+        raise error
+
+    keys = _batch_keys(idempotency_key, len(parsed)) if idempotency_key else [None] * len(parsed)
+    rows = [
+        (ride_id, passenger_id, quantity, rides[ride_id]['price_per_unit'] * quantity, key)
+        for (ride_id, quantity), key in zip(parsed, keys)
+    ]
+    conn.executemany('''
+        INSERT INTO bookings (ride_id, passenger_id, quantity, total_amount, idempotency_key)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    # We hold the write lock, so the batch received consecutive ids
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    first_id = last_id - len(rows) + 1
+
+    return _batch_result([
+        {'id': first_id + i, 'ride_id': ride_id, 'quantity': quantity, 'total_amount': total,
+         'source_city': rides[ride_id]['source_city'],
+         'destination_city': rides[ride_id]['destination_city'],
+         'departure_time': rides[ride_id]['departure_time']}
+        for i, (ride_id, _, quantity, total, _) in enumerate(rows)
+    ], replayed=False)
+
+
+def _in_transaction(conn, func, *args):
+    # Begin explicitly: the sqlite3 module only opens a transaction on its
+    # own for statements it recognises as DML
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        result = func(conn, *args)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def book(conn, ride_id, passenger_id, quantity, idempotency_key=None, writer=None):
+    """Book seats on one ride, via the group-commit writer when given"""
+    args = (ride_id, passenger_id, quantity, idempotency_key)
+    try:
+        if writer is not None:
+            return writer.submit(reserve, *args)
+        return _in_transaction(conn, reserve, *args)
+    except sqlite3.IntegrityError:
+        # A concurrent retry with the same key committed first
+        existing = _existing_booking(conn, passenger_id, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise
+        return existing
+
+
+def book_many(conn, passenger_id, items, idempotency_key=None, writer=None):
+    """Book several rides atomically, via the group-commit writer when given"""
+    args = (passenger_id, items, idempotency_key)
+    try:
+        if writer is not None:
+            return writer.submit(reserve_many, *args)
+        return _in_transaction(conn, reserve_many, *args)
+    except sqlite3.IntegrityError:
+        existing = (_existing_batch(conn, passenger_id, idempotency_key, len(items))
+                    if idempotency_key else None)
+        if existing is None:
+            raise
+        return existing
+
+
+class GroupCommitter:
+    """Single writer thread that commits concurrent bookings together.
+
+    submit() blocks until the batch holding the request has committed, or
+    for timeout seconds while it is still queued.
+    """
+
+    def __init__(self, max_batch=64, timeout=10):
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.batches = 0
+        self.bookings = 0
+        self.largest_batch = 0
+        self.timed_out = 0
+        self.errors = 0
+
+    def _ensure_writer(self):
+        # Started lazily so every gunicorn worker gets its own writer after fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='booking-writer', daemon=True).start()
+
+    def submit(self, func, *args):
+        """Run func(conn, *args) in the next batch and wait for its commit"""
+        self._ensure_writer()
+        future = Future()
+        self._queue.put((future, func, args))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Still queued: the writer will skip it. Otherwise it is in the
+            # batch being committed right now, so its outcome is moments away.
+            if future.cancel():
+                with self._lock:
+                    self.timed_out += 1
+                raise ReservationError('Booking is taking too long, nothing was booked; please try again')
+            return future.result()
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if conn is None:
+                # Fail this batch at once rather than let its callers time
+                # out; the next batch tries to open the connection again
+                try:
+                    conn = database.checkout()
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Booking writer could not open the database: {e}")
+                    error = ReservationError('Booking is unavailable right now, nothing was booked; '
+                                             'please try again')
+                    for future, _, _ in batch:
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(error)
+                    continue
+            self._commit_batch(conn, batch)
+
+    def _commit_batch(self, conn, batch):
+        # Requests whose caller gave up while they were queued are dropped
+        batch = [entry for entry in batch if entry[0].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for future, func, args in batch:
+                # Each request gets its own savepoint so one failure does
+                # not undo the others in the batch
+                conn.execute('SAVEPOINT booking')
+                try:
+                    outcomes.append((future, func(conn, *args), None))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO booking')
+                    outcomes.append((future, None, e))
+                conn.execute('RELEASE booking')
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.bookings += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'bookings': self.bookings,
+            'largest_batch': self.largest_batch,
+            'timed_out': self.timed_out,
+            'errors': self.errors,
+            'pending': self._queue.qsize(),
+        }
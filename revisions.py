@@ -0,0 +1,31 @@
+"""Version stamps for rides, behind the ETags of /api/ride/<id> and search.
+
+Every insert or update of a ride takes the next number of one sequence
+(ride_revision) as the ride's revision, and so do a driver's rides when
+the driver's name or rating changes, since both endpoints show them.
+
+- A ride's ETag is its id and revision: one primary-key read.
+- A search's ETag is the number of active rides it can match and the
+  newest revision among them. A ride posted, changed, or moved into the
+  search raises the newest revision past every older one; a ride that
+  only leaves it lowers the count. One index range, no join.
+
+Either is read before the body it labels, so a body is never older than
+its tag.
+"""
+from ride_search import search_stamp
+
+# rides.revision, the ride_revision sequence and the triggers that stamp
+# rides are created by migration step 10 (migrations.py)
+
+
+def ride_etag(conn, ride_id):
+    """ETag of /api/ride/<ride_id>, or None if there is no such ride"""
+    row = conn.execute('SELECT revision FROM rides WHERE id = ?', (ride_id,)).fetchone()
+    return f'ride-{ride_id}-{row[0]}' if row else None
+
+
+def search_etag(conn, source='', destination='', travel_date=''):
+    """ETag shared by every page and field list of one city/date search"""
+    count, newest = search_stamp(conn, source, destination, travel_date)
+    return f'search-{count}-{newest}'
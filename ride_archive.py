@@ -0,0 +1,187 @@
+"""Expiry and archival of departed rides.
+
+A sweeper thread in each worker keeps the hot rides table small:
+
+- expire() flips active rides that left more than EXPIRE_AFTER_MINUTES
+  ago to 'expired', so they drop out of search and can't be booked.
+- archive() moves finished rides that left more than ARCHIVE_AFTER_DAYS
+  ago, with their bookings, to rides_archive and bookings_archive.
+
+Both work in batches of BATCH_SIZE rows, one short write transaction per
+batch, and pick their rows inside that transaction, so workers sweeping
+at the same time never move a ride twice. My Rides and My Bookings read
+the archive too (history.py), and user_stats keeps counting archived
+rows.
+
+One sweep by hand: python ride_archive.py [db path]
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database
+
+EXPIRE_AFTER_MINUTES = int(os.environ.get('RIDE_EXPIRE_MINUTES', 15))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('RIDE_ARCHIVE_DAYS', 30))
+SWEEP_SECONDS = 60
+BATCH_SIZE = 500
+
+# Rides in these states never change again and may be archived
+FINISHED = ('expired', 'completed', 'cancelled')
+
+# rides_archive, bookings_archive and archive_state are created by
+# migration step 9 (migrations.py)
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _shared_columns(conn, table):
+    # Columns added to a live table later are archived once the archive
+    # table gains them too
+    archived = set(_columns(conn, f'{table}_archive'))
+    return ', '.join(c for c in _columns(conn, table) if c in archived)
+
+
+def _timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def expire(conn, now=None, batch_size=BATCH_SIZE):
+    """Mark departed active rides 'expired'; returns the rows changed.
+
+    departure_time is stored as typed ('2024-01-22 09:00' or
+    '2024-01-22T09:00'), so the index range stops at the next day and
+    julianday() makes the exact comparison.
+    """
+    cutoff = (now or datetime.now()) - timedelta(minutes=EXPIRE_AFTER_MINUTES)
+    bound = (cutoff.date() + timedelta(days=1)).isoformat()
+    expired = []
+    while True:
+        rows = conn.execute('''
+            UPDATE rides SET status = 'expired'
+            WHERE id IN (SELECT id FROM rides
+                         WHERE status = 'active' AND departure_time < ?
+                           AND julianday(departure_time) < julianday(?)
+                         LIMIT ?)
+            RETURNING id, source_city, destination_city, departure_time
+        ''', (bound, _timestamp(cutoff), batch_size)).fetchall()
+        conn.commit()
+        expired.extend(rows)
+        if len(rows) < batch_size:
+            return expired
+
+
+def archive(conn, now=None, batch_size=BATCH_SIZE):
+    """Move old finished rides and their bookings to the archive; returns the ride count"""
+    cutoff = ((now or datetime.now()) - timedelta(days=ARCHIVE_AFTER_DAYS)).date().isoformat()
+    ride_columns = _shared_columns(conn, 'rides')
+    booking_columns = _shared_columns(conn, 'bookings')
+    moved = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT id FROM rides
+                WHERE status IN ({', '.join('?' * len(FINISHED))}) AND departure_time < ?
+                LIMIT ?
+            ''', FINISHED + (cutoff, batch_size))]
+            if ids:
+                _move(conn, ids, ride_columns, booking_columns)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        moved += len(ids)
+        if len(ids) < batch_size:
+            return moved
+
+
+def _move(conn, ids, ride_columns, booking_columns):
+    marks = ', '.join('?' * len(ids))
+    # The user_stats delete triggers skip rows while this is set
+    conn.execute('UPDATE archive_state SET moving = 1')
+    conn.execute(f'''
+        INSERT INTO rides_archive ({ride_columns}, archived_at)
+        SELECT {ride_columns}, CURRENT_TIMESTAMP FROM rides WHERE id IN ({marks})
+    ''', ids)
+    conn.execute(f'''
+        INSERT INTO bookings_archive ({booking_columns}, archived_at)
+        SELECT {booking_columns}, CURRENT_TIMESTAMP FROM bookings WHERE ride_id IN ({marks})
+    ''', ids)
+    conn.execute(f'DELETE FROM bookings WHERE ride_id IN ({marks})', ids)
+    conn.execute(f'DELETE FROM rides WHERE id IN ({marks})', ids)
+    conn.execute('UPDATE archive_state SET moving = 0')
+
+
+class RideSweeper:
+    def __init__(self, interval=SWEEP_SECONDS, on_expired=None):
+        # interval <= 0 turns the background thread off
+        self.interval = interval
+        # Called with the rows expire() changed, e.g. to drop cached searches
+        self.on_expired = on_expired
+        self._lock = threading.Lock()
+        self._pid = None
+        self.sweeps = 0
+        self.expired = 0
+        self.archived = 0
+        self.errors = 0
+        self.last_sweep_ms = None
+
+    def start(self):
+        """Start this process's sweeper thread if it is not running yet"""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        # One sweeper per process, started lazily so it survives fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='ride-sweeper', daemon=True).start()
+
+    def _run(self):
+        conn = database.checkout()
+        while True:
+            try:
+                self.sweep(conn)
+            except Exception as e:
+                self.errors += 1
+                print(f"Ride sweeper error: {e}")
+                if conn.in_transaction:
+                    conn.rollback()
+            time.sleep(self.interval)
+
+    def sweep(self, conn, now=None):
+        """Expire and archive once; returns (rides expired, rides archived)"""
+        started = time.perf_counter()
+        expired = expire(conn, now)
+        if expired and self.on_expired:
+            self.on_expired(expired)
+        archived = archive(conn, now)
+        self.sweeps += 1
+        self.expired += len(expired)
+        self.archived += archived
+        self.last_sweep_ms = round((time.perf_counter() - started) * 1000, 2)
+        return len(expired), archived
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'sweeps': self.sweeps,
+            'expired': self.expired,
+            'archived': self.archived,
+            'errors': self.errors,
+            'last_sweep_ms': self.last_sweep_ms,
+        }
+
+
+if __name__ == '__main__':
+    import sys
+
+    import migrations
+
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else None)
+    migrations.migrate(conn)
+    expired, archived = RideSweeper().sweep(conn)
+    print(f"✅ Expired {expired} rides, archived {archived}")
@@ -0,0 +1,207 @@
+"""Ride validation shared by /api/post-ride and the bulk importer.
+
+The importer reads CSV or NDJSON row by row from a stream, so an upload
+of any size is never held in memory, and writes valid rows with
+executemany in fixed-size transactions. Invalid rows are skipped and
+reported by row number.
+"""
+import csv
+import io
+import json
+import math
+from datetime import datetime
+
+from geo import cell_id
+from ride_search import city_key
+
+REQUIRED_FIELDS = (
+    'ride_type', 'source_city', 'destination_city', 'departure_time', 'vehicle_type',
+    'vehicle_number', 'available_capacity', 'price_per_unit', 'contact_number',
+)
+
+INSERT_RIDE = '''
+    INSERT INTO rides (
+        user_id, ride_type, source_city, destination_city, departure_time,
+        arrival_time, vehicle_type, vehicle_number, available_capacity,
+        price_per_unit, additional_info, contact_number, preferred_language,
+        source_key, destination_key,
+        source_lat, source_lng, destination_lat, destination_lng, source_cell, destination_cell
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+
+
+def _text(data, field):
+    value = data.get(field)
+    return value.strip() if isinstance(value, str) else value
+
+
+def _point(data, prefix, city, locate):
+    # Coordinates picked on the map win; otherwise place the city by name
+    lat, lng = data.get(f'{prefix}_lat'), data.get(f'{prefix}_lng')
+    if lat not in (None, '') and lng not in (None, ''):
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            raise ValueError(f'{prefix}_lat/{prefix}_lng must be numbers')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise ValueError(f'{prefix}_lat/{prefix}_lng out of range')
+        return lat, lng
+    return locate(city) if locate else None
+
+
+def _timestamp(data, field):
+    # Stored as YYYY-MM-DD HH:MM, so searches and expiry can compare the
+    # text with day ranges
+    value = _text(data, field)
+    if value in (None, ''):
+        return None
+    try:
+        if not isinstance(value, str):
+            raise ValueError
+        return datetime.fromisoformat(value).replace(tzinfo=None).isoformat(' ', 'minutes')
+    except ValueError:
+        raise ValueError(f'{field} must look like 2024-01-22 09:00 or 2024-01-22T09:00')
+
+
+def validate_ride(data, user_id, locate=None):
+    """Return the INSERT_RIDE parameters for a ride, or raise ValueError.
+
+    locate(city name) -> (lat, lng) or None fills in coordinates the
+    ride does not carry itself.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Ride must be an object')
+    missing = [f for f in REQUIRED_FIELDS if _text(data, f) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing required field(s): {', '.join(missing)}")
+
+    try:
+        capacity = int(data['available_capacity'])
+    except (TypeError, ValueError):
+        raise ValueError('available_capacity must be a whole number')
+    if capacity < 1:
+        raise ValueError('available_capacity must be at least 1')
+    try:
+        price = float(data['price_per_unit'])
+    except (TypeError, ValueError):
+        raise ValueError('price_per_unit must be a number')
+    if not math.isfinite(price):
+        raise ValueError('price_per_unit must be a number')
+    if price < 0:
+        raise ValueError('price_per_unit cannot be negative')
+    if price.is_integer():
+        price = int(price)
+
+    departure_time = _timestamp(data, 'departure_time')
+    arrival_time = _timestamp(data, 'arrival_time')
+
+    source_city = _text(data, 'source_city')
+    destination_city = _text(data, 'destination_city')
+    source = _point(data, 'source', source_city, locate) or (None, None)
+    destination = _point(data, 'destination', destination_city, locate) or (None, None)
+    return (
+        user_id,
+        _text(data, 'ride_type'),
+        source_city,
+        destination_city,
+        departure_time,
+        arrival_time,
+        _text(data, 'vehicle_type'),
+        _text(data, 'vehicle_number'),
+        capacity,
+        price,
+        _text(data, 'additional_info') or '',
+        str(_text(data, 'contact_number')),
+        _text(data, 'preferred_language') or 'hindi',
+        city_key(source_city),
+        city_key(destination_city),
+        *source,
+        *destination,
+        cell_id(*source) if source[0] is not None else None,
+        cell_id(*destination) if destination[0] is not None else None,
+    )
+
+
+def _csv_rows(text_stream):
+    reader = csv.DictReader(text_stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _ndjson_rows(text_stream):
+    for line_num, line in enumerate(text_stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError:
+            yield line_num, None
+
+
+def iter_rows(binary_stream, fmt):
+    """Yield (line number, dict or None) from a CSV or NDJSON byte stream"""
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        return _csv_rows(text_stream)
+    if fmt == 'ndjson':
+        return _ndjson_rows(text_stream)
+    raise ValueError(f'Unsupported import format: {fmt}')
+
+
+def import_rides(conn, rows, user_id, chunk_size=CHUNK_SIZE, locate=None):
+    """Validate and insert rides, committing every chunk_size rows.
+
+    Returns a summary with per-row errors (the first MAX_REPORTED_ERRORS)
+    and the set of (source, destination, day) corridors touched. An upload
+    that cannot be read to the end (bad UTF-8, broken CSV quoting) stops
+    there; the rows before it are kept and read_error says why.
+    """
+    imported = failed = 0
+    errors = []
+    corridors = set()
+    pending = []
+    read_error = None
+
+    def flush():
+        nonlocal imported
+        if pending:
+            conn.executemany(INSERT_RIDE, pending)
+            conn.commit()
+            imported += len(pending)
+            pending.clear()
+
+    try:
+        for line_num, data in rows:
+            try:
+                if data is None:
+                    raise ValueError('Row is not valid JSON')
+                values = validate_ride(data, user_id, locate)
+            except ValueError as e:
+                failed += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'row': line_num, 'message': str(e)})
+                continue
+            pending.append(values)
+            corridors.add((values[2], values[3], values[4][:10]))
+            if len(pending) >= chunk_size:
+                flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        read_error = str(e)
+    flush()
+
+    return {'imported': imported, 'failed': failed, 'errors': errors, 'corridors': corridors,
+            'read_error': read_error}
+
+
+def detect_format(declared, content_type, filename=''):
+    """Pick csv or ndjson from ?format=, the file name or the content type"""
+    if declared:
+        return declared.lower()
+    filename = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if filename.endswith(('.ndjson', '.jsonl')) or 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'ndjson'
+    return 'csv'
@@ -0,0 +1,436 @@
+"""Ride search queries shared by the API routes.
+
+City names are matched on normalized keys (``source_key`` /
+``destination_key``) kept next to the display names, so every filter can
+be answered from the composite indexes instead of scanning ``rides``.
+Radius search (geo_search) works the same way on the grid cell of each
+ride's endpoints (``source_cell`` / ``destination_cell``, see geo.py).
+"""
+import base64
+import heapq
+import json
+import re
+import sys
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from geo import bounding_box, cells_within, haversine_km
+
+_SPACES = re.compile(r'\s+')
+
+# The indexes these queries are answered from are created by migration
+# step 8 (migrations.py)
+
+# Columns a search may return, in response order. source_key and
+# destination_key are internal and never exposed. Drivers without a
+# rating or ride count get sample values for demonstration.
+RIDE_FIELDS = {
+    'id': 'r.id',
+    'user_id': 'r.user_id',
+    'ride_type': 'r.ride_type',
+    'source_city': 'r.source_city',
+    'destination_city': 'r.destination_city',
+    'departure_time': 'r.departure_time',
+    'arrival_time': 'r.arrival_time',
+    'vehicle_type': 'r.vehicle_type',
+    'vehicle_number': 'r.vehicle_number',
+    'available_capacity': 'r.available_capacity',
+    'price_per_unit': 'r.price_per_unit',
+    'additional_info': 'r.additional_info',
+    'contact_number': 'r.contact_number',
+    'preferred_language': 'r.preferred_language',
+    'status': 'r.status',
+    'created_at': 'r.created_at',
+    'source_lat': 'r.source_lat',
+    'source_lng': 'r.source_lng',
+    'destination_lat': 'r.destination_lat',
+    'destination_lng': 'r.destination_lng',
+    'driver_name': 'u.name',
+    'rating': 'COALESCE(NULLIF(u.rating, 0), 4.5)',
+    'total_rides': 'COALESCE(u.total_rides, 5 + ABS(RANDOM()) % 46)',
+}
+DRIVER_FIELDS = {'driver_name', 'rating', 'total_rides'}
+
+# A typed prefix that matches more distinct cities than this is searched
+# as a key range instead of being expanded into an IN list
+MAX_PREFIX_KEYS = 8
+MAX_PAGE_SIZE = 100
+DEFAULT_RADIUS_KM = 25.0
+MAX_RADIUS_KM = 100.0
+
+
+@lru_cache(maxsize=4096)
+def city_key(name):
+    """Normalize a city name: 'Pune, Maharashtra, India ' -> 'pune'"""
+    if not name:
+        return ''
+    name = str(name).split(',', 1)[0]
+    return _SPACES.sub(' ', name).strip().lower()
+
+
+def _prefix_upper_bound(prefix):
+    # Smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def day_range(travel_date):
+    """('YYYY-MM-DD', next day) for a travel_date; raises ValueError"""
+    day = datetime.strptime(travel_date, '%Y-%m-%d')
+    return day.strftime('%Y-%m-%d'), (day + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def parse_fields(fields):
+    """Turn a 'fields=a,b,c' value into a list of known column names.
+
+    id and departure_time are always included because the pagination
+    cursor is built from them.
+    """
+    if not fields:
+        return list(RIDE_FIELDS)
+    names = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in names if f not in RIDE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    for required in ('departure_time', 'id'):
+        if required not in names:
+            names.insert(0, required)
+    return names
+
+
+def parse_filters(ride_type='', vehicle_type='', min_price='', max_price='', seats=''):
+    """Optional result filters from query-string values; raises ValueError.
+
+    ride_type is a comma list and, like vehicle_type, matches without
+    regard to case. min_price / max_price bound price_per_unit and seats
+    is the capacity a ride must still have. Empty values are left out.
+    """
+    filters = {}
+    types = tuple(sorted({t.strip().lower() for t in (ride_type or '').split(',') if t.strip()}))
+    if types:
+        filters['ride_type'] = types
+    if (vehicle_type or '').strip():
+        filters['vehicle_type'] = vehicle_type.strip().lower()
+    for name, value in (('min_price', min_price), ('max_price', max_price)):
+        if value not in (None, ''):
+            try:
+                filters[name] = float(value)
+            except ValueError:
+                raise ValueError(f'{name} must be a number')
+    if seats not in (None, ''):
+        try:
+            filters['seats'] = int(seats)
+        except ValueError:
+            raise ValueError('seats must be a whole number')
+        if filters['seats'] < 1:
+            raise ValueError('seats must be at least 1')
+    return filters
+
+
+def _filter_clauses(filters):
+    query, params = '', []
+    if filters.get('ride_type'):
+        query += f" AND lower(r.ride_type) IN ({', '.join('?' * len(filters['ride_type']))})"
+        params += list(filters['ride_type'])
+    if filters.get('vehicle_type'):
+        query += ' AND lower(r.vehicle_type) = ?'
+        params.append(filters['vehicle_type'])
+    if filters.get('min_price') is not None:
+        query += ' AND r.price_per_unit >= ?'
+        params.append(filters['min_price'])
+    if filters.get('max_price') is not None:
+        query += ' AND r.price_per_unit <= ?'
+        params.append(filters['max_price'])
+    if filters.get('seats'):
+        query += ' AND r.available_capacity >= ?'
+        params.append(filters['seats'])
+    return query, params
+
+
+def encode_cursor(row):
+    raw = json.dumps([row['departure_time'], row['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (departure_time, id) pair encoded by encode_cursor()"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        departure_time, ride_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(departure_time), int(ride_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+
+def resolve_city_keys(conn, column, prefix):
+    """Expand a key prefix into the distinct active keys it matches.
+
+    Walks the index one distinct key at a time (a skip-scan), so the cost
+    depends on the number of cities, not rides. Returns None when the
+    prefix is too broad to be worth expanding.
+    """
+    upper = _prefix_upper_bound(prefix)
+    keys = conn.execute(f'''
+        WITH RECURSIVE k(key) AS (
+            SELECT MIN({column}) FROM rides
+            WHERE status = 'active' AND {column} >= ? AND {column} < ?
+            UNION ALL
+            SELECT (SELECT MIN({column}) FROM rides
+                    WHERE status = 'active' AND {column} > k.key AND {column} < ?)
+            FROM k WHERE k.key IS NOT NULL
+        )
+        SELECT key FROM k WHERE key IS NOT NULL LIMIT ?
+    ''', (prefix, upper, upper, MAX_PREFIX_KEYS + 1)).fetchall()
+    keys = [row[0] for row in keys]
+    return None if len(keys) > MAX_PREFIX_KEYS else keys
+
+
+def _city_filter(column, prefix, keys):
+    if keys is None:
+        return f' AND r.{column} >= ? AND r.{column} < ?', [prefix, _prefix_upper_bound(prefix)]
+    if len(keys) == 1:
+        return f' AND r.{column} = ?', list(keys)
+    return f" AND r.{column} IN ({', '.join('?' * len(keys))})", list(keys)
+
+
+def _select(fields, extra=''):
+    columns = ', '.join(f'{RIDE_FIELDS[f]} AS {f}' for f in fields)
+    query = f'SELECT {columns}{extra} FROM rides r'
+    if DRIVER_FIELDS.intersection(fields):
+        query += ' JOIN users u ON r.user_id = u.id'
+    return query + " WHERE r.status = 'active'"
+
+
+def build_search_query(source='', destination='', travel_date='', fields=None,
+                       after=None, limit=None, source_keys=None, destination_keys=None,
+                       select=None, filters=None):
+    """Return (sql, params) for an active-ride search.
+
+    Cities match on key prefix ("pun" finds Pune); pass source_keys /
+    destination_keys from resolve_city_keys() to match exact keys instead,
+    which lets the indexes return rows already in departure order. The
+    date becomes a half-open range on departure_time, which holds for both
+    the '2024-01-20 08:00:00' and '2024-01-20T08:00' formats we store.
+    Results are ordered by (departure_time, id); after is a decoded
+    cursor from the previous page. select replaces the column list and
+    the ordering, e.g. with an aggregate over the matching rides. filters
+    come from parse_filters().
+    """
+    fields = fields or list(RIDE_FIELDS)
+    query = _select(fields) if select is None else f"SELECT {select} FROM rides r WHERE r.status = 'active'"
+    params = []
+
+    source = city_key(source)
+    if source:
+        clause, values = _city_filter('source_key', source, source_keys)
+        query += clause
+        params += values
+
+    destination = city_key(destination)
+    if destination:
+        clause, values = _city_filter('destination_key', destination, destination_keys)
+        query += clause
+        params += values
+
+    if travel_date:
+        query += ' AND r.departure_time >= ? AND r.departure_time < ?'
+        params += list(day_range(travel_date))
+
+    if filters:
+        clause, values = _filter_clauses(filters)
+        query += clause
+        params += values
+
+    if after:
+        query += ' AND (r.departure_time, r.id) > (?, ?)'
+        params += list(after)
+
+    if select is None:
+        query += ' ORDER BY r.departure_time ASC, r.id ASC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return query, params
+
+
+def _resolved_query(conn, source, destination, travel_date, **kwargs):
+    # None means "no rides can match", so callers can skip the query
+    source_keys = destination_keys = None
+    if city_key(source):
+        source_keys = resolve_city_keys(conn, 'source_key', city_key(source))
+        if source_keys == []:
+            return None
+    if city_key(destination):
+        destination_keys = resolve_city_keys(conn, 'destination_key', city_key(destination))
+        if destination_keys == []:
+            return None
+    return build_search_query(source, destination, travel_date,
+                              source_keys=source_keys, destination_keys=destination_keys,
+                              **kwargs)
+
+
+def search_rides(conn, source='', destination='', travel_date='', fields=None,
+                 after=None, limit=None, filters=None):
+    """Run a ride search and return the matching rows"""
+    resolved = _resolved_query(conn, source, destination, travel_date,
+                               fields=fields, after=after, limit=limit, filters=filters)
+    if resolved is None:
+        return []
+    query, params = resolved
+    return conn.execute(query, params).fetchall()
+
+
+def search_stamp(conn, source='', destination='', travel_date=''):
+    """(rides matched, newest revision among them) for a search; see revisions.py"""
+    resolved = _resolved_query(conn, source, destination, travel_date,
+                               select='COUNT(*), COALESCE(MAX(r.revision), 0)')
+    if resolved is None:
+        return 0, 0
+    query, params = resolved
+    return tuple(conn.execute(query, params).fetchone())
+
+
+def search_page(conn, source='', destination='', travel_date='', fields=None,
+                after=None, limit=20, filters=None):
+    """One page of results plus the cursor for the next page (or None)"""
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    rows = search_rides(conn, source, destination, travel_date, fields=fields,
+                        after=after, limit=limit + 1, filters=filters)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def parse_point(lat, lng, radius=None):
+    """(lat, lng, radius_km) from query-string values, or None if lat/lng are absent"""
+    if lat in (None, '') and lng in (None, ''):
+        return None
+    try:
+        lat, lng = float(lat), float(lng)
+        radius = float(radius) if radius not in (None, '') else DEFAULT_RADIUS_KM
+    except (TypeError, ValueError):
+        raise ValueError('lat, lon and radius must be numbers')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('lat/lon out of range')
+    if not 0 < radius <= MAX_RADIUS_KM:
+        raise ValueError(f'radius must be between 0 and {MAX_RADIUS_KM:g} km')
+    return lat, lng, radius
+
+
+def build_geo_query(origin=None, destination=None, travel_date='', filters=None):
+    """Return (sql, params) for the ids and end points of active rides whose
+    cells are near the given points"""
+    query = ("SELECT r.id, r.departure_time, r.source_lat, r.source_lng,"
+             " r.destination_lat, r.destination_lng FROM rides r WHERE r.status = 'active'")
+    params = []
+    for side, point in (('source', origin), ('destination', destination)):
+        if point:
+            cells = cells_within(*point)
+            query += f" AND r.{side}_cell IN ({', '.join('?' * len(cells))})"
+            # The box around the circle is checked from the index, so only
+            # rides that can be in range reach the distance maths
+            query += f' AND r.{side}_lat BETWEEN ? AND ? AND r.{side}_lng BETWEEN ? AND ?'
+            params += cells + list(bounding_box(*point))
+    if travel_date:
+        query += ' AND r.departure_time >= ? AND r.departure_time < ?'
+        params += list(day_range(travel_date))
+    if filters:
+        clause, values = _filter_clauses(filters)
+        query += clause
+        params += values
+    return query, params
+
+
+def _detour(row, origin, destination):
+    # (detour_km, pickup_km, dropoff_km), or None if the ride is out of range
+    slat, slng, dlat, dlng = row[2:6]
+    if slat is None or dlat is None:
+        return None
+    pickup = dropoff = None
+    if origin:
+        pickup = haversine_km(slat, slng, origin[0], origin[1])
+        if pickup > origin[2]:
+            return None
+    if destination:
+        dropoff = haversine_km(dlat, dlng, destination[0], destination[1])
+        if dropoff > destination[2]:
+            return None
+    # source -> pickup -> drop -> destination, reusing the legs above
+    if origin and destination:
+        via = pickup + haversine_km(origin[0], origin[1], destination[0], destination[1]) + dropoff
+    elif origin:
+        via = pickup + haversine_km(origin[0], origin[1], dlat, dlng)
+    else:
+        via = haversine_km(slat, slng, destination[0], destination[1]) + dropoff
+    return via - haversine_km(slat, slng, dlat, dlng), pickup, dropoff
+
+
+def geo_search(conn, origin=None, destination=None, travel_date='', fields=None, limit=20,
+               filters=None):
+    """Rides starting near origin and/or ending near destination, least detour first.
+
+    origin and destination are (lat, lng, radius_km). The detour is how
+    much longer the driver's trip gets by going via the pickup and drop
+    points instead of straight from source to destination. Candidates are
+    ranked on ids and coordinates alone; full rows are only read for the
+    page that is returned.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    fields = fields or list(RIDE_FIELDS)
+    query, params = build_geo_query(origin, destination, travel_date, filters)
+    ranked = []
+    for row in conn.execute(query, params):
+        distances = _detour(row, origin, destination)
+        if distances is not None:
+            ranked.append((round(distances[0], 2), row[1], row[0], distances))
+    ranked = heapq.nsmallest(limit, ranked)
+    if not ranked:
+        return []
+
+    if 'id' not in fields:
+        fields = ['id'] + list(fields)
+    query = _select(fields) + f" AND r.id IN ({', '.join('?' * len(ranked))})"
+    rows = {row['id']: dict(row) for row in conn.execute(query, [r[2] for r in ranked])}
+    rides = []
+    for detour, _, ride_id, (_, pickup, dropoff) in ranked:
+        ride = rows.get(ride_id)
+        if ride is None:
+            continue
+        if pickup is not None:
+            ride['pickup_km'] = round(pickup, 2)
+        if dropoff is not None:
+            ride['dropoff_km'] = round(dropoff, 2)
+        ride['detour_km'] = detour
+        rides.append(ride)
+    return rides
+
+
+def full_scans(conn, source='', destination='', travel_date='', **kwargs):
+    """List the EXPLAIN QUERY PLAN steps that scan the rides table"""
+    resolved = _resolved_query(conn, source, destination, travel_date, **kwargs)
+    if resolved is None:
+        return []
+    query, params = resolved
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()
+    return [row[3] for row in plan if row[3].startswith('SCAN r')]
+
+
+if __name__ == '__main__':
+    # Sanity check: python ride_search.py [db path]
+    import database
+    import migrations
+
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else None)
+    migrations.migrate(conn)
+    cases = [
+        ('Pune', 'Mumbai', '2024-01-22'),
+        ('Pune', '', ''),
+        ('P', '', ''),
+        ('', 'Mumbai', ''),
+        ('', '', '2024-01-22'),
+        ('', '', ''),
+    ]
+    failed = False
+    for case in cases:
+        scans = full_scans(conn, *case, after=('2024-01-01', 0), limit=21)
+        print(('❌ ' if scans else '✅ ') + repr(case) + (f' {scans}' if scans else ''))
+        failed = failed or bool(scans)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,343 @@
+"""In-memory snapshot of the active rides behind /api/search-rides.
+
+Optional (SEARCH_SNAPSHOT=1). Each worker then holds every active ride
+in array-backed columns: interned city, ride type and vehicle ids,
+capacity and price. Next to them sits the row the search returns.
+Indexes like the ones on rides map each (source, destination), each
+source, each destination and the whole table to date buckets of rides
+in departure order. City, date and filter searches are then answered
+without touching the database.
+
+The rides table is its own change log. Every insert or update of a
+ride (posting, a booking changing its capacity, expiry, a driver's
+profile) gives it the next revision (revisions.py). A search whose
+snapshot was refreshed more than max_staleness seconds ago first
+applies the rows above the last revision seen, found through
+idx_rides_revision, so results are never older than that.
+This worker's own writes call changed(), so they show up at once.
+
+A ride leaves the snapshot when a change makes it anything but active.
+The change log does not see rows deleted outright. Only the archive
+deletes rides, and only finished ones.
+"""
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from heapq import merge
+from itertools import chain
+from operator import itemgetter
+
+from ride_search import (DRIVER_FIELDS, MAX_PAGE_SIZE, RIDE_FIELDS, city_key, day_range,
+                         encode_cursor)
+
+STALENESS_SECONDS = 1.0
+
+# The change log reads idx_rides_revision, created by migration step 11
+# (migrations.py)
+
+_FIELDS = tuple(RIDE_FIELDS)
+_INDEX = {field: i for i, field in enumerate(_FIELDS)}
+# Values many rides share; one copy of each is kept
+_SHARED = {_INDEX[f] for f in ('ride_type', 'source_city', 'destination_city', 'vehicle_type',
+                               'preferred_language', 'status', 'driver_name')}
+# revision, status, keys and whether the driver exists, then the search row
+_CHANGES = f'''
+    SELECT r.revision, r.status, r.source_key, r.destination_key, u.id IS NOT NULL,
+           {', '.join(f'{RIDE_FIELDS[f]} AS {f}' for f in _FIELDS)}
+    FROM rides r LEFT JOIN users u ON r.user_id = u.id
+'''
+
+
+def _number(value, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return kind('nan') if kind is float else 0
+
+
+class RideSnapshot:
+    def __init__(self, max_staleness=STALENESS_SECONDS):
+        self.max_staleness = max_staleness
+        self._lock = threading.Lock()
+        self.revision = None
+        self.refreshed_at = None
+        self._dirty = False
+        self.loads = 0
+        self.refreshes = 0
+        self.changes = 0
+        self.searches = 0
+        self.load_ms = None
+        self.last_refresh_ms = None
+        self._clear()
+
+    def _clear(self):
+        self._slot_of = {}              # ride id -> slot
+        self._free = []                 # slots of rides that left, reused first
+        self._rows = []                 # slot -> search row, RIDE_FIELDS order
+        self._departure = []            # slot -> departure_time as stored (sort key)
+        self._ids = array('q')
+        self._source = array('l')       # interned city keys
+        self._destination = array('l')
+        self._ride_type = array('l')    # interned, lower case
+        self._vehicle = array('l')
+        self._capacity = array('q')
+        self._price = array('d')
+        self._driver = array('b')       # the driver's user row exists
+        self._interned = {}             # ride / vehicle type -> id
+        self._city_ids = {}             # city key -> id
+        self._keys = []                 # city keys seen, sorted, for prefixes
+        self._pairs = {}                # (source, destination) -> {day: [slots]}
+        self._by_source = {}            # source -> {day: [slots]}
+        self._by_destination = {}       # destination -> {day: [slots]}
+        self._days = {}                 # day -> [slots], every pair
+        self._destinations = {}         # source -> destinations seen
+        # Newest revision that changed the rides of a pair / city
+        self._pair_revision = {}
+        self._source_revision = {}
+        self._destination_revision = {}
+
+    def changed(self):
+        """This worker wrote rides: refresh before the next search"""
+        self._dirty = True
+
+    # -- keeping up with the rides table (caller holds self._lock) --
+
+    def _fresh(self, conn):
+        now = time.monotonic()
+        if self.revision is not None and not self._dirty and now - self.refreshed_at < self.max_staleness:
+            return
+        started = time.perf_counter()
+        self._dirty = False
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        if self.revision is None:
+            self._clear()
+            # Rides committed after this read come round again in the next refresh
+            revision = cursor.execute('SELECT COALESCE(MAX(revision), 0) FROM rides').fetchone()[0]
+            # In departure order, so every insort appends
+            for row in cursor.execute(_CHANGES + " WHERE r.status = 'active' ORDER BY r.departure_time, r.id"):
+                self._link(row, revision)
+            self.revision = revision
+            self.loads += 1
+            self.load_ms = round((time.perf_counter() - started) * 1000, 2)
+        else:
+            rows = cursor.execute(_CHANGES + ' WHERE r.revision > ? ORDER BY r.revision',
+                                  (self.revision,)).fetchall()
+            for row in rows:
+                slot = self._slot_of.get(row[5])
+                if slot is not None:
+                    self._unlink(slot, row[0])
+                if row[1] == 'active':
+                    self._link(row, row[0])
+            if rows:
+                self.revision = rows[-1][0]
+                self.changes += len(rows)
+            self.refreshes += 1
+            self.last_refresh_ms = round((time.perf_counter() - started) * 1000, 3)
+        self.refreshed_at = now
+
+    def _intern(self, value):
+        number = self._interned.get(value)
+        if number is None:
+            number = self._interned[value] = len(self._interned)
+        return number
+
+    def _city(self, key):
+        number = self._city_ids.get(key)
+        if number is None:
+            number = self._city_ids[key] = len(self._city_ids)
+            if key is not None:
+                insort(self._keys, key)
+        return number
+
+    def _order(self, slot):
+        return self._departure[slot], self._ids[slot]
+
+    def _link(self, change, revision):
+        values = change[5:]
+        row = tuple(sys.intern(v) if i in _SHARED and isinstance(v, str) else v
+                    for i, v in enumerate(values))
+        ride_id = row[0]
+        source, destination = self._city(change[2]), self._city(change[3])
+        columns = (
+            (self._ids, ride_id),
+            (self._source, source),
+            (self._destination, destination),
+            (self._ride_type, self._intern(str(row[_INDEX['ride_type']] or '').lower())),
+            (self._vehicle, self._intern(str(row[_INDEX['vehicle_type']] or '').lower())),
+            (self._capacity, _number(row[_INDEX['available_capacity']], int)),
+            (self._price, _number(row[_INDEX['price_per_unit']], float)),
+            (self._driver, 1 if change[4] else 0),
+            (self._rows, row),
+            (self._departure, str(row[_INDEX['departure_time']])),
+        )
+        if self._free:
+            slot = self._free.pop()
+            for column, value in columns:
+                column[slot] = value
+        else:
+            slot = len(self._rows)
+            for column, value in columns:
+                column.append(value)
+        self._slot_of[ride_id] = slot
+
+        pair = (source, destination)
+        day = self._departure[slot][:10]
+        for buckets in (self._pairs.setdefault(pair, {}), self._by_source.setdefault(source, {}),
+                        self._by_destination.setdefault(destination, {}), self._days):
+            insort(buckets.setdefault(day, []), slot, key=self._order)
+        self._destinations.setdefault(source, set()).add(destination)
+        self._touch(pair, revision)
+
+    def _unlink(self, slot, revision):
+        pair = (self._source[slot], self._destination[slot])
+        day = self._departure[slot][:10]
+        for buckets in (self._pairs[pair], self._by_source[pair[0]], self._by_destination[pair[1]], self._days):
+            bucket = buckets[day]
+            del bucket[bisect_left(bucket, self._order(slot), key=self._order)]
+            if not bucket:
+                del buckets[day]
+        del self._slot_of[self._ids[slot]]
+        self._rows[slot] = None
+        self._free.append(slot)
+        self._touch(pair, revision)
+
+    def _touch(self, pair, revision):
+        self._pair_revision[pair] = revision
+        self._source_revision[pair[0]] = revision
+        self._destination_revision[pair[1]] = revision
+
+    # -- searching (caller holds self._lock) --
+
+    def _cities(self, prefix):
+        # Interned ids of the city keys starting with prefix
+        keys = self._keys
+        at = bisect_left(keys, prefix)
+        found = []
+        while at < len(keys) and keys[at].startswith(prefix):
+            found.append(self._city_ids[keys[at]])
+            at += 1
+        return found
+
+    def _matching_pairs(self, source, destination):
+        wanted = set(self._cities(destination))
+        return [(s, d) for s in self._cities(source) for d in self._destinations.get(s, ()) if d in wanted]
+
+    def _stamp(self, source, destination):
+        # A change to any ride the search can match moves its pair, and
+        # so its cities, to that change's revision, newer than all before
+        if source and destination:
+            revisions = [self._pair_revision[pair] for pair in self._matching_pairs(source, destination)]
+        elif source:
+            revisions = [self._source_revision.get(s, 0) for s in self._cities(source)]
+        elif destination:
+            revisions = [self._destination_revision.get(d, 0) for d in self._cities(destination)]
+        else:
+            revisions = [self.revision]
+        return max(revisions, default=0)
+
+    def _stream(self, buckets, day, after):
+        # Slots of one bucket map in departure order, after the cursor
+        if day is not None:
+            lists = [buckets[day]] if day in buckets else []
+        else:
+            lists = [buckets[d] for d in sorted(buckets)]
+        if after:
+            lists = [bucket[bisect_right(bucket, after, key=self._order):] for bucket in lists]
+        return chain.from_iterable(lists)
+
+    def _keep(self, filters, driver):
+        checks = []
+        if driver:
+            checks.append(self._driver.__getitem__)
+        if filters.get('ride_type'):
+            types, ride_type = {self._interned.get(t) for t in filters['ride_type']}, self._ride_type
+            checks.append(lambda slot: ride_type[slot] in types)
+        if filters.get('vehicle_type'):
+            wanted, vehicle = self._interned.get(filters['vehicle_type']), self._vehicle
+            checks.append(lambda slot: vehicle[slot] == wanted)
+        price = self._price
+        if filters.get('min_price') is not None:
+            low = filters['min_price']
+            checks.append(lambda slot: price[slot] >= low)
+        if filters.get('max_price') is not None:
+            high = filters['max_price']
+            checks.append(lambda slot: price[slot] <= high)
+        if filters.get('seats'):
+            seats, capacity = filters['seats'], self._capacity
+            checks.append(lambda slot: capacity[slot] >= seats)
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        return lambda slot: all(check(slot) for check in checks)
+
+    # -- the ride_search interface --
+
+    def etag(self, conn, source='', destination=''):
+        """ETag of a search answered from this snapshot; read it before the search"""
+        with self._lock:
+            self._fresh(conn)
+            return f'snapshot-{self._stamp(city_key(source), city_key(destination))}'
+
+    def search_rides(self, conn, source='', destination='', travel_date='', fields=None,
+                     after=None, limit=None, filters=None):
+        """ride_search.search_rides() from memory; rows are tuples in fields order"""
+        fields = tuple(fields or _FIELDS)
+        day = day_range(travel_date)[0] if travel_date else None
+        source, destination = city_key(source), city_key(destination)
+        with self._lock:
+            self._fresh(conn)
+            self.searches += 1
+            if source and destination:
+                bucket_maps = [self._pairs[pair] for pair in self._matching_pairs(source, destination)]
+            elif source:
+                bucket_maps = [self._by_source[s] for s in self._cities(source) if s in self._by_source]
+            elif destination:
+                bucket_maps = [self._by_destination[d] for d in self._cities(destination)
+                               if d in self._by_destination]
+            else:
+                bucket_maps = [self._days]
+            streams = [self._stream(buckets, day, after) for buckets in bucket_maps]
+            slots = streams[0] if len(streams) == 1 else merge(*streams, key=self._order)
+            keep = self._keep(filters or {}, bool(DRIVER_FIELDS.intersection(fields)))
+            found = []
+            for slot in slots:
+                if keep is None or keep(slot):
+                    found.append(slot)
+                    if limit and len(found) >= limit:
+                        break
+            rows = [self._rows[slot] for slot in found]
+        if fields == _FIELDS:
+            return rows
+        indexes = [_INDEX[field] for field in fields]
+        pick = itemgetter(*indexes) if len(indexes) > 1 else (lambda row: (row[indexes[0]],))
+        return [pick(row) for row in rows]
+
+    def search_page(self, conn, source='', destination='', travel_date='', fields=None,
+                    after=None, limit=20, filters=None):
+        """ride_search.search_page() from memory"""
+        fields = tuple(fields or _FIELDS)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        rows = self.search_rides(conn, source, destination, travel_date, fields=fields,
+                                 after=after, limit=limit + 1, filters=filters)
+        next_cursor = encode_cursor(dict(zip(fields, rows[limit - 1]))) if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    def stats(self):
+        return {
+            'rides': len(self._slot_of),
+            'slots': len(self._rows),
+            'revision': self.revision,
+            'max_staleness': self.max_staleness,
+            'age_ms': (round((time.monotonic() - self.refreshed_at) * 1000, 1)
+                       if self.refreshed_at is not None else None),
+            'loads': self.loads,
+            'load_ms': self.load_ms,
+            'refreshes': self.refreshes,
+            'last_refresh_ms': self.last_refresh_ms,
+            'changes': self.changes,
+            'searches': self.searches,
+        }
@@ -0,0 +1,107 @@
+"""In-process LRU/TTL cache for /api/search-rides results.
+
+Entries are keyed on the normalized (source, destination, travel_date)
+query. Writes invalidate only the entries whose query could match the
+ride that changed, so popular corridors stay warm while a booking on one
+ride never leaves its capacity stale in this process. The TTL bounds how
+long another gunicorn worker's writes can go unseen; with the search
+snapshot on, city searches add its revision to the key instead.
+
+Every invalidation bumps a generation counter. A search reads it before
+its query and passes it to put(), which drops the results if a write was
+invalidated in between, so results read before a booking are never
+cached after it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from ride_search import city_key
+
+
+class SearchCache:
+    def __init__(self, max_entries=512, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.discarded = 0
+        # Bumped by every invalidation; see put()
+        self.generation = 0
+
+    @staticmethod
+    def make_key(source, destination, travel_date, *extra):
+        """The corridor/date always leads the key; extra parts (page, fields) follow"""
+        return (city_key(source), city_key(destination), (travel_date or '').strip()) + extra
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        """Cache value unless an invalidation came after generation was read"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                self.discarded += 1
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_ride(self, source_city, destination_city, departure_time):
+        """Drop every cached query that a ride on this corridor/date matches"""
+        source = city_key(source_city)
+        destination = city_key(destination_city)
+        day = str(departure_time or '')[:10]
+        with self._lock:
+            self.generation += 1
+            stale = [
+                key for key in self._entries
+                if source.startswith(key[0])
+                and destination.startswith(key[1])
+                and key[2] in ('', day)
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'discarded': self.discarded,
+            }
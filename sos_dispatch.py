@@ -0,0 +1,300 @@
+"""SOS alerts: persist first, notify in the background.
+
+/sos only INSERTs the alert (with a priority) and returns, so the user
+gets an acknowledgement in milliseconds. sos_alerts doubles as a durable
+queue: a dispatcher thread in each worker claims the highest-priority
+queued alert with one conditional UPDATE, works out who to tell (support
+staff, the driver of the user's current ride and the nearest drivers
+reporting live positions) and hands the alert to every configured
+notifier. Alerts claimed by a worker that died are requeued, and failed
+deliveries are retried a few times.
+
+Notifier backends are picked with SOS_NOTIFIERS (comma separated, default
+"log"); see NOTIFIERS.
+"""
+import json
+import os
+import threading
+from collections import deque
+
+import database
+import metrics
+import outbound
+
+# The queue columns of sos_alerts and sos_notifications are created by
+# migration step 6 (migrations.py)
+
+# Priorities: anyone on a ride right now goes first, and a repeated alert
+# from the same user is escalated
+PRIORITY_DEFAULT = 1
+PRIORITY_ON_RIDE = 2
+PRIORITY_REPEAT_BONUS = 1
+REPEAT_WINDOW_MINUTES = 10
+
+MAX_ATTEMPTS = 5
+# A claim older than this belonged to a worker that died mid-dispatch
+CLAIM_TIMEOUT_SECONDS = 60
+POLL_SECONDS = 5
+NEAREST_DRIVERS = 5
+NEAREST_RADIUS_KM = 10.0
+
+
+class LogNotifier:
+    """Prints alerts and keeps the last few in memory; the default backend"""
+    name = 'log'
+
+    def __init__(self, keep=100):
+        self.sent = deque(maxlen=keep)
+
+    def send(self, alert, recipients):
+        self.sent.append((alert, recipients))
+        who = ', '.join(f"{r['name']} ({r['role']})" for r in recipients) or 'nobody'
+        print(f"🚨 SOS #{alert['id']} from user {alert['user_id']} "
+              f"(priority {alert['priority']}) -> {who}")
+
+
+class WebhookNotifier:
+    """POSTs the alert and its recipients as JSON to SOS_WEBHOOK_URL"""
+    name = 'webhook'
+
+    def __init__(self, url=None, timeout=5, http=None):
+        self.url = url or os.environ.get('SOS_WEBHOOK_URL')
+        self.timeout = timeout
+        self.http = http or outbound.shared
+        if not self.url:
+            raise ValueError('SOS_WEBHOOK_URL is not set')
+
+    def send(self, alert, recipients):
+        body = json.dumps({'alert': alert, 'recipients': recipients}, default=str).encode()
+        with metrics.timed_call('sos_webhook'):
+            resp = self.http.request('POST', self.url, body=body, timeout=self.timeout,
+                                     headers={'Content-Type': 'application/json'})
+        if resp.status >= 300:
+            raise RuntimeError(f'Webhook returned {resp.status}')
+
+
+NOTIFIERS = {
+    'log': LogNotifier,
+    'webhook': WebhookNotifier,
+}
+
+
+def load_notifiers(names=None):
+    """Instantiate the notifier backends named in SOS_NOTIFIERS"""
+    names = names if names is not None else os.environ.get('SOS_NOTIFIERS', 'log')
+    notifiers = []
+    for name in filter(None, (n.strip() for n in names.split(','))):
+        if name not in NOTIFIERS:
+            raise ValueError(f'Unknown SOS notifier: {name}')
+        notifiers.append(NOTIFIERS[name]())
+    return notifiers
+
+
+def map_link(lat, lng):
+    if lat is None or lng is None:
+        return None
+    return f'https://www.google.com/maps?q={lat},{lng}'
+
+
+def _coordinate(value, low, high):
+    if value in (None, ''):
+        return None
+    value = float(value)
+    if not low <= value <= high:
+        raise ValueError('Location out of range')
+    return value
+
+
+class SOSDispatcher:
+    def __init__(self, notifiers=None, locator=None, poll_seconds=POLL_SECONDS):
+        self.notifiers = notifiers if notifiers is not None else load_notifiers()
+        # Anything with nearby(lat, lng, limit, radius_km) -> [(ride_id, km)]
+        self.locator = locator
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.queued = 0
+        self.dispatched = 0
+        self.retried = 0
+        self.failed = 0
+        self.errors = 0
+
+    def enqueue(self, conn, user_id, latitude=None, longitude=None, address=''):
+        """Persist an alert and wake the dispatcher; returns (alert id, priority)"""
+        latitude = _coordinate(latitude, -90, 90)
+        longitude = _coordinate(longitude, -180, 180)
+        priority = PRIORITY_ON_RIDE if self._current_ride(conn, user_id) else PRIORITY_DEFAULT
+        recent = conn.execute(f'''
+            SELECT 1 FROM sos_alerts
+            WHERE user_id = ? AND created_at >= datetime('now', '-{REPEAT_WINDOW_MINUTES} minutes')
+            LIMIT 1
+        ''', (user_id,)).fetchone()
+        if recent:
+            priority += PRIORITY_REPEAT_BONUS
+        alert_id = conn.execute('''
+            INSERT INTO sos_alerts (user_id, latitude, longitude, address, priority)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, latitude, longitude, address or '', priority)).lastrowid
+        conn.commit()
+        self.queued += 1
+        self._ensure_worker()
+        self._wake.set()
+        return alert_id, priority
+
+    @staticmethod
+    def _current_ride(conn, user_id):
+        # A confirmed booking on a ride that left recently or leaves soon
+        return conn.execute('''
+            SELECT r.id, r.user_id AS driver_id
+            FROM bookings b JOIN rides r ON b.ride_id = r.id
+            WHERE b.passenger_id = ? AND b.status = 'confirmed'
+              AND datetime(r.departure_time) BETWEEN datetime('now', 'localtime', '-12 hours')
+                                                 AND datetime('now', 'localtime', '+1 hour')
+            ORDER BY datetime(r.departure_time) DESC LIMIT 1
+        ''', (user_id,)).fetchone()
+
+    def start(self):
+        """Start this process's dispatcher thread if it is not running yet"""
+        if self._pid != os.getpid():
+            self._ensure_worker()
+
+    def _ensure_worker(self):
+        # One dispatcher per process, started lazily so it survives fork
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, name='sos-dispatcher', daemon=True).start()
+
+    def _run(self):
+        conn = database.checkout()
+        while True:
+            try:
+                alert = self._claim(conn)
+                if alert is not None:
+                    self._dispatch(conn, alert)
+            except Exception as e:
+                # A claimed alert is requeued after CLAIM_TIMEOUT_SECONDS
+                self.errors += 1
+                print(f"SOS dispatcher error: {e}")
+                if conn.in_transaction:
+                    conn.rollback()
+                alert = None
+            if alert is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def _claim(self, conn):
+        # Requeue alerts whose worker died, then take the most urgent one.
+        # The WHERE is re-checked under the write lock, so two workers can
+        # never claim the same alert.
+        conn.execute(f'''
+            UPDATE sos_alerts SET dispatch_status = 'queued'
+            WHERE dispatch_status = 'dispatching'
+              AND claimed_at < datetime('now', '-{CLAIM_TIMEOUT_SECONDS} seconds')
+        ''')
+        rows = conn.execute('''
+            UPDATE sos_alerts
+            SET dispatch_status = 'dispatching', claimed_at = CURRENT_TIMESTAMP,
+                attempts = attempts + 1
+            WHERE id = (SELECT id FROM sos_alerts
+                        WHERE dispatch_status = 'queued'
+                          AND (retry_at IS NULL OR retry_at <= CURRENT_TIMESTAMP)
+                        ORDER BY priority DESC, id LIMIT 1)
+              AND dispatch_status = 'queued'
+            RETURNING id, user_id, latitude, longitude, address, priority, attempts, created_at
+        ''').fetchall()
+        conn.commit()
+        return dict(rows[0]) if rows else None
+
+    def recipients(self, conn, alert):
+        """Support staff, the user's current driver and the nearest drivers"""
+        found = {}
+
+        def add(rows, role, distances=None):
+            for row in rows:
+                if row['id'] == alert['user_id'] or row['id'] in found:
+                    continue
+                found[row['id']] = {
+                    'user_id': row['id'], 'name': row['name'], 'phone': row['phone'], 'role': role,
+                    'distance_km': (distances or {}).get(row['ride_id']) if 'ride_id' in row.keys() else None,
+                }
+
+        ride = self._current_ride(conn, alert['user_id'])
+        if ride:
+            add(conn.execute('SELECT id, name, phone FROM users WHERE id = ?',
+                             (ride['driver_id'],)).fetchall(), 'driver')
+
+        if self.locator is not None and alert['latitude'] is not None and alert['longitude'] is not None:
+            nearby = dict(self.locator.nearby(alert['latitude'], alert['longitude'],
+                                              NEAREST_DRIVERS, NEAREST_RADIUS_KM))
+            if nearby:
+                rows = conn.execute(f'''
+                    SELECT u.id, u.name, u.phone, r.id AS ride_id
+                    FROM rides r JOIN users u ON r.user_id = u.id
+                    WHERE r.id IN ({', '.join('?' * len(nearby))})
+                ''', list(nearby)).fetchall()
+                rows = sorted(rows, key=lambda row: nearby[row['ride_id']])
+                add(rows, 'nearby_driver', nearby)
+
+        add(conn.execute("SELECT id, name, phone FROM users WHERE user_type = 'admin'").fetchall(),
+            'support')
+        return list(found.values())
+
+    def _dispatch(self, conn, alert):
+        alert['map_link'] = map_link(alert['latitude'], alert['longitude'])
+        try:
+            recipients = self.recipients(conn, alert)
+        except Exception as e:
+            recipients = []
+            print(f"SOS #{alert['id']}: could not look up recipients: {e}")
+
+        log, errors = [], []
+        for notifier in self.notifiers:
+            try:
+                notifier.send(alert, recipients)
+                status, error = 'sent', None
+            except Exception as e:
+                status, error = 'failed', str(e)
+                errors.append(f'{notifier.name}: {e}')
+            log += [(alert['id'], notifier.name, r['user_id'], r['role'], status, error)
+                    for r in recipients] or [(alert['id'], notifier.name, None, None, status, error)]
+
+        delivered = len(errors) < len(self.notifiers)
+        if delivered:
+            outcome = 'dispatched'
+        elif alert['attempts'] >= MAX_ATTEMPTS:
+            outcome = 'failed'
+        else:
+            outcome = 'queued'
+        conn.executemany('''
+            INSERT INTO sos_notifications (alert_id, notifier, recipient_id, role, status, error)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', log)
+        # Retries back off without holding up other alerts in the queue
+        backoff = min(2 ** alert['attempts'], 60)
+        conn.execute(f'''
+            UPDATE sos_alerts
+            SET dispatch_status = ?, last_error = ?,
+                dispatched_at = CASE WHEN ? = 'dispatched' THEN CURRENT_TIMESTAMP END,
+                retry_at = CASE WHEN ? = 'queued' THEN datetime('now', '+{backoff} seconds') END
+            WHERE id = ?
+        ''', (outcome, '; '.join(errors) or None, outcome, outcome, alert['id']))
+        conn.commit()
+        if outcome == 'dispatched':
+            self.dispatched += 1
+        elif outcome == 'failed':
+            self.failed += 1
+        else:
+            self.retried += 1
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'dispatched': self.dispatched,
+            'retried': self.retried,
+            'failed': self.failed,
+            'errors': self.errors,
+            'notifiers': [n.name for n in self.notifiers],
+        }
@@ -54,6 +54,13 @@ document.addEventListener('DOMContentLoaded', () => {
             totalAmountEl.textContent = `₹${qty * ridePrice}`;
         }
 
+        // One key per booking attempt: a double click or a retry after a
+        // network error reaches the server with the same key and gets the
+        // original booking back instead of a second one
+        const idempotencyKey = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
         qtyInput.addEventListener('input', updateTotal);
 
         confirmBtn.addEventListener('click', async () => {
@@ -66,7 +73,7 @@ document.addEventListener('DOMContentLoaded', () => {
             try {
                 const resp = await fetch('/api/book-ride', {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
+                    headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey },
                     body: JSON.stringify({ ride_id: rideId, quantity: qty })
                 });
                 const result = await resp.json();
@@ -86,45 +93,4 @@ document.addEventListener('DOMContentLoaded', () => {
         // initial total
         updateTotal();
     }
-
-    const qtyInput = document.getElementById('quantityInput');
-    const totalAmountEl = document.getElementById('totalAmount');
-    const confirmBtn = document.getElementById('confirmBookingBtn');
-
-    function updateTotal() {
-        const qty = Number(qtyInput.value || 1);
-        totalAmountEl.textContent = `₹${qty * ridePrice}`;
-    }
-
-    qtyInput.addEventListener('input', updateTotal);
-
-    confirmBtn.addEventListener('click', async () => {
-        const qty = Number(qtyInput.value || 1);
-        if (qty < 1 || qty > availableCapacity) {
-            Swal.fire('Invalid Quantity', 'Please enter a valid quantity within capacity.', 'warning');
-            return;
-        }
-
-        try {
-            const resp = await fetch('/api/book-ride', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ ride_id: rideId, quantity: qty })
-            });
-            const result = await resp.json();
-            if (result.success) {
-                Swal.fire('Booked!', 'Your ride has been booked.', 'success').then(() => {
-                    window.location.href = '/my-bookings';
-                });
-            } else {
-                Swal.fire('Error', result.message || 'Could not book ride', 'error');
-            }
-        } catch (e) {
-            console.error(e);
-            Swal.fire('Error', 'An error occurred while booking', 'error');
-        }
-    });
-
-    // initial total
-    updateTotal();
 });
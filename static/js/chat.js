@@ -7,9 +7,50 @@ document.addEventListener('DOMContentLoaded', () => {
   function appendMessage(text, from='bot'){
     const div = document.createElement('div');
     div.className = from === 'user' ? 'text-end mb-2' : 'text-start mb-2';
-    div.innerHTML = `<div class="d-inline-block p-2 rounded" style="max-width:80%; background:${from==='user'? '#0d6efd':'#e9ecef'}; color:${from==='user'? '#fff':'#000'}">${text}</div>`;
+    const bubble = document.createElement('div');
+    bubble.className = 'd-inline-block p-2 rounded';
+    bubble.style.maxWidth = '80%';
+    bubble.style.background = from === 'user' ? '#0d6efd' : '#e9ecef';
+    bubble.style.color = from === 'user' ? '#fff' : '#000';
+    bubble.textContent = text;
+    div.appendChild(bubble);
     chatBox.appendChild(div);
     chatBox.scrollTop = chatBox.scrollHeight;
+    return bubble;
+  }
+
+  function appendRides(rides){
+    rides.forEach(ride => {
+      const card = document.createElement('div');
+      card.className = 'card mb-2';
+      card.style.maxWidth = '80%';
+      const body = document.createElement('div');
+      body.className = 'card-body p-2';
+      const route = document.createElement('div');
+      route.className = 'fw-bold';
+      route.textContent = `${ride.source_city} → ${ride.destination_city}`;
+      const details = document.createElement('div');
+      details.className = 'small text-muted';
+      const when = new Date(ride.departure_time.replace(' ', 'T'));
+      details.textContent = `${when.toLocaleString()} · ${ride.vehicle_type} · ${ride.driver_name} (${ride.rating}★) · ${ride.available_capacity} left · ₹${ride.price_per_unit}`;
+      const book = document.createElement('a');
+      book.className = 'btn btn-sm btn-primary mt-1';
+      book.href = `/booking/${ride.id}`;
+      book.textContent = 'Book';
+      body.append(route, details, book);
+      card.appendChild(body);
+      chatBox.appendChild(card);
+    });
+    chatBox.scrollTop = chatBox.scrollHeight;
+  }
+
+  function appendLink(href){
+    const link = document.createElement('a');
+    link.className = 'btn btn-sm btn-outline-primary mb-2';
+    link.href = href;
+    link.textContent = 'Open page';
+    chatBox.appendChild(link);
+    chatBox.scrollTop = chatBox.scrollHeight;
   }
 
   async function sendMessage(text){
@@ -19,8 +60,14 @@ document.addEventListener('DOMContentLoaded', () => {
     try{
       const res = await fetch('/api/chat', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({message:text})});
       const data = await res.json();
-      const reply = data.reply || 'Sorry, I did not get that.';
+      // A 429 from the rate limit carries a message instead of a reply
+      const reply = data.reply || data.message || 'Sorry, I did not get that.';
       appendMessage(reply, 'bot');
+      if(data.rides && data.rides.length){
+        appendRides(data.rides);
+      } else if(data.link){
+        appendLink(data.link);
+      }
       // speak
       if(window.speechSynthesis){
         const utter = new SpeechSynthesisUtterance(reply);
@@ -1,5 +1,5 @@
 document.addEventListener('DOMContentLoaded', () => {
-    console.log('[find-ride.js] loaded (v2) - Teleport autocomplete active');
+    console.log('[find-ride.js] loaded (v3) - local city autocomplete active');
     const searchForm = document.getElementById('searchForm');
     const searchResults = document.getElementById('searchResults');
     const resultsCount = document.getElementById('resultsCount');
@@ -12,8 +12,26 @@ document.addEventListener('DOMContentLoaded', () => {
         priceRangeValue.textContent = `₹${priceRange.value}`;
     });
 
-    // City suggestions using Teleport Cities API (no server-side city list required)
-    // Teleport docs: https://developers.teleport.org/api/
+    // Sidebar filters are applied by the server (ride_type, max_price,
+    // vehicle_type on /api/search-rides); changing one reruns the search
+    const rideTypeFilters = ['filterCar', 'filterBike', 'filterLogistics'].map(id => document.getElementById(id));
+    const vehicleTypeFilter = document.getElementById('vehicleTypeFilter');
+
+    function filterParams() {
+        const params = {};
+        const checked = rideTypeFilters.filter(box => box.checked).map(box => box.value);
+        // All or none checked means no ride type filter
+        if (checked.length && checked.length < rideTypeFilters.length) params.ride_type = checked.join(',');
+        if (Number(priceRange.value) < Number(priceRange.max)) params.max_price = priceRange.value;
+        if (vehicleTypeFilter.value) params.vehicle_type = vehicleTypeFilter.value;
+        return params;
+    }
+
+    [...rideTypeFilters, priceRange, vehicleTypeFilter].forEach(el => el.addEventListener('change', () => {
+        if (searchParams) fetchRides();
+    }));
+
+    // City suggestions come from the server's bundled gazetteer (/api/city-suggest)
     const cityOptions = document.getElementById('cityOptions');
     const sourceInput = document.getElementById('sourceInput');
     const destinationInput = document.getElementById('destinationInput');
@@ -124,7 +142,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (document.activeElement === destinationInput) {
             renderDropdown(destDropdown, suggestions, destinationInput);
         }
-    }, 400);
+    }, 150);
 
     [sourceInput, destinationInput].forEach(inp => {
         if (!inp) return;
@@ -148,8 +166,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     searchForm.addEventListener('submit', async (e) => {
         e.preventDefault();
-        // No server-side city list required: we allow free-form city names but suggestions
-        // are provided by Teleport. Proceed directly to search.
+        // Free-form city names are allowed; suggestions are only a convenience.
+        // Proceed directly to search.
         clearValidation();
         await fetchRides();
     });
@@ -176,21 +194,102 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // Ride results are fetched a page at a time (keyset cursor) and only
+    // with the columns the card shows; the next page loads when the
+    // sentinel below the list scrolls into view.
+    const PAGE_SIZE = 20;
+    const CARD_FIELDS = [
+        'id', 'ride_type', 'driver_name', 'rating', 'price_per_unit', 'source_city',
+        'destination_city', 'departure_time', 'vehicle_type', 'vehicle_number',
+        'available_capacity', 'contact_number'
+    ].join(',');
+    let searchParams = null;
+    let nextCursor = null;
+    let loadedCount = 0;
+    let loadingPage = false;
+
+    const pageSentinel = document.createElement('div');
+    pageSentinel.className = 'py-2';
+    const pageObserver = 'IntersectionObserver' in window
+        ? new IntersectionObserver((entries) => {
+            if (entries.some(entry => entry.isIntersecting)) fetchNextPage();
+        }, { rootMargin: '200px' })
+        : null;
+
+    function renderRideCard(ride) {
+        const rideCard = document.createElement('div');
+        rideCard.classList.add('ride-card', `ride-type-${ride.ride_type}`);
+        rideCard.innerHTML = `
+            <div class="p-3">
+                <div class="d-flex align-items-center mb-2">
+                    <div class="driver-avatar me-3">${ride.driver_name.charAt(0)}</div>
+                    <div>
+                        <strong>${ride.driver_name}</strong> (${ride.ride_type})
+                        <div class="rating-stars">${'★'.repeat(Math.round(ride.rating))}</div>
+                    </div>
+                    <div class="ms-auto d-flex align-items-center gap-2">
+                        <div class="price-tag">₹${ride.price_per_unit}</div>
+                        <a href="/booking/${ride.id}" class="btn btn-sm btn-primary">Book</a>
+                    </div>
+                </div>
+                <p><strong>From:</strong> ${ride.source_city} &nbsp; | &nbsp; <strong>To:</strong> ${ride.destination_city}</p>
+                <p><strong>Departure:</strong> ${new Date(ride.departure_time).toLocaleString()}</p>
+                <p><strong>Vehicle:</strong> ${ride.vehicle_type} (${ride.vehicle_number}) &nbsp; | &nbsp; <strong>Capacity:</strong> ${ride.available_capacity}</p>
+                <p><strong>Contact:</strong> ${ride.contact_number}</p>
+            </div>
+        `;
+        return rideCard;
+    }
+
+    async function fetchPage(cursor) {
+        const params = new URLSearchParams(searchParams);
+        params.set('limit', PAGE_SIZE);
+        params.set('fields', CARD_FIELDS);
+        if (cursor) params.set('after', cursor);
+        const response = await fetch(`/api/search-rides?${params.toString()}`);
+        return response.json();
+    }
+
+    function showPage(page) {
+        page.rides.forEach(ride => searchResults.insertBefore(renderRideCard(ride), pageSentinel));
+        loadedCount += page.rides.length;
+        nextCursor = page.next_cursor;
+        resultsCount.textContent = nextCursor ? `${loadedCount}+` : loadedCount;
+        if (!nextCursor && pageObserver) pageObserver.unobserve(pageSentinel);
+    }
+
+    async function fetchNextPage() {
+        if (loadingPage || !nextCursor) return;
+        loadingPage = true;
+        try {
+            showPage(await fetchPage(nextCursor));
+        } catch (error) {
+            console.error('Error fetching more rides:', error);
+        } finally {
+            loadingPage = false;
+        }
+    }
+
     async function fetchRides() {
         searchResults.innerHTML = '';
         loadingSpinner.style.display = 'block';
+        if (pageObserver) pageObserver.unobserve(pageSentinel);
 
-        const from = searchForm.elements['source'].value;
-        const to = searchForm.elements['destination'].value;
-        const date = searchForm.elements['travel_date'].value;
+        searchParams = {
+            source: searchForm.elements['source'].value,
+            destination: searchForm.elements['destination'].value,
+            travel_date: searchForm.elements['travel_date'].value,
+            ...filterParams()
+        };
+        nextCursor = null;
+        loadedCount = 0;
 
         try {
-            const response = await fetch(`/api/search-rides?source=${from}&destination=${to}&travel_date=${date}`);
-            const rides = await response.json();
+            loadingPage = true;
+            const page = await fetchPage(null);
 
-            resultsCount.textContent = rides.length;
-
-            if (rides.length === 0) {
+            if (page.rides.length === 0) {
+                resultsCount.textContent = 0;
                 searchResults.innerHTML = `
                     <div class="no-rides">
                         <div class="no-rides-icon"><i class="fas fa-road"></i></div>
@@ -199,34 +298,14 @@ document.addEventListener('DOMContentLoaded', () => {
                     </div>
                 `;
             } else {
-                rides.forEach(ride => {
-                    const rideCard = document.createElement('div');
-                    rideCard.classList.add('ride-card', `ride-type-${ride.ride_type}`);
-                    rideCard.innerHTML = `
-                        <div class="p-3">
-                            <div class="d-flex align-items-center mb-2">
-                                <div class="driver-avatar me-3">${ride.driver_name.charAt(0)}</div>
-                                <div>
-                                    <strong>${ride.driver_name}</strong> (${ride.ride_type})
-                                    <div class="rating-stars">${'★'.repeat(Math.round(ride.rating))}</div>
-                                </div>
-                                <div class="ms-auto d-flex align-items-center gap-2">
-                                    <div class="price-tag">₹${ride.price_per_unit}</div>
-                                    <a href="/booking/${ride.id}" class="btn btn-sm btn-primary">Book</a>
-                                </div>
-                            </div>
-                            <p><strong>From:</strong> ${ride.source_city} &nbsp; | &nbsp; <strong>To:</strong> ${ride.destination_city}</p>
-                            <p><strong>Departure:</strong> ${new Date(ride.departure_time).toLocaleString()}</p>
-                            <p><strong>Vehicle:</strong> ${ride.vehicle_type} (${ride.vehicle_number}) &nbsp; | &nbsp; <strong>Capacity:</strong> ${ride.available_capacity}</p>
-                            <p><strong>Contact:</strong> ${ride.contact_number}</p>
-                        </div>
-                    `;
-                    searchResults.appendChild(rideCard);
-                });
+                searchResults.appendChild(pageSentinel);
+                showPage(page);
+                if (nextCursor && pageObserver) pageObserver.observe(pageSentinel);
             }
         } catch (error) {
             console.error('Error fetching rides:', error);
         } finally {
+            loadingPage = false;
             loadingSpinner.style.display = 'none';
         }
     }
@@ -19,37 +19,35 @@ class YatraSetuApp {
             triggerBtn.disabled = true;
 
             try {
-                if (!navigator.geolocation) {
-                    throw new Error('Geolocation is not supported by your browser.');
+                // Never let a slow or denied location fix hold up the alert:
+                // accept a recent cached fix and fall back to sending without one
+                let coords = {};
+                if (navigator.geolocation) {
+                    try {
+                        const position = await new Promise((resolve, reject) => {
+                            navigator.geolocation.getCurrentPosition(resolve, reject, {
+                                enableHighAccuracy: true,
+                                timeout: 5000,
+                                maximumAge: 60000
+                            });
+                        });
+                        coords = {
+                            latitude: position.coords.latitude,
+                            longitude: position.coords.longitude
+                        };
+                    } catch (e) {
+                        console.warn('SOS without location:', e.message);
+                    }
                 }
 
-                const position = await new Promise((resolve, reject) => {
-                    navigator.geolocation.getCurrentPosition(resolve, reject, {
-                        enableHighAccuracy: true,
-                        timeout: 10000,
-                        maximumAge: 0
-                    });
-                });
-
-                const lat = position.coords.latitude;
-                const lng = position.coords.longitude;
-
-                // Get address using reverse geocoding
-                const response = await fetch(`https://nominatim.openstreetmap.org/reverse?format=json&lat=${lat}&lon=${lng}`);
-                const data = await response.json();
-                const address = data.display_name || 'Address not available';
-
-                // Send SOS alert
+                // The server links the coordinates on a map for responders,
+                // so there is no reverse-geocoding round trip before posting
                 const sosResponse = await fetch('/sos', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
-                    body: JSON.stringify({
-                        latitude: lat,
-                        longitude: lng,
-                        address: address
-                    })
+                    body: JSON.stringify(coords)
                 });
 
                 const result = await sosResponse.json();
@@ -33,28 +33,72 @@ document.addEventListener('DOMContentLoaded', () => {
             .bindPopup(`Dropoff Location: ${booking.dropoff_address || ''}`);
     }
 
-    function updateDriverLocation() {
+    const statusBadge = document.getElementById('statusBadge');
+
+    function showStatus(status) {
+        if (!status || !statusBadge) return;
+        statusBadge.textContent = status;
+        statusBadge.className = 'badge ' +
+            (status === 'completed' ? 'bg-success' :
+             status === 'cancelled' ? 'bg-danger' : 'bg-warning');
+    }
+
+    function moveDriver(lat, lng) {
+        if (lat == null || lng == null) return;
+        if (window.driverMarker) {
+            window.driverMarker.setLatLng([lat, lng]);
+        } else {
+            window.driverMarker = L.marker([lat, lng])
+                .addTo(map)
+                .bindPopup('Your Driver')
+                .openPopup();
+            map.setView([lat, lng], 13);
+        }
+    }
+
+    // Fallback for browsers without EventSource
+    function pollDriverLocation() {
         fetch(`/api/booking/${booking.id}/location`)
             .then(response => response.json())
             .then(data => {
-                if (data.current_lat && data.current_lng) {
-                    if (window.driverMarker) {
-                        window.driverMarker.setLatLng([data.current_lat, data.current_lng]);
-                    } else {
-                        window.driverMarker = L.marker([data.current_lat, data.current_lng])
-                            .addTo(map)
-                            .bindPopup('Your Driver')
-                            .openPopup();
-                    }
-
-                    document.getElementById('statusBadge').textContent = data.status;
-                    document.getElementById('statusBadge').className = 'badge ' +
-                        (data.status === 'completed' ? 'bg-success' :
-                         data.status === 'cancelled' ? 'bg-danger' : 'bg-warning');
-                }
+                moveDriver(data.current_lat, data.current_lng);
+                showStatus(data.status);
             });
     }
 
-    setInterval(updateDriverLocation, 5000);
-    updateDriverLocation();
+    let polling = null;
+    function startPolling() {
+        if (polling) return;
+        polling = setInterval(pollDriverLocation, 5000);
+        pollDriverLocation();
+    }
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    // The server pushes each new position; EventSource reconnects by itself
+    const stream = new EventSource(`/api/booking/${booking.id}/location/stream`);
+    stream.addEventListener('trail', event => {
+        const data = JSON.parse(event.data);
+        const last = data.points[data.points.length - 1];
+        if (last) moveDriver(last.lat, last.lng);
+        showStatus(data.status);
+    });
+    stream.addEventListener('location', event => {
+        const data = JSON.parse(event.data);
+        moveDriver(data.lat, data.lng);
+    });
+    stream.addEventListener('status', event => {
+        const data = JSON.parse(event.data);
+        showStatus(data.status);
+        if (data.status === 'completed' || data.status === 'cancelled') stream.close();
+    });
+    // A stream the server turned away (503 when it is at its limit) is
+    // not retried by EventSource; keep the map moving by polling instead
+    stream.addEventListener('error', () => {
+        if (stream.readyState === EventSource.CLOSED) startPolling();
+    });
+    window.addEventListener('beforeunload', () => stream.close());
 });
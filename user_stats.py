@@ -0,0 +1,143 @@
+"""Per-user and per-ride counters behind the dashboard and history pages.
+
+user_stats holds each user's ride and booking totals, and rides carries
+its own bookings_count / seats_booked. Triggers on rides and bookings
+keep all of them current on every write path (post-ride, imports,
+bookings, status changes), so the dashboard, My Rides and My Bookings
+read one row by primary key instead of counting a user's whole history.
+
+Consistency check: python user_stats.py [--rebuild] [db path]
+"""
+import sys
+
+# Counter columns of user_stats, in table order
+COUNTERS = (
+    'active_rides', 'rides_posted', 'completed_rides', 'bookings_received',
+    'total_bookings', 'confirmed_bookings', 'completed_bookings', 'total_spent',
+)
+
+# user_stats and its triggers are created by migration step 7; step 9
+# makes the delete triggers skip rows ride_archive.py is moving to the
+# archive tables (archive_state.moving), so archived rides and bookings
+# still count towards a user's totals (migrations.py)
+
+# The counters as computed from scratch, one row per user; {rides} and
+# {bookings} are the live tables, plus the archive once it exists
+_RECOUNT = '''
+    SELECT u.id AS user_id,
+           COALESCE(r.active_rides, 0) AS active_rides,
+           COALESCE(r.rides_posted, 0) AS rides_posted,
+           COALESCE(r.completed_rides, 0) AS completed_rides,
+           COALESCE(r.bookings_received, 0) AS bookings_received,
+           COALESCE(b.total_bookings, 0) AS total_bookings,
+           COALESCE(b.confirmed_bookings, 0) AS confirmed_bookings,
+           COALESCE(b.completed_bookings, 0) AS completed_bookings,
+           COALESCE(b.total_spent, 0) AS total_spent
+    FROM users u
+    LEFT JOIN (
+        SELECT rides.user_id,
+               SUM(rides.status = 'active') AS active_rides,
+               COUNT(*) AS rides_posted,
+               SUM(rides.status = 'completed') AS completed_rides,
+               COALESCE(SUM(received.bookings), 0) AS bookings_received
+        FROM {rides} rides
+        LEFT JOIN (
+            SELECT ride_id, COUNT(*) AS bookings FROM {bookings} bookings GROUP BY ride_id
+        ) received ON received.ride_id = rides.id
+        GROUP BY rides.user_id
+    ) r ON r.user_id = u.id
+    LEFT JOIN (
+        SELECT passenger_id,
+               COUNT(*) AS total_bookings,
+               SUM(status = 'confirmed') AS confirmed_bookings,
+               SUM(status = 'completed') AS completed_bookings,
+               SUM(total_amount) AS total_spent
+        FROM {bookings} bookings GROUP BY passenger_id
+    ) b ON b.passenger_id = u.id
+'''
+
+_RIDE_RECOUNT = '''
+    UPDATE rides SET
+        bookings_count = (SELECT COUNT(*) FROM bookings WHERE ride_id = rides.id),
+        seats_booked = (SELECT COALESCE(SUM(quantity), 0) FROM bookings WHERE ride_id = rides.id)
+'''
+
+_ARCHIVED_RIDES = '(SELECT id, user_id, status FROM rides UNION ALL SELECT id, user_id, status FROM rides_archive)'
+_ARCHIVED_BOOKINGS = '''(
+    SELECT ride_id, passenger_id, status, total_amount FROM bookings
+    UNION ALL SELECT ride_id, passenger_id, status, total_amount FROM bookings_archive
+)'''
+
+DEFAULT_STATS = dict({c: 0 for c in COUNTERS}, rating=5.0, days_joined=1)
+
+
+def _recount(conn):
+    archived = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'rides_archive'").fetchone()
+    if archived:
+        return _RECOUNT.format(rides=_ARCHIVED_RIDES, bookings=_ARCHIVED_BOOKINGS)
+    return _RECOUNT.format(rides='rides', bookings='bookings')
+
+
+def rebuild(conn):
+    """Recompute every counter from rides and bookings"""
+    conn.execute(_RIDE_RECOUNT)
+    conn.execute('DELETE FROM user_stats')
+    conn.execute(f"INSERT INTO user_stats (user_id, {', '.join(COUNTERS)}) SELECT * FROM ({_recount(conn)})")
+    conn.commit()
+
+
+def check(conn):
+    """Return the users and rides whose stored counters disagree with a recount"""
+    mismatch = ' OR '.join(f'c.{c} IS NOT COALESCE(s.{c}, 0)' for c in COUNTERS)
+    rows = conn.execute(f'''
+        SELECT c.*, {', '.join(f's.{c} AS stored_{c}' for c in COUNTERS)}
+        FROM ({_recount(conn)}) c LEFT JOIN user_stats s ON s.user_id = c.user_id
+        WHERE {mismatch}
+    ''').fetchall()
+    drift = [dict(row) for row in rows]
+    rides = conn.execute('''
+        SELECT r.id AS ride_id, r.bookings_count, r.seats_booked,
+               COUNT(b.id) AS counted_bookings, COALESCE(SUM(b.quantity), 0) AS counted_seats
+        FROM rides r LEFT JOIN bookings b ON b.ride_id = r.id
+        GROUP BY r.id
+        HAVING r.bookings_count IS NOT counted_bookings OR r.seats_booked IS NOT counted_seats
+    ''').fetchall()
+    return drift + [dict(row) for row in rides]
+
+
+def dashboard_stats(conn, user_id):
+    """Counters, rating and days since joining for one user, in one lookup"""
+    row = conn.execute(f'''
+        SELECT {', '.join(f'COALESCE(s.{c}, 0) AS {c}' for c in COUNTERS)},
+               u.rating,
+               CAST(julianday('now') - julianday(u.member_since) AS INTEGER) AS days_joined
+        FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+        WHERE u.id = ?
+    ''', (user_id,)).fetchone()
+    if row is None:
+        return dict(DEFAULT_STATS)
+    stats = dict(row)
+    if stats['days_joined'] is None:
+        stats['days_joined'] = 1
+    return stats
+
+
+if __name__ == '__main__':
+    import database
+    import migrations
+
+    args = [a for a in sys.argv[1:] if a != '--rebuild']
+    conn = database.connect(args[0] if args else None)
+    migrations.migrate(conn)
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_stats'").fetchone():
+        print('❌ Database is not initialized; run database.py first')
+        sys.exit(1)
+    if '--rebuild' in sys.argv:
+        rebuild(conn)
+        print('✅ user_stats rebuilt')
+    drift = check(conn)
+    for row in drift:
+        print(f"❌ {row}")
+    if not drift:
+        print('✅ user_stats matches rides and bookings')
+    sys.exit(1 if drift else 0)
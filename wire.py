@@ -0,0 +1,179 @@
+"""How API responses go on the wire: compact JSON, columnar lists, compression.
+
+- Rows holds query results as the tuples the cursor returned plus their
+  column names. It is encoded straight from the tuples through a
+  template built once per column list, with no dict per row, and each
+  encoding is kept, so a cached search is encoded once however often it
+  is served. Callers that want dicts can iterate over it.
+- With columnar=True (format=columns on list endpoints) the keys are
+  sent once: {"columns": [...], "rows": [[...], ...]}.
+- compress() runs after every request. JSON and text bodies of at least
+  COMPRESS_MIN_BYTES are sent as brotli when that package is installed
+  and the client accepts it, or as gzip otherwise. A strong ETag means
+  the same URL and tag always carry the same bytes, so the last
+  REUSE_ENTRIES compressed bodies with one are kept and sent again.
+"""
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('API_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('API_GZIP_LEVEL', 5))
+BROTLI_QUALITY = 5
+REUSE_ENTRIES = 64
+COMPRESSIBLE = {'application/json', 'text/html', 'text/plain', 'text/csv'}
+# Preferred first
+CODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+# JSON for each type SQLite returns; anything else goes through json.dumps
+_VALUE = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: float.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
+
+
+def _value(value):
+    encode = _VALUE.get(type(value))
+    return encode(value) if encode else json.dumps(value)
+
+
+@lru_cache(maxsize=256)
+def _template(columns):
+    # '{"id":%s,"source_city":%s,...}' for one column list
+    keys = (encode_basestring_ascii(column).replace('%', '%%') for column in columns)
+    return '{' + ','.join(f'{key}:%s' for key in keys) + '}'
+
+
+class Rows:
+    """Result rows as tuples with their column names; iterates as dicts"""
+
+    __slots__ = ('columns', 'rows', '_encoded')
+
+    def __init__(self, columns, rows):
+        self.columns = tuple(columns)
+        self.rows = rows
+        self._encoded = {}
+
+    @classmethod
+    def from_dicts(cls, dicts):
+        """Rows of dicts that all have the same keys in the same order"""
+        columns = tuple(dicts[0]) if dicts else ()
+        return cls(columns, [tuple(row.values()) for row in dicts])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        columns = self.columns
+        return (dict(zip(columns, row)) for row in self.rows)
+
+    def json(self, columnar=False):
+        encoded = self._encoded.get(columnar)
+        if encoded is None:
+            if columnar:
+                rows = ','.join('[' + ','.join(map(_value, row)) + ']' for row in self.rows)
+                encoded = f'{{"columns":{json.dumps(self.columns)},"rows":[{rows}]}}'
+            else:
+                template = _template(self.columns)
+                encoded = '[' + ','.join(template % tuple(map(_value, row)) for row in self.rows) + ']'
+            # Two threads racing here store the same string
+            self._encoded[columnar] = encoded
+        return encoded
+
+
+def dumps(payload, columnar=False):
+    """Compact JSON for payload; Rows, bare or as a value of a dict, take the fast path"""
+    if isinstance(payload, Rows):
+        return payload.json(columnar)
+    if isinstance(payload, dict) and any(isinstance(value, Rows) for value in payload.values()):
+        return '{' + ','.join(f'{encode_basestring_ascii(str(key))}:{dumps(value, columnar)}'
+                              for key, value in payload.items()) + '}'
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def etag_variants(etag):
+    """etag as sent uncompressed and as compress() sends it for each coding"""
+    return (etag,) + tuple(f'{etag}-{coding}' for coding in CODINGS)
+
+
+class Compressor:
+    def __init__(self, min_bytes=COMPRESS_MIN_BYTES, reuse_entries=REUSE_ENTRIES):
+        self.min_bytes = min_bytes
+        self.reuse_entries = reuse_entries
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.responses = {coding: 0 for coding in CODINGS}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped_small = 0
+        self.reused = 0
+
+    def compress(self, response, accept_encodings, path=''):
+        """Encode response in place for a client whose Accept-Encoding is accept_encodings"""
+        if (response.mimetype not in COMPRESSIBLE or response.direct_passthrough
+                or response.is_streamed or 'Content-Encoding' in response.headers
+                or response.status_code in (204, 304) or response.status_code < 200):
+            return response
+        response.vary.add('Accept-Encoding')
+        coding = next((c for c in CODINGS if accept_encodings[c]), None)
+        if coding is None:
+            return response
+        etag, weak = response.get_etag()
+        key = (path, etag, coding) if etag and not weak else None
+        with self._lock:
+            recent = self._recent.get(key) if key else None
+            if recent:
+                self._recent.move_to_end(key)
+                self.reused += 1
+        if recent:
+            size, encoded = recent
+        else:
+            body = response.get_data()
+            size = len(body)
+            if size < self.min_bytes:
+                with self._lock:
+                    self.skipped_small += 1
+                return response
+            if coding == 'br':
+                encoded = brotli.compress(body, quality=BROTLI_QUALITY)
+            else:
+                encoded = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        response.set_data(encoded)
+        response.headers['Content-Encoding'] = coding
+        # A strong ETag names one exact byte sequence, so each coding gets its own
+        if key:
+            response.set_etag(f'{etag}-{coding}')
+        with self._lock:
+            self.responses[coding] += 1
+            self.bytes_in += size
+            self.bytes_out += len(encoded)
+            if key and not recent:
+                self._recent[key] = (size, encoded)
+                while len(self._recent) > self.reuse_entries:
+                    self._recent.popitem(last=False)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                'codings': list(CODINGS),
+                'min_bytes': self.min_bytes,
+                'responses': dict(self.responses),
+                'skipped_small': self.skipped_small,
+                'reused': self.reused,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else None,
+            }